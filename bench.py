@@ -0,0 +1,519 @@
+"""Замеры производительности бота на локальных ICS-файлах из репозитория.
+
+Запуск: python bench.py <замер>
+"""
+import argparse
+import asyncio
+import builtins
+import datetime
+import logging
+import logging.handlers
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import urllib.parse
+from array import array
+
+import main as bot
+import gen_scale_data
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# === ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===
+def local_ics_path(url):
+    """Путь к локальной копии ICS-файла, на который указывает URL"""
+    return os.path.join(REPO_DIR, urllib.parse.unquote(url.rsplit('/', 1)[-1]))
+
+def load_bundled_calendars():
+    """Читает ICS-файлы из репозитория: {(курс, поток): текст}"""
+    calendars = {}
+    for course, streams in bot.STREAM_URLS.items():
+        for stream, url in streams.items():
+            path = local_ics_path(url)
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    calendars[(course, stream)] = f.read()
+    return calendars
+
+def best_of(func, repeat):
+    """Лучшее время из нескольких прогонов, мс"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    return min(timings)
+
+def deep_sizeof(obj, seen=None):
+    """Размер объекта вместе со всем, на что он ссылается (общие объекты считаются один раз)"""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, type):
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif isinstance(obj, array):
+        pass
+    elif hasattr(obj, '__slots__'):
+        size += sum(deep_sizeof(getattr(obj, name), seen) for name in obj.__slots__ if hasattr(obj, name))
+    elif hasattr(obj, '__dict__'):
+        size += deep_sizeof(vars(obj), seen)
+    return size
+
+def replicate_streams(calendars, copies):
+    """Размножает потоки: каждая копия — отдельная группа из тех же потоков со сдвигом по времени"""
+    streams = {}
+    for copy in range(copies):
+        for (course, stream), data in calendars.items():
+            events = bot.parse_ics(data)
+            for event in events:
+                event['start_ts'] += 600 * copy
+                event['end_ts'] += 600 * copy
+            streams[f"{course}_{stream}{copy}"] = events
+    return streams
+
+class FakeMessage:
+    chat_id = 1
+    message_id = 1
+
+    async def reply_text(self, text, reply_markup=None):
+        pass
+
+class FakeQuery:
+    def __init__(self, data=None):
+        self.message = FakeMessage()
+        self.data = data
+        self.edits = 0
+
+    async def answer(self, text=None, **kwargs):
+        pass
+
+    async def edit_message_text(self, text, reply_markup=None):
+        self.edits += 1
+
+class FakeUpdate:
+    """Минимальный Update для вызова обработчиков без Telegram"""
+
+    def __init__(self, user_id, username="student", data=None):
+        self.effective_user = type("User", (), {"id": user_id, "username": username})()
+        self.callback_query = FakeQuery(data)
+        self.message = FakeMessage()
+
+class FakeContext:
+    def __init__(self):
+        self.user_data = {}
+
+def count_io_calls():
+    """Подменяет open, requests.get и загрузку расписания счетчиками; возвращает (счетчик, функция отката)"""
+    calls = {"open": 0, "requests.get": 0, "load_events_from_github": 0, "fetch_calendar": 0, "download_ics": 0}
+    originals = (builtins.open, bot.requests.get, bot.load_events_from_github, bot.fetch_calendar, bot.download_ics)
+
+    def counted(name, func):
+        def wrapper(*args, **kwargs):
+            calls[name] += 1
+            return func(*args, **kwargs)
+        return wrapper
+
+    builtins.open = counted("open", originals[0])
+    bot.requests.get = counted("requests.get", originals[1])
+    bot.load_events_from_github = counted("load_events_from_github", originals[2])
+    bot.fetch_calendar = counted("fetch_calendar", originals[3])
+    bot.download_ics = counted("download_ics", originals[4])
+
+    def restore():
+        builtins.open, bot.requests.get, bot.load_events_from_github, bot.fetch_calendar, bot.download_ics = originals
+    return calls, restore
+
+def reset_caches():
+    bot.events_cache.clear()
+    bot.day_index_cache.clear()
+    bot.base_day_index_cache.clear()
+
+# === ЗАМЕРЫ ===
+def bench_startup(args):
+    """Холодный старт: полный разбор ICS против загрузки бинарных снимков"""
+    calendars = load_bundled_calendars()
+    snapshot_dir = tempfile.mkdtemp(prefix="snapshots_")
+    bot.SNAPSHOT_DIR = snapshot_dir
+
+    def cold_parse():
+        reset_caches()
+        for (course, stream), data in calendars.items():
+            bot.store_parsed_events(course, stream, bot.parse_ics(data))
+
+    def from_snapshots():
+        reset_caches()
+        bot.load_snapshots()
+
+    try:
+        for (course, stream), data in calendars.items():
+            bot.save_snapshot(course, stream, bot.ics_content_hash(data), bot.parse_ics(data))
+
+        parse_ms = best_of(cold_parse, args.repeat)
+        snapshot_ms = best_of(from_snapshots, args.repeat)
+        events = sum(len(events) for events in bot.events_cache.values())
+        snapshot_bytes = sum(
+            os.path.getsize(os.path.join(snapshot_dir, name)) for name in os.listdir(snapshot_dir)
+        )
+    finally:
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+    print(f"Потоков: {len(calendars)}, событий: {events}")
+    print(f"Разбор ICS (без сети):   {parse_ms:8.2f} мс")
+    print(f"Загрузка снимков:        {snapshot_ms:8.2f} мс  ({snapshot_bytes / 1024:.1f} КБ на диске)")
+    print(f"Ускорение:               {parse_ms / snapshot_ms:8.1f}x")
+
+def bench_datetime(args):
+    """Декодирование дат: strptime + localize против срезов с кэшем смещения"""
+    calendars = load_bundled_calendars()
+    values = [
+        value
+        for data in calendars.values()
+        for value in re.findall(r'DT(?:START|END)[^:\n]*:(\d{8}T\d{6})', data)
+    ]
+    iso_dates = [value[:4] + '-' + value[4:6] + '-' + value[6:8] for value in values]
+
+    def old_ics():
+        for value in values:
+            bot.TIMEZONE.localize(datetime.datetime.strptime(value, '%Y%m%dT%H%M%S'))
+
+    def new_ics():
+        for value in values:
+            bot.decode_ics_datetime(value)
+
+    def old_iso():
+        for value in iso_dates:
+            datetime.datetime.strptime(value, "%Y-%m-%d").date()
+
+    def new_iso():
+        for value in iso_dates:
+            bot.decode_iso_date(value)
+
+    def parse_all():
+        for data in calendars.values():
+            bot.parse_ics(data)
+
+    rows = [
+        (f"YYYYMMDDTHHMMSS x{len(values)}", best_of(old_ics, args.repeat), best_of(new_ics, args.repeat)),
+        (f"YYYY-MM-DD x{len(iso_dates)}", best_of(old_iso, args.repeat), best_of(new_iso, args.repeat)),
+    ]
+    print(f"{'формат':<24} {'strptime, мс':>13} {'срезы, мс':>10} {'ускорение':>10}")
+    for name, old_ms, new_ms in rows:
+        print(f"{name:<24} {old_ms:>13.2f} {new_ms:>10.2f} {old_ms / new_ms:>9.1f}x")
+    print(f"Полный разбор {len(calendars)} ICS: {best_of(parse_all, args.repeat):.2f} мс")
+
+def bench_menu(args):
+    """Навигация по меню на холодном кэше: ни сети, ни файлов, ни загрузки расписания.
+    Кнопка «Назад» проходит тот же путь, что в приложении: track_activity (группа -1), затем handle_query."""
+    workdir = tempfile.mkdtemp(prefix="menu_")
+    previous_dir = os.getcwd()
+    os.chdir(workdir)
+    reset_caches()
+    update = FakeUpdate(user_id=1)
+    back_update = FakeUpdate(user_id=1, data="back_to_menu_1_sdi")
+    context = FakeContext()
+
+    async def navigate(times):
+        for _ in range(times):
+            await bot.show_main_menu(update, None, "1", "sdi", "morning")
+
+    async def go_back(times):
+        for _ in range(times):
+            await bot.track_activity(back_update, context)
+            await bot.handle_query(back_update, context)
+
+    try:
+        # Первый показ сохраняет выбор пользователя — это единственная ожидаемая запись
+        asyncio.run(navigate(1))
+        calls, restore = count_io_calls()
+        try:
+            started = time.perf_counter()
+            asyncio.run(navigate(args.repeat * 100))
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            started = time.perf_counter()
+            asyncio.run(go_back(args.repeat * 100))
+            back_ms = (time.perf_counter() - started) * 1000
+        finally:
+            restore()
+    finally:
+        os.chdir(previous_dir)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    total = sum(calls.values())
+    print(f"Переходов в меню: {args.repeat * 100}, среднее {elapsed_ms / (args.repeat * 100) * 1000:.1f} мкс")
+    print(f"Нажатий «Назад» через track_activity и handle_query: {args.repeat * 100}, среднее {back_ms / (args.repeat * 100) * 1000:.1f} мкс")
+    print(f"Вызовы ввода-вывода: {calls}")
+    print(f"Запросов к Telegram: {update.callback_query.edits + back_update.callback_query.edits} (повторные показы пропущены)")
+    print(f"Загружено потоков: {len(bot.events_cache)}")
+    if total or bot.events_cache:
+        print("ОШИБКА: меню обращается к диску, сети или расписанию")
+        sys.exit(1)
+
+def bench_logging(args):
+    """Рассылка напоминаний глазами цикла событий: синхронная запись в файл против очереди"""
+    workdir = tempfile.mkdtemp(prefix="logging_")
+    count = args.repeat * 2000
+    root = logging.getLogger()
+    previous_handlers = list(root.handlers)
+    previous_level = root.level
+    record_flags = ("_srcfile", "logThreads", "logProcesses", "logMultiprocessing")
+    previous_flags = {flag: getattr(logging, flag) for flag in record_flags}
+    # Как в bot.setup_logging при запуске бота: уровень INFO и записи без файла, потока и процесса.
+    # При импорте main логирование не настраивается, поэтому замер выставляет это сам и потом откатывает
+    root.setLevel(logging.INFO)
+    logging._srcfile = None
+    logging.logThreads = logging.logProcesses = logging.logMultiprocessing = False
+
+    def install(*handlers):
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        for handler in handlers:
+            root.addHandler(handler)
+
+    def file_handler(name):
+        handler = logging.FileHandler(os.path.join(workdir, name), encoding="utf-8")
+        handler.setFormatter(bot.StructuredFormatter(bot.LOG_FORMAT))
+        return handler
+
+    def fan_out(lazy):
+        started = time.perf_counter()
+        for user_id in range(count):
+            if lazy:
+                logging.info("📤 Отправлено напоминание пользователю %s", user_id,
+                             extra={"event": "reminder_sent", "user_id": user_id})
+            else:
+                logging.info(f"📤 Отправлено напоминание пользователю {user_id}")
+        return (time.perf_counter() - started) * 1000
+
+    rows = []
+    try:
+        sync_handler = file_handler("sync.log")
+        install(sync_handler)
+        rows.append(("синхронно, f-строки", fan_out(False)))
+        sync_handler.close()
+
+        for name, sampled in (("очередь", False), ("очередь + прореживание", True)):
+            log_queue = bot.queue.SimpleQueue()
+            queue_handler = bot.LazyQueueHandler(log_queue)
+            if sampled:
+                queue_handler.addFilter(bot.SamplingFilter())
+            handler = file_handler(f"{'sampled' if sampled else 'queue'}.log")
+            listener = logging.handlers.QueueListener(log_queue, handler)
+            listener.start()
+            install(queue_handler)
+            caller_ms = fan_out(True)
+            started = time.perf_counter()
+            listener.stop()
+            rows.append((name, caller_ms, (time.perf_counter() - started) * 1000))
+            handler.close()
+        sizes = {name: os.path.getsize(os.path.join(workdir, name)) for name in os.listdir(workdir)}
+    finally:
+        install(*previous_handlers)
+        root.setLevel(previous_level)
+        for flag, value in previous_flags.items():
+            setattr(logging, flag, value)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"Записей: {count}")
+    print(f"{'режим':<24} {'в цикле, мс':>12} {'мкс/запись':>11} {'дописать очередь, мс':>21}")
+    for name, caller_ms, *drain in rows:
+        drain_text = f"{drain[0]:.1f}" if drain else "—"
+        print(f"{name:<24} {caller_ms:>12.1f} {caller_ms / count * 1000:>11.2f} {drain_text:>21}")
+    print("Размер логов: " + ", ".join(f"{name} {size // 1024} КБ" for name, size in sorted(sizes.items())))
+
+def plot_scaling(title, points, series, path):
+    """График через matplotlib, если он установлен; иначе — текстовый"""
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print(f"\n{title} (matplotlib не установлен, текстовый график)")
+        top = max(max(values) for values in series.values()) or 1
+        for name, values in series.items():
+            print(f"  {name}")
+            for point, value in zip(points, values):
+                print(f"    {point:>8} {'█' * max(1, round(value / top * 50))} {value:.1f} мс")
+        return
+
+    fig, ax = plt.subplots(figsize=(7, 4))
+    for name, values in series.items():
+        ax.plot(points, values, marker="o", label=name)
+    ax.set_title(title)
+    ax.set_xlabel("потоков / пользователей")
+    ax.set_ylabel("мс")
+    ax.set_xticks(points)
+    ax.set_xticklabels([f"{point}" for point in points])
+    ax.legend()
+    fig.tight_layout()
+    fig.savefig(path)
+    print(f"\nГрафик: {path}")
+
+def bench_scale(args):
+    """Разбор, отрисовка недели и рассылка напоминаний на синтетических данных растущего размера"""
+    class SilentBot:
+        sent = 0
+
+        async def send_message(self, chat_id, text):
+            SilentBot.sent += 1
+
+    # Каждое напоминание пишет строку в лог — на десятках тысяч пользователей это шум
+    logging.disable(logging.INFO)
+    fractions = [0.1, 0.25, 0.5, 1.0]
+    rows = []
+    previous_dir = os.getcwd()
+    for fraction in fractions:
+        faculties = max(1, round(args.faculties * fraction))
+        users = max(1, round(args.users * fraction))
+        workdir = tempfile.mkdtemp(prefix="scale_")
+        try:
+            bot.apply_sources(gen_scale_data.write_dataset(workdir, faculties, args.streams, users))
+            bot.CALENDAR_MEMORY_BUDGET = float("inf")
+            calendars = {
+                (course, stream): bot.download_ics(url)
+                for course, streams in bot.STREAM_URLS.items()
+                for stream, url in streams.items()
+            }
+
+            os.chdir(workdir)
+            bot.user_settings = bot.load_user_settings()
+            bot.application = type("Application", (), {"bot": SilentBot()})()
+
+            def parse_all():
+                reset_caches()
+                for (course, stream), data in calendars.items():
+                    bot.store_parsed_events(course, stream, bot.parse_ics(data))
+
+            def render_week():
+                bot.rendered_view_cache.clear()
+                start_date, _ = bot.get_week_range(datetime.date.today())
+                for course, stream in calendars:
+                    for offset in range(7):
+                        bot.render_day(course, stream, start_date + datetime.timedelta(days=offset))
+
+            def fan_out():
+                SilentBot.sent = 0
+                asyncio.run(bot.send_homework_reminders())
+
+            parse_ms = best_of(parse_all, args.repeat)
+            render_ms = best_of(render_week, args.repeat)
+            reminders_ms = best_of(fan_out, args.repeat)
+            events = sum(len(events) for events in bot.events_cache.values())
+            rows.append((len(calendars), users, events, parse_ms, render_ms, reminders_ms, SilentBot.sent))
+        finally:
+            os.chdir(previous_dir)
+            shutil.rmtree(workdir, ignore_errors=True)
+    bot.apply_sources(bot.load_sources())
+
+    print(f"{'потоков':>8} {'польз.':>7} {'событий':>8} {'разбор, мс':>11} {'неделя, мс':>11} "
+          f"{'напоминания, мс':>16} {'отправлено':>11}")
+    for streams, users, events, parse_ms, render_ms, reminders_ms, sent in rows:
+        print(f"{streams:>8} {users:>7} {events:>8} {parse_ms:>11.1f} {render_ms:>11.1f} "
+              f"{reminders_ms:>16.1f} {sent:>11}")
+
+    plot_scaling(
+        "Масштабирование",
+        [f"{row[0]}/{row[1]}" for row in rows],
+        {
+            "разбор ICS": [row[3] for row in rows],
+            "отрисовка недели": [row[4] for row in rows],
+            "рассылка напоминаний": [row[5] for row in rows],
+        },
+        args.plot
+    )
+
+def bench_parse(args):
+    """Разбор всех потоков при старте: последовательно против пула из 1 и N процессов"""
+    workdir = tempfile.mkdtemp(prefix="parse_")
+    previous_dir = os.getcwd()
+    previous_workers = bot.PARSE_WORKERS
+    try:
+        bot.apply_sources(gen_scale_data.write_dataset(workdir, args.faculties, args.streams, 0))
+        items = [
+            (course, stream, bot.download_ics(url))
+            for course, streams in bot.STREAM_URLS.items()
+            for stream, url in streams.items()
+        ]
+        os.chdir(workdir)
+
+        def clear_snapshots():
+            shutil.rmtree(bot.SNAPSHOT_DIR, ignore_errors=True)
+
+        def sequential():
+            clear_snapshots()
+            for course, stream, data in items:
+                bot.parse_calendar(course, stream, data)
+
+        parsed = {}
+
+        def in_pool():
+            clear_snapshots()
+            parsed.update(asyncio.run(bot.parse_calendars(items)))
+            assert len(parsed) == len(items)
+
+        timings = [("последовательно", sequential_ms := best_of(sequential, args.repeat))]
+        for workers in sorted({1, args.workers}):
+            bot.PARSE_WORKERS = workers
+            bot.shutdown_parse_pool()
+            # Запуск процессов пула в замер не входит
+            asyncio.run(bot.parse_calendars(items[:workers]))
+            timings.append((f"пул, процессов: {workers}", best_of(in_pool, args.repeat)))
+        bot.shutdown_parse_pool()
+        events = sum(len(events) for events, _ in parsed.values())
+    finally:
+        bot.PARSE_WORKERS = previous_workers
+        os.chdir(previous_dir)
+        shutil.rmtree(workdir, ignore_errors=True)
+    bot.apply_sources(bot.load_sources())
+
+    print(f"Потоков: {len(items)}, событий: {events}, ядер: {os.cpu_count()}")
+    for name, ms in timings:
+        print(f"{name:<22} {ms:9.1f} мс  ({sequential_ms / ms:4.2f}x)")
+
+def bench_memory(args):
+    """Память: списки словарей по потокам против колоночного хранилища со ссылками на строки"""
+    calendars = load_bundled_calendars()
+    print(f"{'потоков':>8} {'событий':>8} {'строк':>7} {'словари, КБ':>12} {'хранилище, КБ':>14} {'экономия':>9}")
+    for copies in (1, 10):
+        streams = replicate_streams(calendars, copies)
+        store = bot.EventStore()
+        stored = {stream_key: store.set_stream(stream_key, events) for stream_key, events in streams.items()}
+
+        dicts_size = deep_sizeof(streams)
+        store_size = deep_sizeof(stored)
+        total_events = sum(len(events) for events in streams.values())
+        print(f"{len(streams):>8} {total_events:>8} {store.live_rows():>7} "
+              f"{dicts_size / 1024:>12.1f} {store_size / 1024:>14.1f} {dicts_size / store_size:>8.1f}x")
+
+BENCHMARKS = {
+    "startup": bench_startup,
+    "memory": bench_memory,
+    "datetime": bench_datetime,
+    "menu": bench_menu,
+    "scale": bench_scale,
+    "logging": bench_logging,
+    "parse": bench_parse,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры производительности бота")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=5, help="число прогонов, берется лучший")
+    parser.add_argument("--faculties", type=int, default=40, help="scale, parse: факультетов в самой большой точке")
+    parser.add_argument("--streams", type=int, default=10, help="scale, parse: потоков на факультет")
+    parser.add_argument("--users", type=int, default=50000, help="scale: пользователей в самой большой точке")
+    parser.add_argument("--plot", default="scale.png", help="scale: куда сохранить график")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="parse: процессов в пуле")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+if __name__ == '__main__':
+    main()
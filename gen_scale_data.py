@@ -0,0 +1,170 @@
+"""Генератор синтетических данных для нагрузочных замеров: ICS, ДЗ и настройки пользователей.
+
+Запуск: python gen_scale_data.py --faculties 40 --streams 10 --users 50000 --out scale_data
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+
+import main as bot
+
+SUBJECTS = [
+    "Философия", "История России", "Основы социологии", "Высшая математика",
+    "Культурология", "Экономическая география", "Безопасность жизнедеятельности",
+    "Современные информационные технологии", "История социальных учений",
+    "Маркетинг и социологические исследования", "Политология", "Правоведение",
+    "Психология", "Статистика", "Иностранный язык в профессиональной сфере",
+    "Элективные дисциплины (модули) по физической культуре и спорту",
+]
+LESSON_KINDS = ["лекции", "практические", "лекции, практические", "семинар"]
+SURNAMES = [
+    "Залунин", "Котов", "Чурсина", "Любков", "Тюрина", "Подъячев", "Николаева",
+    "Капралова", "Коротаев", "Гнилозуб", "Шамраева", "Воробьев", "Ершова", "Мельников",
+]
+FIRST_NAMES = ["Владимир", "Юрий", "Анна", "Ирина", "Кирилл", "Ульяна", "Дарья", "Сергей", "Виктория"]
+PATRONYMICS = ["Иванович", "Владимирович", "Вадимовна", "Дмитриевич", "Олеговна", "Викторович", "Алексеевна"]
+ROOMS = ["108", "215", "218", "220", "301", "412", "215/220", "Спортивный комплекс", "ZOOM",
+         "ИНИОН", "Таганка", "Экзамен/108", "Зачёт/Спортивный комплекс"]
+SLOTS = [(9, 0, 10, 30), (10, 30, 13, 40), (10, 0, 13, 10), (14, 0, 15, 30), (14, 0, 17, 10), (15, 40, 17, 10)]
+HOMEWORK_TEXTS = [
+    "Прочитать главу {n} учебника и подготовить конспект",
+    "Решить задачи {n}–{m} из сборника",
+    "Подготовить доклад по теме семинара (5–7 минут)",
+    "Эссе на 2 страницы, сдать в ЭИОС до начала пары",
+    "Повторить лекции {n} и {m}, будет тест",
+]
+
+def semester_start(today=None):
+    """Понедельник за четыре недели до текущей: «завтра» всегда попадает в семестр"""
+    today = today or datetime.date.today()
+    return today - datetime.timedelta(days=today.weekday() + 28)
+
+def course_stream_keys(faculty, stream):
+    """Ключи без '_', чтобы не ломать разбор callback_data; id курса совпадает с факультетом,
+    потому что apply_sources требует уникальных id курсов среди всех факультетов"""
+    return f"f{faculty + 1:02d}", f"s{stream + 1:02d}"
+
+def teacher_name(rng):
+    return f"{rng.choice(SURNAMES)} {rng.choice(FIRST_NAMES)} {rng.choice(PATRONYMICS)}"
+
+def generate_calendar(rng, title, start_date, weeks):
+    """ICS одного потока в формате исходных файлов: свернутые строки, кириллица, LOCATION"""
+    subjects = [
+        (f"{subject}: {rng.choice(LESSON_KINDS)}", teacher_name(rng), rng.choice(ROOMS))
+        for subject in rng.sample(SUBJECTS, 8)
+    ]
+    # Сетка недели: (день недели, слот, предмет) — повторяется с небольшими пропусками
+    grid = [(weekday, slot, rng.choice(subjects))
+            for weekday in range(6) for slot in rng.sample(SLOTS, rng.randint(1, 3))]
+
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//Synthetic//Schedule to ICS//RU",
+        "CALSCALE:GREGORIAN",
+        "METHOD:PUBLISH",
+        f"X-WR-CALNAME:{title}",
+        "X-WR-TIMEZONE:Europe/Moscow",
+    ]
+    for week in range(weeks):
+        for weekday, (start_h, start_m, end_h, end_m), (summary, teacher, room) in grid:
+            if rng.random() < 0.08:
+                continue
+            date = start_date + datetime.timedelta(days=week * 7 + weekday)
+            day = date.strftime('%Y%m%d')
+            lines += [
+                "BEGIN:VEVENT",
+                f"UID:{summary.split(':')[0].lower().replace(' ', '-')}-{day}-{start_h:02d}{start_m:02d}@synthetic",
+                "DTSTAMP:20260101T000000Z",
+                f"SUMMARY:{bot.ics_escape(summary)}",
+                f"DTSTART;TZID=Europe/Moscow:{day}T{start_h:02d}{start_m:02d}00",
+                f"DTEND;TZID=Europe/Moscow:{day}T{end_h:02d}{end_m:02d}00",
+                f"LOCATION:{room}",
+                f"DESCRIPTION:Преподаватель: {teacher}.",
+                "END:VEVENT",
+            ]
+    lines.append("END:VCALENDAR")
+    return "\n".join(bot.ics_fold(line).replace("\r\n", "\n") for line in lines) + "\n"
+
+def generate_homeworks(rng, events, share=0.3):
+    """ДЗ на часть пар: ключи в формате бота 'предмет|YYYY-MM-DD'"""
+    homeworks = {}
+    for event in events:
+        if rng.random() < share:
+            date = bot.ts_to_date(event['start_ts']).isoformat()
+            n = rng.randint(1, 12)
+            homeworks[f"{event['original_summary']}|{date}"] = rng.choice(HOMEWORK_TEXTS).format(n=n, m=n + 3)
+    return homeworks
+
+def generate_users(rng, streams, count):
+    """Настройки пользователей; популярность потоков неравномерная, как в жизни"""
+    weights = [1 / (rank + 1) for rank in range(len(streams))]
+    users = {}
+    for user_id in rng.sample(range(100_000_000, 999_999_999), count):
+        course, stream = rng.choices(streams, weights)[0]
+        users[str(user_id)] = {
+            "course": course,
+            "stream": stream,
+            "english_time": rng.choice(["morning", "afternoon", None]),
+            "reminders": rng.random() < 0.4,
+            "change_notifications": rng.random() < 0.2,
+        }
+    return users
+
+def write_dataset(out_dir, faculties, streams, users, weeks=18, seed=1, start_date=None):
+    """Пишет набор данных в out_dir; возвращает конфиг источников в формате sources.json"""
+    rng = random.Random(seed)
+    start_date = start_date or semester_start()
+    os.makedirs(os.path.join(out_dir, "ics"), exist_ok=True)
+
+    config = {"faculties": []}
+    sources = {}
+    for faculty in range(faculties):
+        faculty_streams = []
+        for stream in range(streams):
+            course, stream_key = course_stream_keys(faculty, stream)
+            path = os.path.join(out_dir, "ics", f"{course}_{stream_key}.ics")
+            data = generate_calendar(rng, f"Факультет {faculty + 1}, поток {stream + 1}", start_date, weeks)
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(data)
+
+            homeworks = generate_homeworks(rng, bot.parse_ics(data))
+            with open(os.path.join(out_dir, f"homeworks_{course}_{stream_key}.json"), "w", encoding="utf-8") as f:
+                json.dump(homeworks, f, ensure_ascii=False, indent=2)
+            sources.setdefault(course, {})[stream_key] = os.path.abspath(path)
+            faculty_streams.append({
+                "id": stream_key,
+                "name": f"Поток {stream + 1}",
+                "url": "file://" + os.path.abspath(path)
+            })
+        config["faculties"].append({
+            "id": course,
+            "name": f"Факультет {faculty + 1}",
+            "courses": [{"id": course, "name": "1 курс", "streams": faculty_streams}]
+        })
+
+    stream_keys = [(course, stream) for course, course_streams in sources.items() for stream in course_streams]
+    with open(os.path.join(out_dir, bot.USER_SETTINGS_FILE), "w", encoding="utf-8") as f:
+        json.dump(generate_users(rng, stream_keys, users), f, ensure_ascii=False, indent=2)
+    with open(os.path.join(out_dir, "sources.json"), "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    return config
+
+def main():
+    parser = argparse.ArgumentParser(description="Синтетические данные для нагрузочных замеров")
+    parser.add_argument("--faculties", type=int, default=40)
+    parser.add_argument("--streams", type=int, default=10, help="потоков на факультет")
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--weeks", type=int, default=18, help="длина семестра")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", default="scale_data")
+    args = parser.parse_args()
+
+    config = write_dataset(args.out, args.faculties, args.streams, args.users, args.weeks, args.seed)
+    total = sum(len(course["streams"]) for faculty in config["faculties"] for course in faculty["courses"])
+    print(f"Потоков: {total}, пользователей: {args.users}, каталог: {args.out}")
+
+if __name__ == '__main__':
+    main()
@@ -2,17 +2,49 @@ import datetime
 import pytz
 import re
 import os
+import sys
 import requests
 import json
 import logging
+import logging.handlers
+import queue
+import multiprocessing
+import atexit
 import time
 import threading
 import asyncio
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import hashlib
+import pickle
+import struct
+import hmac
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import bisect
+import glob
+import functools
+import base64
+import difflib
+import csv
+import io
+from array import array
+from telegram import (
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InlineQueryResultsButton,
+    InputTextMessageContent
+)
 from telegram.ext import (
     ApplicationBuilder,
+    BasePersistence,
+    PersistenceInput,
     CommandHandler,
     CallbackQueryHandler,
+    InlineQueryHandler,
+    TypeHandler,
     ContextTypes,
     MessageHandler,
     filters
@@ -20,10 +52,123 @@ from telegram.ext import (
 from telegram.error import BadRequest, TimedOut
 
 # === НАСТРОЙКА ЛОГИРОВАНИЯ ===
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Записи уходят в очередь, форматирует и пишет их отдельный поток: цикл событий не ждет диска.
+# Поля из extra={...} (event, user_id, stream, ...) попадают в вывод; частые записи одного
+# типа (event, а без него — шаблон сообщения) прореживаются, предупреждения и ошибки — никогда.
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_JSON = False
+LOG_FILE = None  # например "bot.log": файл с ротацией по размеру
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+LOG_SAMPLE_WINDOW = 60
+LOG_SAMPLE_LIMIT = 20
+LOG_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+def log_fields(record):
+    return {key: value for key, value in vars(record).items() if key not in LOG_RECORD_FIELDS}
+
+class StructuredFormatter(logging.Formatter):
+    """Обычная строка лога, к которой дописаны поля записи: ... | event=reminder_sent user_id=1"""
+
+    def format(self, record):
+        text = super().format(record)
+        fields = log_fields(record)
+        if fields:
+            text += " | " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return text
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(log_fields(record))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class SamplingFilter(logging.Filter):
+    """Не больше LOG_SAMPLE_LIMIT записей одного типа за LOG_SAMPLE_WINDOW секунд;
+    первая запись нового окна несет число пропущенных в поле sampled_out"""
+
+    def __init__(self, limit=LOG_SAMPLE_LIMIT, window=LOG_SAMPLE_WINDOW):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.counters = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        key = getattr(record, "event", record.msg)
+        now = time.monotonic()
+        counter = self.counters.get(key)
+        if counter is None or now - counter[0] >= self.window:
+            if counter is not None and counter[2]:
+                record.sampled_out = counter[2]
+            self.counters[key] = [now, 1, 0]
+            return True
+        if counter[1] < self.limit:
+            counter[1] += 1
+            return True
+        counter[2] += 1
+        return False
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """Кладет запись в очередь как есть: сообщение форматирует поток-слушатель"""
+
+    def prepare(self, record):
+        return record
+
+log_listener = None
+
+def setup_logging(json_output=None, log_file=None):
+    """Очередь и поток-слушатель; вывод в stderr и, если задан файл, в файл с ротацией.
+
+    Меняет настройки logging всего процесса, поэтому вызывается только из main(), не при импорте.
+    """
+    global log_listener
+    stop_logging()
+    # Формат не использует файл, строку, процесс и поток — не тратим время на их сбор в каждой записи
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+    json_output = LOG_JSON if json_output is None else json_output
+    log_file = LOG_FILE if log_file is None else log_file
+
+    formatter = JsonFormatter() if json_output else StructuredFormatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(logging.INFO)
+
+    log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    log_listener.start()
+
+def stop_logging():
+    """Дописывает очередь и останавливает поток-слушатель"""
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
 
 # === ФУНКЦИЯ ДЛЯ ЧТЕНИЯ ТОКЕНА ИЗ ФАЙЛА ===
 def load_bot_token():
@@ -39,56 +184,278 @@ def load_bot_token():
         return None
 
 # === НАСТРОЙКИ ===
-BOT_TOKEN = load_bot_token()
-if not BOT_TOKEN:
-    exit(1)
+BOT_TOKEN = None
 
 ADMIN_USERNAME = "fusuges"
 GITHUB_RAW_URL = "https://raw.githubusercontent.com/EgorLesNet/schedule-bot/main/main.py"
 
-# URLs для разных курсов
-STREAM_URLS = {
-    "1": {
-        "sdi": "https://raw.githubusercontent.com/EgorLesNet/schedule-bot/main/GAUGN_1_kurs_СДИ_nodups.ics",
-        "theory": "https://raw.githubusercontent.com/EgorLesNet/schedule-bot/main/GAUGN_1_kurs_Теория_и_практика_nodups.ics",
-        "region1": "https://raw.githubusercontent.com/EgorLesNet/schedule-bot/main/GAUGN_1_kurs_Регионы_1_nodups.ics",
-        "region2": "https://raw.githubusercontent.com/EgorLesNet/schedule-bot/main/GAUGN_1_kurs_Регионы_2_nodups.ics"
-    },
-    "2": {
-        "1": "https://raw.githubusercontent.com/EgorLesNet/schedule-bot/main/GAUGN_2kurs.ics"
-    },
-    "3": {
-        "1": "https://raw.githubusercontent.com/EgorLesNet/schedule-bot/main/GAUGN_3kurs.ics"
-    },
-    "4": {
-        "1": "https://raw.githubusercontent.com/EgorLesNet/schedule-bot/main/GAUGN_4kurs.ics"
-    }
-}
-
-# Словарь для отображения названий потоков
-STREAM_NAMES = {
-    "sdi": "СДИ",
-    "theory": "Теория и практика",
-    "region1": "Регионы 1",
-    "region2": "Регионы 2"
-}
+# Факультеты, курсы и потоки описаны в sources.json рядом с кодом
+SOURCES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sources.json")
+FACULTIES = {}
+COURSES = {}
+STREAM_URLS = {}
+CALENDAR_MEMORY_BUDGET = 64 * 1024 * 1024
 
 TIMEZONE = pytz.timezone("Europe/Moscow")
 USER_SETTINGS_FILE = "user_settings.json"
+ACTIVITY_FILE = "activity.json"
 LAST_UPDATE_FILE = "last_update.txt"
 ASSISTANTS_FILE = "assistants.json"
 SUBJECT_RENAMES_FILE = "subject_renames.json"
 SCHEDULE_EDITS_FILE = "schedule_edits.json"
 PROXY_URL = "socks5://127.0.0.1:987"
+SNAPSHOT_DIR = "snapshots"
+SNAPSHOT_MAGIC = b"GSNP"
+SNAPSHOT_VERSION = 6
+SNAPSHOT_HEADER_SIZE = len(SNAPSHOT_MAGIC) + 2 + 32
+SOURCE_TIMEOUT = (5, 15)
+SOURCE_RETRIES = 2
+SOURCE_RETRY_DELAY = 0.5
+SOURCE_FAILURE_THRESHOLD = 3
+SOURCE_BASE_COOLDOWN = 30
+SOURCE_MAX_COOLDOWN = 30 * 60
+SOURCE_NOT_FOUND_TTL = 10 * 60
+DATA_WATCH_INTERVAL = 2
+MAX_MESSAGE_LENGTH = 4000
+ACTIVITY_KEEP_DAYS = 90
+ACTIVITY_FLUSH_INTERVAL = 300
+SENT_MESSAGE_CACHE_SIZE = 4096
+# Оценка памяти на одно событие вместе с индексами и отрисованными днями
+EVENT_MEMORY_ESTIMATE = 1024
+SNAPSHOT_MAX_AGE = 24 * 3600
+# Бессрочные правила повторения разворачиваются не дальше чем на год от DTSTART
+RECURRENCE_HORIZON_DAYS = 366
+PREFETCH_ON_SELECT = True
+# Процессов для разбора ICS при старте и плановом обновлении; None — по числу ядер
+PARSE_WORKERS = None
+PRELOAD_ON_STARTUP = True
+FEED_DIR = "feeds"
+FEED_HOST = "0.0.0.0"
+FEED_PORT = 8080
+FEED_BASE_URL = "http://localhost:8080"
+FEED_MAX_AGE = 300
+FEED_RETRY_AFTER = 120
+USAGE_DIR = "usage"
+USAGE_LOG_MAX_BYTES = 8 * 1024 * 1024
+USAGE_LOG_KEEP = 8
+USAGE_READ_CHUNK = 4096
+USAGE_FLUSH_INTERVAL = 10
+USAGE_ROLLUP_INTERVAL = 3600
+USAGE_HOURLY_KEEP_DAYS = 14
+USAGE_DAILY_KEEP_DAYS = 400
+STATE_DIR = "conversation_state"
+STATE_FLUSH_INTERVAL = 10
+STATE_TTL = 24 * 3600
+STATE_SWEEP_INTERVAL = 600
+STATE_MAX_IDLE_USERS = 2000
 
 # Глобальные переменные
 user_settings = {}
 events_cache = {}
+base_day_index_cache = {}
+day_index_cache = {}
+rendered_view_cache = {}
+timeline_cache = {}
+schedule_version = 0
+directory_index = None
+directory_index_version = -1
+directory_answer_cache = OrderedDict()
+interval_index_cache = {}
+interval_index_version = -1
+feed_cache = {}
+feed_files = {}
+period_page_cache = {}
+inline_subject_index_cache = {}
+edited_events_cache = {}
+calendar_residency = OrderedDict()
+evicted_streams = {}
+main_menu_markups = {}
+calendar_loads = {}
+stale_retry_at = {}
+user_counters = {
+    "total_users": 0,
+    "course_stats": {},
+    "reminders_stats": {"enabled": 0, "disabled": 0},
+    "english_time_stats": {"morning": 0, "afternoon": 0, "none": 0}
+}
+user_stat_keys = {}
+activity = {"users": [], "new_users": {}, "days": {}}
+activity_user_index = {}
+activity_dirty = False
+sent_message_digests = OrderedDict()
+feed_server = None
 application = None
 assistants = set()
 subject_renames = {}
 schedule_edits = {}
 
+# === ЧАСЫ ===
+class SystemClock:
+    """Текущее время для всего бота; simulate.py подставляет виртуальные часы"""
+
+    def time(self):
+        return time.time()
+
+    def now(self):
+        return datetime.datetime.fromtimestamp(self.time(), TIMEZONE)
+
+    def today(self):
+        return self.now().date()
+
+clock = SystemClock()
+
+# === БЫСТРАЯ РАБОТА С ДАТАМИ ===
+# Внутри время событий хранится в секундах от эпохи ('start_ts', 'end_ts').
+# Смещение от UTC кэшируется на каждую дату, datetime создается только при отрисовке.
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+@functools.lru_cache(maxsize=4096)
+def utc_offset_for_day(day):
+    """Смещение TIMEZONE от UTC (в секундах) для дня с номером day от эпохи"""
+    noon = datetime.datetime.combine(datetime.date.fromordinal(EPOCH_ORDINAL + day), datetime.time(12))
+    return int(TIMEZONE.utcoffset(noon).total_seconds())
+
+def local_to_ts(year, month, day, hour=0, minute=0, second=0):
+    """Местное время TIMEZONE -> секунды от эпохи"""
+    days = datetime.date(year, month, day).toordinal() - EPOCH_ORDINAL
+    return days * 86400 + hour * 3600 + minute * 60 + second - utc_offset_for_day(days)
+
+def decode_ics_datetime(value):
+    """Разбирает YYYYMMDDTHHMMSS[Z] срезами, без strptime"""
+    if len(value) < 15 or value[8] != 'T':
+        raise ValueError(f"Неверный формат даты: {value}")
+    year, month, day = int(value[0:4]), int(value[4:6]), int(value[6:8])
+    hour, minute, second = int(value[9:11]), int(value[11:13]), int(value[13:15])
+    if value.endswith('Z'):
+        return (datetime.date(year, month, day).toordinal() - EPOCH_ORDINAL) * 86400 + hour * 3600 + minute * 60 + second
+    return local_to_ts(year, month, day, hour, minute, second)
+
+@functools.lru_cache(maxsize=4096)
+def decode_iso_date(value):
+    """Разбирает YYYY-MM-DD срезами; ValueError для неверной строки"""
+    if len(value) != 10 or value[4] != '-' or value[7] != '-':
+        raise ValueError(f"Неверный формат даты: {value}")
+    return datetime.date(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+
+def decode_hhmm(value):
+    """'HH:MM' -> (часы, минуты)"""
+    hour, _, minute = value.partition(':')
+    hour, minute = int(hour), int(minute)
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise ValueError(f"Неверное время: {value}")
+    return hour, minute
+
+def local_day(ts):
+    """Номер местного дня от эпохи"""
+    return (ts + utc_offset_for_day(ts // 86400)) // 86400
+
+@functools.lru_cache(maxsize=4096)
+def day_to_date(day):
+    return datetime.date.fromordinal(EPOCH_ORDINAL + day)
+
+def ts_to_date(ts):
+    return day_to_date(local_day(ts))
+
+def date_to_ts(date):
+    """Начало местного дня в секундах от эпохи"""
+    return local_to_ts(date.year, date.month, date.day)
+
+def ts_to_hhmm(ts):
+    local = ts + utc_offset_for_day(ts // 86400)
+    return f"{local // 3600 % 24:02d}:{local // 60 % 60:02d}"
+
+def ts_to_datetime(ts):
+    return datetime.datetime.fromtimestamp(ts, TIMEZONE)
+
+class Event(dict):
+    """Событие расписания.
+
+    'start' и 'end' (datetime) не хранятся заранее, а создаются из
+    'start_ts'/'end_ts' при первом обращении — то есть при отрисовке.
+    """
+    __slots__ = ()
+
+    def __missing__(self, key):
+        if key == 'start' or key == 'end':
+            value = ts_to_datetime(self[key + '_ts'])
+            self[key] = value
+            return value
+        raise KeyError(key)
+
+    def copy(self):
+        return Event(self)
+
+# === ИСТОЧНИКИ РАСПИСАНИЙ ===
+def load_sources(path=None):
+    with open(path or SOURCES_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def apply_sources(config):
+    """Заполняет FACULTIES, COURSES и STREAM_URLS из конфига источников.
+
+    id курса уникален во всем файле, а не только внутри факультета: пара курс_поток — ключ
+    настроек пользователей, файлов ДЗ и снимков и часть callback_data. По той же причине
+    в id курса и потока нет '_'. Нарушение — ValueError.
+    """
+    global CALENDAR_MEMORY_BUDGET
+    faculties, courses, urls = {}, {}, {}
+    for faculty in config.get("faculties", []):
+        faculty_id = str(faculty["id"])
+        course_ids = []
+        for course in faculty.get("courses", []):
+            course_id = str(course["id"])
+            if not course_id or '_' in course_id:
+                raise ValueError(f"Некорректный id курса: {course_id!r}")
+            if course_id in courses:
+                raise ValueError(
+                    f"id курса {course_id!r} уже есть у факультета {courses[course_id]['faculty']!r}: "
+                    f"id курсов должны быть уникальны среди всех факультетов"
+                )
+            streams = {}
+            for stream in course.get("streams", []):
+                stream_id = str(stream["id"])
+                if not stream_id or '_' in stream_id or stream_id in streams:
+                    raise ValueError(f"Некорректный или повторяющийся id потока {course_id}: {stream_id!r}")
+                streams[stream_id] = stream.get("name", stream_id)
+                urls.setdefault(course_id, {})[stream_id] = stream["url"]
+            courses[course_id] = {
+                "faculty": faculty_id,
+                "name": course.get("name", f"{course_id} курс"),
+                "streams": streams
+            }
+            course_ids.append(course_id)
+        faculties[faculty_id] = {"name": faculty.get("name", faculty_id), "courses": course_ids}
+
+    FACULTIES.clear()
+    FACULTIES.update(faculties)
+    COURSES.clear()
+    COURSES.update(courses)
+    STREAM_URLS.clear()
+    STREAM_URLS.update(urls)
+    CALENDAR_MEMORY_BUDGET = int(config.get("memory_budget_mb", 64) * 1024 * 1024)
+
+def reload_sources():
+    apply_sources(load_sources())
+    for cache_key in list(events_cache):
+        course, stream = cache_key.split('_', 1)
+        if stream not in STREAM_URLS.get(course, {}):
+            unload_stream(cache_key)
+    main_menu_markups.clear()
+
+def course_title(course, stream):
+    """'1 курс, СДИ' для курсов с выбором потока, иначе '2 курс'"""
+    info = COURSES.get(course)
+    if info is None:
+        return f"{course} курс"
+    title = info["name"]
+    if len(info["streams"]) > 1:
+        title += f", {info['streams'].get(stream, stream)}"
+    if len(FACULTIES) > 1:
+        title = f"{FACULTIES[info['faculty']]['name']}: {title}"
+    return title
+
+apply_sources(load_sources())
+
 # === ФУНКЦИИ ДЛЯ РАБОТЫ С ДАННЫМИ ===
 def load_assistants():
     """Загружает список помощников"""
@@ -103,6 +470,7 @@ def save_assistants():
     """Сохраняет список помощников"""
     with open(ASSISTANTS_FILE, "w", encoding="utf-8") as f:
         json.dump({"assistants": list(assistants)}, f, ensure_ascii=False, indent=2)
+    remember_data_file(ASSISTANTS_FILE)
 
 def load_subject_renames():
     """Загружает переименования предметов"""
@@ -116,6 +484,7 @@ def save_subject_renames():
     """Сохраняет переименования предметов"""
     with open(SUBJECT_RENAMES_FILE, "w", encoding="utf-8") as f:
         json.dump(subject_renames, f, ensure_ascii=False, indent=2)
+    remember_data_file(SUBJECT_RENAMES_FILE)
 
 def load_schedule_edits():
     """Загружает правки расписания"""
@@ -125,11 +494,6 @@ def load_schedule_edits():
     except FileNotFoundError:
         return {}
 
-def save_schedule_edits():
-    """Сохраняет правки расписания"""
-    with open(SCHEDULE_EDITS_FILE, "w", encoding="utf-8") as f:
-        json.dump(schedule_edits, f, ensure_ascii=False, indent=2)
-
 def get_original_subject_name(course, stream, display_name):
     """Возвращает оригинальное название предмета по отображаемому"""
     key = f"{course}_{stream}"
@@ -157,11 +521,13 @@ def save_homeworks(course, stream, homeworks_data):
     filename = f"homeworks_{course}_{stream}.json"
     with open(filename, "w", encoding="utf-8") as f:
         json.dump(homeworks_data, f, ensure_ascii=False, indent=2)
+    remember_data_file(filename)
+    invalidate_rendered_views(f"{course}_{stream}")
 
 def get_future_homeworks(course, stream):
     """Получает только будущие домашние задания"""
     homeworks = load_homeworks(course, stream)
-    today = datetime.datetime.now(TIMEZONE).date()
+    today = clock.today()
 
     future_homeworks = {}
     for hw_key, hw_text in homeworks.items():
@@ -170,7 +536,7 @@ def get_future_homeworks(course, stream):
             if len(parts) != 2:
                 continue
             date_str = parts[1]
-            hw_date = datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
+            hw_date = decode_iso_date(date_str)
             if hw_date >= today:
                 future_homeworks[hw_key] = hw_text
         except (ValueError, IndexError):
@@ -180,7 +546,7 @@ def get_future_homeworks(course, stream):
 def get_past_homeworks(course, stream):
     """Получает только прошедшие домашние задания"""
     homeworks = load_homeworks(course, stream)
-    today = datetime.datetime.now(TIMEZONE).date()
+    today = clock.today()
 
     past_homeworks = {}
     for hw_key, hw_text in homeworks.items():
@@ -189,7 +555,7 @@ def get_past_homeworks(course, stream):
             if len(parts) != 2:
                 continue
             date_str = parts[1]
-            hw_date = datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
+            hw_date = decode_iso_date(date_str)
             if hw_date < today:
                 past_homeworks[hw_key] = hw_text
         except (ValueError, IndexError):
@@ -198,7 +564,7 @@ def get_past_homeworks(course, stream):
 
 def get_homeworks_for_tomorrow(course, stream):
     """Получает домашние задания на завтра"""
-    tomorrow = datetime.datetime.now(TIMEZONE).date() + datetime.timedelta(days=1)
+    tomorrow = clock.today() + datetime.timedelta(days=1)
     tomorrow_homeworks = []
     homeworks = load_homeworks(course, stream)
 
@@ -209,7 +575,7 @@ def get_homeworks_for_tomorrow(course, stream):
                 continue
             subject = parts[0]
             date_str = parts[1]
-            hw_date = datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
+            hw_date = decode_iso_date(date_str)
             if hw_date == tomorrow:
                 tomorrow_homeworks.append((subject, hw_text))
         except (ValueError, IndexError):
@@ -236,125 +602,2907 @@ def load_last_update():
 
 def save_last_update():
     with open(LAST_UPDATE_FILE, "w", encoding="utf-8") as f:
-        f.write(datetime.datetime.now().isoformat())
+        f.write(clock.now().isoformat())
+
+# === СПИСОК ДЗ ПО СТРАНИЦАМ ===
+# Будущие ДЗ потока сортируются по (дата, предмет) один раз после изменения файла ДЗ.
+# Страница начинается с курсора — даты и короткого хэша ключа ДЗ: он помещается в callback_data
+# и не сдвигается, когда ДЗ добавляют или удаляют выше по списку.
+HW_PAGE_SIZE = 8
+HW_PREVIEW_LENGTH = 350
+homework_index_cache = {}
+homework_page_cache = {}
+
+def homework_cursor(date_str, hw_key):
+    return date_str.replace('-', '') + hashlib.sha1(hw_key.encode('utf-8')).hexdigest()[:6]
+
+def get_homework_index(course, stream):
+    """Будущие ДЗ потока по порядку: (дата, предмет, ключ, текст) и их курсоры"""
+    cache_key = f"{course}_{stream}"
+    today = clock.today()
+    index = homework_index_cache.get(cache_key)
+    if index is None or index["today"] != today:
+        items = []
+        for hw_key, hw_text in get_future_homeworks(course, stream).items():
+            subject, date_str = hw_key.split('|')
+            items.append((date_str, subject, hw_key, hw_text))
+        items.sort()
+        index = {
+            "today": today,
+            "items": items,
+            "cursors": [homework_cursor(date_str, hw_key) for date_str, _, hw_key, _ in items],
+        }
+        homework_index_cache[cache_key] = index
+        for view_key in [key for key in homework_page_cache if key[0] == cache_key]:
+            del homework_page_cache[view_key]
+    return index
+
+def locate_homework_cursor(index, cursor):
+    """Позиция ДЗ с курсором; если его уже нет — первое ДЗ той же или более поздней даты"""
+    cursors = index["cursors"]
+    position = bisect.bisect_left(cursors, cursor[:8])
+    while position < len(cursors) and cursors[position][:8] == cursor[:8]:
+        if cursors[position] == cursor:
+            return position
+        position += 1
+    return bisect.bisect_left(cursors, cursor[:8])
+
+def build_homework_page(course, stream, mode, cursor=""):
+    """Текст и клавиатура страницы списка ('list') или удаления ('delete') ДЗ"""
+    index = get_homework_index(course, stream)
+    cursors = index["cursors"]
+    start = locate_homework_cursor(index, cursor) if cursor else 0
+    if start >= len(cursors):
+        start = max(len(cursors) - HW_PAGE_SIZE, 0)
+
+    view_key = (f"{course}_{stream}", mode, start)
+    page = homework_page_cache.get(view_key)
+    if page is not None:
+        return page
+
+    items = index["items"][start:start + HW_PAGE_SIZE]
+    back = [InlineKeyboardButton("⬅️ Назад", callback_data=f"manage_hw_{course}_{stream}")]
+    if not items:
+        text = "📋 Список домашних заданий пуст" if mode == "list" else "📋 Нет домашних заданий для удаления"
+        page = (text, InlineKeyboardMarkup([back]))
+        homework_page_cache[view_key] = page
+        return page
+
+    position = f"{start + 1}–{start + len(items)} из {len(cursors)}"
+    keyboard = []
+    if mode == "list":
+        text = f"📋 Список домашних заданий ({position}):\n\n"
+        for date_str, subject, _, hw_text in items:
+            if len(hw_text) > HW_PREVIEW_LENGTH:
+                hw_text = hw_text[:HW_PREVIEW_LENGTH - 1] + "…"
+            text += f"📖 {subject} ({decode_iso_date(date_str).strftime('%d.%m.%Y')}):\n{hw_text}\n\n"
+    else:
+        text = f"Выбери ДЗ для удаления ({position}):"
+        page_cursor = cursors[start]
+        for offset, (date_str, subject, _, _) in enumerate(items):
+            keyboard.append([InlineKeyboardButton(
+                f"{subject} ({decode_iso_date(date_str).strftime('%d.%m.%Y')})",
+                callback_data=f"hw_del_{course}_{stream}_{cursors[start + offset]}_{page_cursor}"
+            )])
+
+    navigation = []
+    if start > 0:
+        previous = cursors[max(start - HW_PAGE_SIZE, 0)]
+        navigation.append(InlineKeyboardButton("◀", callback_data=f"hw_page_{mode}_{course}_{stream}_{previous}"))
+    if start + HW_PAGE_SIZE < len(cursors):
+        following = cursors[start + HW_PAGE_SIZE]
+        navigation.append(InlineKeyboardButton("▶", callback_data=f"hw_page_{mode}_{course}_{stream}_{following}"))
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append(back)
+
+    page = (text, InlineKeyboardMarkup(keyboard))
+    homework_page_cache[view_key] = page
+    return page
+
+def homework_successor_cursor(course, stream, cursor):
+    """Курсор ДЗ, которое займет место удаляемого: следующего, а для последнего — предыдущего"""
+    index = get_homework_index(course, stream)
+    cursors = index["cursors"]
+    position = locate_homework_cursor(index, cursor)
+    if position + 1 < len(cursors):
+        return cursors[position + 1]
+    return cursors[position - 1] if 0 < position <= len(cursors) else ""
+
+def delete_homework_by_cursor(course, stream, cursor):
+    """Удаляет ДЗ по курсору; False, если его уже нет"""
+    index = get_homework_index(course, stream)
+    position = locate_homework_cursor(index, cursor)
+    if position >= len(index["cursors"]) or index["cursors"][position] != cursor:
+        return False
+    homeworks = load_homeworks(course, stream)
+    if homeworks.pop(index["items"][position][2], None) is None:
+        return False
+    save_homeworks(course, stream, homeworks)
+    return True
+
+# === ГОРЯЧАЯ ПЕРЕЗАГРУЗКА ФАЙЛОВ ДАННЫХ ===
+# Файлы опрашиваются по mtime; при изменении перечитывается только этот файл,
+# его версия увеличивается, а зависящие от него кэши сбрасываются.
+data_file_mtimes = {}
+data_versions = {}
+pending_write_flushers = []
+restart_requested = False
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def remember_data_file(path):
+    """Запоминает mtime после собственной записи, чтобы не перечитывать файл"""
+    data_file_mtimes[path] = get_mtime(path)
+
+def data_version(path):
+    return data_versions.get(path, 0)
+
+def reload_assistants():
+    global assistants
+    assistants = load_assistants()
+
+def reload_subject_renames():
+    global subject_renames
+    subject_renames = load_subject_renames()
+    for cache_key, events in events_cache.items():
+        course, stream = cache_key.split('_', 1)
+        apply_subject_renames(course, stream, events)
+        if isinstance(base_day_index_cache.get(cache_key), RecurringDayIndex):
+            # Уже развернутые повторения хранят старое название
+            base_day_index_cache[cache_key] = build_day_index(events)
+        day_index_cache.pop(cache_key, None)
+        invalidate_rendered_views(cache_key)
+    bump_schedule_version()
+
+def reload_schedule_edits():
+    global schedule_edits
+    new_edits = load_schedule_edits()
+    changed = {
+        cache_key for cache_key in set(schedule_edits) | set(new_edits)
+        if schedule_edits.get(cache_key) != new_edits.get(cache_key)
+    }
+    schedule_edits = new_edits
+    for cache_key in changed:
+        day_index_cache.pop(cache_key, None)
+        invalidate_rendered_views(cache_key)
+    if changed:
+        bump_schedule_version()
+        changed_edits = {cache_key: new_edits[cache_key] for cache_key in changed if cache_key in new_edits}
+        for warning in check_schedule_edits_conflicts(changed_edits):
+            logging.warning("⚠️ Пересечение в правках расписания: %s", warning)
+
+WATCHED_DATA_FILES = {
+    ASSISTANTS_FILE: reload_assistants,
+    SUBJECT_RENAMES_FILE: reload_subject_renames,
+    SCHEDULE_EDITS_FILE: reload_schedule_edits,
+    SOURCES_FILE: reload_sources,
+}
+
+def watched_files():
+    """Пары (путь, функция перезагрузки), включая файлы ДЗ всех потоков"""
+    files = list(WATCHED_DATA_FILES.items())
+    for path in glob.glob("homeworks_*.json"):
+        cache_key = path[len("homeworks_"):-len(".json")]
+        files.append((path, functools.partial(invalidate_rendered_views, cache_key)))
+    return files
+
+def remember_data_files():
+    for path, _ in watched_files():
+        remember_data_file(path)
+
+def check_data_files():
+    """Перечитывает изменившиеся на диске файлы; возвращает их список"""
+    reloaded = []
+    for path, reload in watched_files():
+        mtime = get_mtime(path)
+        if mtime == data_file_mtimes.get(path):
+            continue
+        try:
+            reload()
+        except ValueError as e:
+            # Файл мог быть прочитан посреди записи — попробуем на следующем опросе
+            logging.warning("Не удалось перечитать %s: %s", path, e)
+            continue
+        data_file_mtimes[path] = mtime
+        data_versions[path] = data_version(path) + 1
+        reloaded.append(path)
+        logging.info("♻️ Перечитан файл %s (версия %s)", path, data_versions[path])
+    return reloaded
+
+async def watch_data_files():
+    while True:
+        await asyncio.sleep(DATA_WATCH_INTERVAL)
+        try:
+            check_data_files()
+        except Exception as e:
+            logging.error("❌ Ошибка при проверке файлов данных: %s", e)
+
+def flush_pending_writes():
+    """Сбрасывает на диск все отложенные записи перед остановкой"""
+    for flush in pending_write_flushers:
+        try:
+            flush()
+        except Exception as e:
+            logging.error("❌ Ошибка при сохранении данных перед остановкой: %s", e)
+
+def request_restart():
+    """Плавный перезапуск: бот дорабатывает текущие обновления и останавливается,
+    main() сохраняет данные и запускает процесс заново"""
+    global restart_requested
+    restart_requested = True
+    if application:
+        application.stop_running()
 
 # === ФУНКЦИИ РЕДАКТИРОВАНИЯ РАСПИСАНИЯ ===
+def apply_day_edits(date_str, date_edits, events):
+    """Применяет правки одного дня к событиям этого дня"""
+    edited_events = []
+
+    for event in events:
+        event_key = f"{event['original_summary']}[{ts_to_hhmm(event['start_ts'])}]"
+        edit = date_edits.get(event_key)
+
+        if edit is None:
+            edited_events.append(event)
+        elif edit.get("deleted", False):
+            continue
+        elif "new_summary" in edit:
+            edited_event = event.copy()
+            edited_event["summary"] = edit["new_summary"]
+            if "new_desc" in edit:
+                edited_event["desc"] = edit["new_desc"]
+                edited_event["teacher"], edited_event["room"] = extract_teacher_and_room(edit["new_desc"])
+            edited_events.append(edited_event)
+        else:
+            edited_events.append(event)
+
+    for event_key, edit in date_edits.items():
+        if edit.get("new", False) and "start_time" in edit:
+            try:
+                date = decode_iso_date(date_str)
+                start_ts = local_to_ts(date.year, date.month, date.day, *decode_hhmm(edit['start_time']))
+                end_ts = local_to_ts(date.year, date.month, date.day, *decode_hhmm(edit['end_time']))
+
+                new_desc = edit.get('new_desc', '')
+                teacher, room = extract_teacher_and_room(new_desc)
+                new_event = Event(
+                    uid='',
+                    summary=edit['new_summary'],
+                    original_summary=edit['new_summary'],
+                    start_ts=start_ts,
+                    end_ts=end_ts,
+                    desc=new_desc,
+                    teacher=teacher,
+                    room=room
+                )
+                edited_events.append(new_event)
+            except (ValueError, KeyError) as e:
+                logging.error("Ошибка создания нового события: %s", e)
+
+    return edited_events
+
 def apply_schedule_edits(course, stream, events):
-    """Применяет правки к расписанию"""
+    """Применяет правки к расписанию; результат запоминается до смены событий, правок или версии"""
     key = f"{course}_{stream}"
-    if key not in schedule_edits:
-        return events
+    stream_edits = schedule_edits.get(key)
+    cached = edited_events_cache.get(key)
+    if cached is not None and cached[0] is events and cached[1] is stream_edits and cached[2] == schedule_version:
+        return cached[3]
 
-    stream_edits = schedule_edits[key]
-    edited_events = []
+    edited_events = edit_events(events, stream_edits)
+    edited_events_cache[key] = (events, stream_edits, schedule_version, edited_events)
+    return edited_events
 
-    for event in events:
-        event_date = event["start"].date().isoformat()
-        event_key = f"{event['original_summary']}[{event['start'].strftime('%H:%M')}]"
+def edit_events(events, stream_edits):
+    """Разворачивает повторения и накладывает правки потока по датам"""
+    if not stream_edits:
+        return expand_events(events)
 
-        if event_date in stream_edits and event_key in stream_edits[event_date]:
-            edit = stream_edits[event_date][event_key]
+    # Правки относятся к отдельным повторениям, поэтому шаблоны разворачиваются
+    events = expand_events(events)
+    edited_events = []
+    events_by_date = {}
 
-            if edit.get("deleted", False):
-                continue
-            elif "new_summary" in edit:
-                edited_event = event.copy()
-                edited_event["summary"] = edit["new_summary"]
-                if "new_desc" in edit:
-                    edited_event["desc"] = edit["new_desc"]
-                edited_events.append(edited_event)
-            else:
-                edited_events.append(event)
+    for event in events:
+        event_date = ts_to_date(event["start_ts"]).isoformat()
+        if event_date in stream_edits:
+            events_by_date.setdefault(event_date, []).append(event)
         else:
             edited_events.append(event)
 
     for date_str, date_edits in stream_edits.items():
-        for event_key, edit in date_edits.items():
-            if edit.get("new", False) and "start_time" in edit:
-                try:
-                    start_dt = datetime.datetime.strptime(f"{date_str} {edit['start_time']}", "%Y-%m-%d %H:%M")
-                    end_dt = datetime.datetime.strptime(f"{date_str} {edit['end_time']}", "%Y-%m-%d %H:%M")
-
-                    start_dt = TIMEZONE.localize(start_dt)
-                    end_dt = TIMEZONE.localize(end_dt)
-
-                    new_event = {
-                        'summary': edit['new_summary'],
-                        'original_summary': edit['new_summary'],
-                        'start': start_dt,
-                        'end': end_dt,
-                        'desc': edit.get('new_desc', '')
-                    }
-                    edited_events.append(new_event)
-                except ValueError as e:
-                    logging.error(f"Ошибка создания нового события: {e}")
+        edited_events.extend(apply_day_edits(date_str, date_edits, events_by_date.get(date_str, [])))
 
     return edited_events
 
-def load_events_from_github(course, stream):
-    """Загрузка событий с учетом курса и потока"""
-    cache_key = f"{course}_{stream}"
-    if cache_key in events_cache:
-        return apply_schedule_edits(course, stream, events_cache[cache_key])
+def parse_ics(data):
+    """Разбирает ICS-файл в список событий (без учета переименований и правок)"""
+    events = []
+    event_blocks = data.split('BEGIN:VEVENT')
+
+    for block in event_blocks:
+        if 'END:VEVENT' not in block:
+            continue
+
+        try:
+            summary_match = re.search(r'SUMMARY:(.+?)(?:\n|$)', block)
+            dtstart_match = re.search(r'DTSTART(?:;VALUE=DATE-TIME)?(?:;TZID=Europe/Moscow)?:(\d{8}T\d{6})', block)
+            dtend_match = re.search(r'DTEND(?:;VALUE=DATE-TIME)?(?:;TZID=Europe/Moscow)?:(\d{8}T\d{6})', block)
+            description_match = re.search(r'DESCRIPTION:(.+?)(?:\n|$)', block, re.DOTALL)
+            uid_match = re.search(r'UID:(.*(?:\n[ \t].*)*)', block)
+            location_match = re.search(r'LOCATION:(.+?)(?:\n|$)', block)
+
+            if not all([summary_match, dtstart_match, dtend_match]):
+                continue
+
+            original_summary = sys.intern(summary_match.group(1).strip())
+
+            start_str = dtstart_match.group(1)
+            end_str = dtend_match.group(1)
+            description = sys.intern(description_match.group(1).strip()) if description_match else ""
+            teacher, room = extract_teacher_and_room(description)
+            if not room and location_match:
+                room = location_match.group(1).strip()
+
+            event = Event(
+                uid=re.sub(r'\n[ \t]', '', uid_match.group(1)).strip() if uid_match else "",
+                summary=original_summary,
+                original_summary=original_summary,
+                start_ts=decode_ics_datetime(start_str),
+                end_ts=decode_ics_datetime(end_str),
+                desc=description,
+                teacher=sys.intern(teacher),
+                room=sys.intern(room)
+            )
+            if 'RRULE' in block or 'RDATE' in block or 'EXDATE' in block or 'RECURRENCE-ID' in block:
+                add_recurrence_fields(event, re.sub(r'\r?\n[ \t]', '', block))
+            events.append(event)
+        except Exception as e:
+            logging.warning("Ошибка парсинга события: %s", e)
+            continue
+
+    # Перенесенное повторение (RECURRENCE-ID) заменяет собой повторение шаблона
+    overrides = [event for event in events if 'recurrence_id' in event]
+    if overrides:
+        masters = {event['uid']: event for event in events if is_recurring(event)}
+        for event in overrides:
+            recurrence_id = event.pop('recurrence_id')
+            master = masters.get(event['uid'])
+            if master is not None:
+                master['exdates'] = frozenset(master.get('exdates', ())) | {recurrence_id}
+            event['uid'] = f"{event['uid']}/{recurrence_id}"
+
+    return events
+
+def add_recurrence_fields(event, unfolded_block):
+    """RRULE, RDATE, EXDATE и RECURRENCE-ID события (строки уже развернуты)"""
+    time_of_day = local_time_of_day(event['start_ts'])
+
+    def moments(name):
+        values = []
+        for match in re.finditer(rf'^{name}[;:][^\n]*', unfolded_block, re.MULTILINE):
+            for value in match.group(0).split(':', 1)[1].strip().split(','):
+                try:
+                    values.append(decode_ics_moment(value, time_of_day))
+                except ValueError:
+                    logging.warning("Неподдерживаемое значение %s: %s", name, value)
+        return values
+
+    rrule_match = re.search(r'^RRULE:([^\n]+)', unfolded_block, re.MULTILINE)
+    if rrule_match:
+        rrule = parse_rrule(rrule_match.group(1))
+        if rrule:
+            event['rrule'] = rrule
+    rdates = moments('RDATE')
+    if rdates:
+        event['rdates'] = tuple(sorted(rdates))
+    exdates = moments('EXDATE')
+    if exdates:
+        event['exdates'] = frozenset(exdates)
+    recurrence_ids = moments('RECURRENCE-ID')
+    if recurrence_ids:
+        event['recurrence_id'] = recurrence_ids[0]
+
+# === ПОВТОРЯЮЩИЕСЯ СОБЫТИЯ (RRULE / RDATE / EXDATE) ===
+# Событие с RRULE или RDATE хранится одним «шаблоном» с полями rrule, rdates и exdates.
+# Повторения разворачиваются по требованию: индекс по датам раскрывает только те недели,
+# к которым обратились, а сами окна правила кэшируются в recurrence_starts.
+RRULE_WEEKDAYS = {"MO": 0, "TU": 1, "WE": 2, "TH": 3, "FR": 4, "SA": 5, "SU": 6}
+RRULE_FREQUENCIES = ("DAILY", "WEEKLY", "MONTHLY")
+
+def decode_ics_moment(value, time_of_day=(0, 0, 0)):
+    """DATE-TIME (местное или UTC с Z) или DATE -> секунды от эпохи"""
+    value = value.strip()
+    if len(value) == 8:
+        return local_to_ts(int(value[:4]), int(value[4:6]), int(value[6:8]), *time_of_day)
+    if value.endswith('Z'):
+        return int(datetime.datetime.strptime(value, '%Y%m%dT%H%M%SZ').replace(tzinfo=datetime.timezone.utc).timestamp())
+    return decode_ics_datetime(value)
+
+def local_time_of_day(ts):
+    local = ts + utc_offset_for_day(ts // 86400)
+    return local // 3600 % 24, local // 60 % 60, local % 60
+
+def parse_byday(value):
+    """'MO' -> (0, 0), '2TU' -> (2, 1), '-1FR' -> (-1, 4): (номер в месяце или 0, день недели)"""
+    value = value.strip()
+    ordinal = int(value[:-2]) if value[:-2] else 0
+    if not -5 <= ordinal <= 5:
+        raise ValueError(value)
+    return ordinal, RRULE_WEEKDAYS[value[-2:]]
+
+def parse_rrule(value):
+    """'FREQ=WEEKLY;BYDAY=MO,WE;UNTIL=...' -> (freq, interval, byday, count, until_ts) или None"""
+    parts = dict(part.split('=', 1) for part in value.strip().split(';') if '=' in part)
+    freq = parts.get("FREQ")
+    unsupported = set(parts) - {"FREQ", "INTERVAL", "BYDAY", "COUNT", "UNTIL", "WKST"}
+    byday = ()
+    if "BYDAY" in parts:
+        try:
+            byday = tuple(sorted({parse_byday(day) for day in parts["BYDAY"].split(',')}))
+        except (KeyError, ValueError):
+            unsupported.add("BYDAY")
+        # Номер дня в периоде (2TU, -1FR) по RFC 5545 бывает только у MONTHLY
+        if freq != "MONTHLY" and any(ordinal for ordinal, _ in byday):
+            unsupported.add("BYDAY")
+    if freq not in RRULE_FREQUENCIES or unsupported:
+        logging.warning("Правило повторения не поддерживается, берется только первое событие: %s", value.strip())
+        return None
 
+    count = int(parts["COUNT"]) if "COUNT" in parts else None
+    until = decode_ics_moment(parts["UNTIL"], (23, 59, 59)) if "UNTIL" in parts else None
+    return freq, max(int(parts.get("INTERVAL", 1)), 1), byday, count, until
+
+def monthly_byday_days(year, month, byday):
+    """Местные дни месяца, подходящие под BYDAY: все понедельники, второй вторник, последняя пятница"""
+    first = datetime.date(year, month, 1)
+    next_first = datetime.date(year + month // 12, month % 12 + 1, 1)
+    days_in_month = (next_first - first).days
+    first_day = first.toordinal() - EPOCH_ORDINAL
+    days = set()
+    for ordinal, weekday in byday:
+        matches = range(1 + (weekday - first.weekday()) % 7, days_in_month + 1, 7)
+        if ordinal == 0:
+            days.update(matches)
+        elif abs(ordinal) <= len(matches):
+            days.add(matches[ordinal - 1 if ordinal > 0 else ordinal])
+    return [first_day + day - 1 for day in sorted(days)]
+
+def rrule_candidate_days(freq, interval, byday, start_day, last_day):
+    """Местные дни, подходящие под правило, по возрастанию, начиная с дня DTSTART"""
+    if freq == "DAILY":
+        weekdays = {weekday for _, weekday in byday}
+        for day in range(start_day, last_day + 1, interval):
+            if not weekdays or day_to_date(day).weekday() in weekdays:
+                yield day
+    elif freq == "WEEKLY":
+        weekdays = tuple(weekday for _, weekday in byday) or (day_to_date(start_day).weekday(),)
+        week_start = start_day - day_to_date(start_day).weekday()
+        for monday in range(week_start, last_day + 1, 7 * interval):
+            for weekday in weekdays:
+                day = monday + weekday
+                if start_day <= day <= last_day:
+                    yield day
+    elif byday:
+        start = day_to_date(start_day)
+        step = 0
+        while True:
+            month = start.month - 1 + step * interval
+            year, month = start.year + month // 12, month % 12 + 1
+            if datetime.date(year, month, 1).toordinal() - EPOCH_ORDINAL > last_day:
+                return
+            for day in monthly_byday_days(year, month, byday):
+                if start_day <= day <= last_day:
+                    yield day
+            step += 1
+    else:
+        start = day_to_date(start_day)
+        step = 0
+        while True:
+            month = start.month - 1 + step * interval
+            try:
+                date = start.replace(year=start.year + month // 12, month=month % 12 + 1)
+            except ValueError:
+                # 31-го числа нет в этом месяце — повторение пропускается
+                step += 1
+                continue
+            day = date.toordinal() - EPOCH_ORDINAL
+            if day > last_day:
+                return
+            yield day
+            step += 1
+
+@functools.lru_cache(maxsize=16384)
+def recurrence_starts(rrule, dtstart, first_day, last_day):
+    """Начала повторений по правилу в местных днях [first_day, last_day]"""
+    freq, interval, byday, count, until = rrule
+    start_day = local_day(dtstart)
+    last_day = min(last_day, start_day + RECURRENCE_HORIZON_DAYS)
+    time_of_day = local_time_of_day(dtstart)
+
+    starts = []
+    produced = 0
+    for day in rrule_candidate_days(freq, interval, byday, start_day, last_day):
+        date = day_to_date(day)
+        start_ts = local_to_ts(date.year, date.month, date.day, *time_of_day)
+        if until is not None and start_ts > until:
+            break
+        produced += 1
+        if count is not None and produced > count:
+            break
+        if day >= first_day:
+            starts.append(start_ts)
+    return tuple(starts)
+
+def is_recurring(event):
+    return 'rrule' in event or 'rdates' in event
+
+def occurrence_starts(master, first_day, last_day):
+    """Начала повторений шаблона в местных днях [first_day, last_day] без исключенных EXDATE"""
+    rrule = master.get('rrule')
+    if rrule:
+        starts = list(recurrence_starts(rrule, master['start_ts'], first_day, last_day))
+    else:
+        starts = [master['start_ts']] if first_day <= local_day(master['start_ts']) <= last_day else []
+    starts += [start_ts for start_ts in master.get('rdates', ()) if first_day <= local_day(start_ts) <= last_day]
+    exdates = master.get('exdates', ())
+    return sorted({start_ts for start_ts in starts if start_ts not in exdates})
+
+def recurrence_day_range(master):
+    """Первый и последний местный день, на которые может прийтись повторение"""
+    start_day = local_day(master['start_ts'])
+    last_day = start_day
+    rrule = master.get('rrule')
+    if rrule:
+        last_day = start_day + RECURRENCE_HORIZON_DAYS
+        if rrule[4] is not None:
+            last_day = min(last_day, local_day(rrule[4]))
+    for start_ts in master.get('rdates', ()):
+        last_day = max(last_day, local_day(start_ts))
+    return start_day, last_day
+
+def make_occurrence(master, start_ts):
+    return Event(
+        uid=f"{master['uid']}/{start_ts}",
+        summary=master['summary'],
+        original_summary=master['original_summary'],
+        start_ts=start_ts,
+        end_ts=start_ts + master['end_ts'] - master['start_ts'],
+        desc=master['desc'],
+        teacher=master['teacher'],
+        room=master['room']
+    )
+
+def expand_events(events):
+    """Список событий, в котором шаблоны заменены всеми их повторениями"""
+    if not any(is_recurring(event) for event in events):
+        return events
+
+    expanded = []
+    for event in events:
+        if is_recurring(event):
+            expanded.extend(make_occurrence(event, start_ts) for start_ts in occurrence_starts(event, *recurrence_day_range(event)))
+        else:
+            expanded.append(event)
+    expanded.sort(key=lambda event: event['start_ts'])
+    return expanded
+
+class RecurringDayIndex:
+    """Индекс по датам для потока с повторяющимися событиями.
+
+    Ведет себя как dict дата -> события: get/[]/in раскрывают повторения только
+    для недели запрошенной даты, перебор всех дат раскрывает весь диапазон.
+    Записанные через []= или pop даты (правки) больше не раскрываются.
+    """
+
+    def __init__(self, buckets, masters):
+        self.buckets = buckets
+        self.masters = masters
+        self.expanded_weeks = set()
+        self.pinned = set()
+        self.ranges = [recurrence_day_range(master) for master in masters]
+
+    def expand_week(self, week):
+        if week in self.expanded_weeks:
+            return
+        self.expanded_weeks.add(week)
+
+        first_day, last_day = week * 7, week * 7 + 6
+        added = {}
+        for master, (start_day, end_day) in zip(self.masters, self.ranges):
+            if end_day < first_day or start_day > last_day:
+                continue
+            for start_ts in occurrence_starts(master, first_day, last_day):
+                date = ts_to_date(start_ts)
+                if date not in self.pinned:
+                    added.setdefault(date, []).append(make_occurrence(master, start_ts))
+
+        # Списки могут быть общими с копиями индекса — заменяем, а не дополняем
+        for date, occurrences in added.items():
+            bucket = self.buckets.get(date, []) + occurrences
+            bucket.sort(key=lambda event: event['start_ts'])
+            self.buckets[date] = bucket
+
+    def expand_date(self, date):
+        self.expand_week((date.toordinal() - EPOCH_ORDINAL) // 7)
+
+    def expand_range(self, first_date, last_date):
+        first_week = (first_date.toordinal() - EPOCH_ORDINAL) // 7
+        last_week = (last_date.toordinal() - EPOCH_ORDINAL) // 7
+        for week in range(first_week, last_week + 1):
+            self.expand_week(week)
+
+    def expand_all(self):
+        for start_day, end_day in self.ranges:
+            self.expand_range(day_to_date(start_day), day_to_date(end_day))
+
+    def bounds(self):
+        """Первая и последняя дата без раскрытия повторений"""
+        days = [start_day for start_day, _ in self.ranges] + [end_day for _, end_day in self.ranges]
+        dates = [day_to_date(day) for day in days] + list(self.buckets)
+        return min(dates), max(dates)
+
+    def get(self, date, default=None):
+        self.expand_date(date)
+        return self.buckets.get(date, default)
+
+    def __getitem__(self, date):
+        self.expand_date(date)
+        return self.buckets[date]
+
+    def __contains__(self, date):
+        self.expand_date(date)
+        return date in self.buckets
+
+    def __setitem__(self, date, bucket):
+        self.pinned.add(date)
+        self.buckets[date] = bucket
+
+    def pop(self, date, *default):
+        self.pinned.add(date)
+        return self.buckets.pop(date, *default)
+
+    def __iter__(self):
+        self.expand_all()
+        return iter(self.buckets)
+
+    def __len__(self):
+        self.expand_all()
+        return len(self.buckets)
+
+    def __bool__(self):
+        return bool(self.buckets or self.masters)
+
+    def keys(self):
+        self.expand_all()
+        return self.buckets.keys()
+
+    def values(self):
+        self.expand_all()
+        return self.buckets.values()
+
+    def items(self):
+        self.expand_all()
+        return self.buckets.items()
+
+    def copy(self):
+        index = RecurringDayIndex(dict(self.buckets), self.masters)
+        index.expanded_weeks = set(self.expanded_weeks)
+        index.pinned = set(self.pinned)
+        index.ranges = self.ranges
+        return index
+
+def day_index_bounds(day_index):
+    """Первая и последняя дата индекса; повторения при этом не раскрываются"""
+    if isinstance(day_index, RecurringDayIndex):
+        return day_index.bounds()
+    return min(day_index), max(day_index)
+
+def apply_subject_renames(course, stream, events):
+    """Проставляет отображаемые названия предметов"""
+    for event in events:
+        event['summary'] = get_display_subject_name(course, stream, event['original_summary'])
+    return events
+
+def build_day_index(events):
+    """Строит индекс событий по датам: дата -> список событий.
+
+    Если есть повторяющиеся события, возвращает RecurringDayIndex.
+    """
+    index = {}
+    masters = []
+    for event in events:
+        if is_recurring(event):
+            masters.append(event)
+        else:
+            index.setdefault(ts_to_date(event["start_ts"]), []).append(event)
+    return RecurringDayIndex(index, masters) if masters else index
+
+# === БИНАРНЫЕ СНИМКИ РАСПИСАНИЯ ===
+# Формат файла: MAGIC | версия (uint16) | sha256 исходного ICS (32 байта) | pickle с данными.
+# Время хранится в секундах от эпохи, как и в самих событиях.
+def ics_content_hash(data):
+    """Хэш содержимого ICS, по которому проверяется актуальность снимка"""
+    return hashlib.sha256(data.encode("utf-8")).digest()
+
+def get_snapshot_path(course, stream):
+    return os.path.join(SNAPSHOT_DIR, f"{course}_{stream}.snap")
+
+def pack_events(events):
+    """События в компактном виде из кортежей: для снимка и для передачи между процессами"""
+    rows = []
+    day_index = {}
+    for position, event in enumerate(events):
+        recurrence = None
+        if is_recurring(event):
+            recurrence = (event.get('rrule'), tuple(sorted(event.get('exdates', ()))), event.get('rdates', ()))
+        rows.append((
+            event['uid'],
+            event['original_summary'],
+            event['start_ts'],
+            event['end_ts'],
+            event['desc'],
+            event['teacher'],
+            event['room'],
+            recurrence
+        ))
+        if recurrence is None:
+            day_index.setdefault(local_day(event['start_ts']), []).append(position)
+    return {"events": rows, "day_index": day_index}
+
+def unpack_events(data):
+    """Обратно к событиям и индексу по датам; возвращает (события, индекс)"""
     events = []
+    masters = []
+    for uid, original_summary, start_ts, end_ts, desc, teacher, room, recurrence in data["events"]:
+        event = Event(
+            uid=uid,
+            summary=original_summary,
+            original_summary=original_summary,
+            start_ts=start_ts,
+            end_ts=end_ts,
+            desc=desc,
+            teacher=teacher,
+            room=room
+        )
+        if recurrence is not None:
+            rrule, exdates, rdates = recurrence
+            if rrule:
+                event['rrule'] = rrule
+            if exdates:
+                event['exdates'] = frozenset(exdates)
+            if rdates:
+                event['rdates'] = rdates
+            masters.append(event)
+        events.append(event)
+
+    day_index = {
+        day_to_date(day): [events[position] for position in positions]
+        for day, positions in data["day_index"].items()
+    }
+    if masters:
+        day_index = RecurringDayIndex(day_index, masters)
+    return events, day_index
+
+def save_snapshot(course, stream, content_hash, events, packed=None):
+    """Сохраняет разобранное расписание и индекс по датам в бинарный снимок"""
+    payload = pickle.dumps(packed or pack_events(events), protocol=pickle.HIGHEST_PROTOCOL)
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    path = get_snapshot_path(course, stream)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(struct.pack("<H", SNAPSHOT_VERSION))
+        f.write(content_hash)
+        f.write(payload)
+    os.replace(tmp_path, path)
+
+def read_snapshot_hash(course, stream):
+    """Читает только заголовок снимка; None, если снимка нет или версия устарела"""
     try:
-        logging.info(f"Загрузка расписания для курса {course}, потока {stream} из GitHub...")
+        with open(get_snapshot_path(course, stream), "rb") as f:
+            header = f.read(SNAPSHOT_HEADER_SIZE)
+    except FileNotFoundError:
+        return None
+
+    if len(header) != SNAPSHOT_HEADER_SIZE or not header.startswith(SNAPSHOT_MAGIC):
+        return None
+    version, = struct.unpack_from("<H", header, len(SNAPSHOT_MAGIC))
+    if version != SNAPSHOT_VERSION:
+        return None
+    return header[len(SNAPSHOT_MAGIC) + 2:]
+
+def load_snapshot(course, stream, expected_hash=None):
+    """Загружает снимок; возвращает (события, индекс по датам) или None"""
+    content_hash = read_snapshot_hash(course, stream)
+    if content_hash is None or (expected_hash is not None and content_hash != expected_hash):
+        return None
+
+    try:
+        with open(get_snapshot_path(course, stream), "rb") as f:
+            f.seek(SNAPSHOT_HEADER_SIZE)
+            data = pickle.load(f)
+    except Exception as e:
+        logging.warning("Не удалось прочитать снимок %s_%s: %s", course, stream, e)
+        return None
+    return unpack_events(data)
+
+# === КОЛОНОЧНОЕ ХРАНИЛИЩЕ СОБЫТИЙ ===
+# Разобранные события всех потоков в памяти лежат в одном EventStore: время — минуты от
+# эпохи в массивах int, строки — номера в общей таблице, повторение — номер в таблице правил.
+# Пара, общая для нескольких потоков, хранится одной строкой с битовой маской потоков.
+# В events_cache и индексах по датам лежат StoredEvent — ссылки на строки, которые
+# читаются как Event. Строки не перезаписываются: на прежние события могут ссылаться
+# диффы и уведомления, а строка, которая снова понадобится (поток выгружен и поднят
+# заново), находится по ключу и оживает.
+EVENT_ROW_KEY = struct.Struct("<iiIIIIII")
+EVENT_STRING_FIELDS = ('uid', 'original_summary', 'desc', 'teacher', 'room')
+EVENT_FIELDS = ('uid', 'summary', 'original_summary', 'start_ts', 'end_ts', 'desc', 'teacher', 'room')
+EVENT_RECURRENCE_FIELDS = ('rrule', 'exdates', 'rdates')
+
+class EventStore:
+    """События всех потоков в колонках, общие пары — один раз"""
+
+    def __init__(self):
+        self.strings = []
+        self.string_ids = {}
+        self.recurrences = [{}]
+        self.recurrence_ids = {}
+        self.starts = array('i')
+        self.ends = array('i')
+        self.columns = {field: array('I') for field in EVENT_STRING_FIELDS}
+        self.recurrence_rows = array('I')
+        self.masks = []
+        self.rows = {}
+        self.stream_bits = {}
+        self.stream_rows = {}
+
+    def intern(self, value):
+        string_id = self.string_ids.get(value)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.strings.append(value)
+            self.string_ids[value] = string_id
+        return string_id
+
+    def intern_recurrence(self, event):
+        recurrence = {field: event[field] for field in EVENT_RECURRENCE_FIELDS if event.get(field)}
+        if not recurrence:
+            return 0
+        key = tuple(recurrence.get(field) for field in EVENT_RECURRENCE_FIELDS)
+        recurrence_id = self.recurrence_ids.get(key)
+        if recurrence_id is None:
+            recurrence_id = len(self.recurrences)
+            self.recurrences.append(recurrence)
+            self.recurrence_ids[key] = recurrence_id
+        return recurrence_id
+
+    def add_row(self, event):
+        """Номер строки для события: существующей с теми же полями или новой"""
+        values = (event['start_ts'] // 60, event['end_ts'] // 60,
+                  *(self.intern(event.get(field, '')) for field in EVENT_STRING_FIELDS),
+                  self.intern_recurrence(event))
+        key = EVENT_ROW_KEY.pack(*values)
+        row = self.rows.get(key)
+        if row is None:
+            row = len(self.masks)
+            self.starts.append(values[0])
+            self.ends.append(values[1])
+            for column, value in zip(self.columns.values(), values[2:]):
+                column.append(value)
+            self.recurrence_rows.append(values[-1])
+            self.masks.append(0)
+            self.rows[key] = row
+        return row
+
+    def set_stream(self, stream_key, events):
+        """Записывает события потока вместо прежних; возвращает их как StoredEvent в том же порядке.
+
+        Уже лежащие в хранилище события (StoredEvent) переиспользуются как есть.
+        """
+        bit = self.stream_bits.setdefault(stream_key, 1 << len(self.stream_bits))
+        stored = [event if isinstance(event, StoredEvent) and event.store is self
+                  else StoredEvent(self, self.add_row(event), event['summary'])
+                  for event in events]
+        self.remove_stream(stream_key)
+        rows = array('I', (event.row for event in stored))
+        for row in rows:
+            self.masks[row] |= bit
+        self.stream_rows[stream_key] = rows
+        return stored
+
+    def remove_stream(self, stream_key):
+        rows = self.stream_rows.pop(stream_key, None)
+        if rows is not None:
+            bit = self.stream_bits[stream_key]
+            for row in rows:
+                self.masks[row] &= ~bit
+
+    def stream_keys(self, row):
+        """Потоки в памяти, в расписании которых есть эта строка"""
+        mask = self.masks[row]
+        return [stream_key for stream_key, bit in self.stream_bits.items() if mask & bit]
+
+    def live_rows(self):
+        return sum(1 for mask in self.masks if mask)
+
+event_store = EventStore()
+
+class StoredEvent:
+    """Событие потока из EventStore: номер строки и отображаемое (с учетом переименований)
+    название. Читается как Event; правки работают с копией — copy() дает обычный Event."""
+    __slots__ = ('store', 'row', 'summary')
+
+    def __init__(self, store, row, summary):
+        self.store = store
+        self.row = row
+        self.summary = summary
+
+    def __getitem__(self, key):
+        if key == 'summary':
+            return self.summary
+        store, row = self.store, self.row
+        if key == 'start_ts':
+            return store.starts[row] * 60
+        if key == 'end_ts':
+            return store.ends[row] * 60
+        column = store.columns.get(key)
+        if column is not None:
+            return store.strings[column[row]]
+        if key == 'start' or key == 'end':
+            return ts_to_datetime(self[key + '_ts'])
+        return store.recurrences[store.recurrence_rows[row]][key]
+
+    def __setitem__(self, key, value):
+        if key != 'summary':
+            raise TypeError(f"поле '{key}' события из хранилища не меняется, нужна copy()")
+        self.summary = value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in EVENT_FIELDS or key in self.store.recurrences[self.store.recurrence_rows[self.row]]
+
+    def keys(self):
+        return EVENT_FIELDS + tuple(self.store.recurrences[self.store.recurrence_rows[self.row]])
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def copy(self):
+        return Event(self)
+
+    def __repr__(self):
+        return f"StoredEvent({dict(self.items())!r})"
+
+def store_day_index(index, events, stored):
+    """Индекс по датам из снимка, переведенный на события хранилища"""
+    by_id = {id(event): stored_event for event, stored_event in zip(events, stored)}
+    buckets = index.buckets if isinstance(index, RecurringDayIndex) else index
+    buckets = {date: [by_id[id(event)] for event in bucket] for date, bucket in buckets.items()}
+    if isinstance(index, RecurringDayIndex):
+        return RecurringDayIndex(buckets, [by_id[id(master)] for master in index.masters])
+    return buckets
+
+def store_parsed_events(course, stream, events, base_day_index=None, reloaded=False):
+    """Кладет разобранные события в кэш и сбрасывает производные индексы.
+
+    reloaded — поток возвращается в память без изменений, индексы поиска пересобирать не нужно.
+    """
+    cache_key = f"{course}_{stream}"
+    stored = event_store.set_stream(cache_key, events)
+    events_cache[cache_key] = apply_subject_renames(course, stream, stored)
+    if base_day_index is not None:
+        base_day_index_cache[cache_key] = store_day_index(base_day_index, events, stored)
+    else:
+        base_day_index_cache[cache_key] = build_day_index(stored)
+    day_index_cache.pop(cache_key, None)
+    invalidate_rendered_views(cache_key)
+    calendar_residency[cache_key] = len(events) * EVENT_MEMORY_ESTIMATE
+    calendar_residency.move_to_end(cache_key)
+    evict_calendars(keep=cache_key)
+    if not reloaded:
+        bump_schedule_version()
+
+# === РАСПИСАНИЯ В ПАМЯТИ: LRU ПОД БЮДЖЕТ ===
+# Потоки загружаются при первом обращении; если оценка занятой памяти превышает
+# CALENDAR_MEMORY_BUDGET, давно не использованные выгружаются и потом поднимаются из снимка.
+def touch_stream(cache_key):
+    if cache_key in calendar_residency:
+        calendar_residency.move_to_end(cache_key)
+
+def unload_stream(cache_key):
+    """Выгружает поток из памяти; на диске остается его снимок"""
+    events_cache.pop(cache_key, None)
+    event_store.remove_stream(cache_key)
+    base_day_index_cache.pop(cache_key, None)
+    day_index_cache.pop(cache_key, None)
+    inline_subject_index_cache.pop(cache_key, None)
+    edited_events_cache.pop(cache_key, None)
+    interval_index_cache.pop(("stream", cache_key), None)
+    calendar_residency.pop(cache_key, None)
+    # Файлы фидов остаются верными: поток выгружен, а не изменен
+    feeds = {variant: feed_file for variant, feed_file in feed_files.items() if variant[0] == cache_key}
+    invalidate_rendered_views(cache_key)
+    feed_files.update(feeds)
+    drop_search_indexes()
+
+def drop_search_indexes():
+    """Индексы поиска по всем потокам держат ссылки на их пары: после выгрузки потока
+    сбрасываем их, при следующем запросе они соберутся из потоков, оставшихся в памяти"""
+    global directory_index
+    directory_index = None
+    directory_answer_cache.clear()
+    for index_key in [key for key in interval_index_cache if key[0] == "room"]:
+        del interval_index_cache[index_key]
+
+def evict_calendars(keep=None):
+    """Выгружает самые давние потоки, пока оценка памяти не уложится в бюджет"""
+    used = sum(calendar_residency.values())
+    for cache_key in list(calendar_residency):
+        if used <= CALENDAR_MEMORY_BUDGET:
+            break
+        if cache_key == keep:
+            continue
+        course, stream = cache_key.split('_', 1)
+        snapshot_hash = read_snapshot_hash(course, stream)
+        if snapshot_hash is None:
+            # Без снимка поток пришлось бы снова качать из сети — держим его
+            continue
+        used -= calendar_residency[cache_key]
+        unload_stream(cache_key)
+        evicted_streams[cache_key] = snapshot_hash
+        logging.info("📤 Поток %s выгружен из памяти", cache_key, extra={"event": "stream_unloaded", "stream": cache_key})
+
+def is_snapshot_fresh(course, stream):
+    try:
+        return time.time() - os.path.getmtime(get_snapshot_path(course, stream)) < SNAPSHOT_MAX_AGE
+    except OSError:
+        return False
+
+def load_snapshots():
+    """Поднимает все снимки с диска в кэш (быстрый холодный старт без сети)"""
+    loaded = 0
+    for course, streams in STREAM_URLS.items():
+        for stream in streams:
+            snapshot = load_snapshot(course, stream)
+            if snapshot is None:
+                continue
+            events, day_index = snapshot
+            store_parsed_events(course, stream, events, day_index)
+            loaded += 1
+    return loaded
+
+# === УСТОЙЧИВАЯ ЗАГРУЗКА ИСТОЧНИКОВ ===
+class SourceUnavailable(Exception):
+    """Источник расписания недоступен (ошибка, открытый предохранитель или кэш 404)"""
+
+class CircuitBreaker:
+    """Предохранитель источника: после серии ошибок запросы не отправляются,
+    пауза растет экспоненциально до SOURCE_MAX_COOLDOWN."""
+
+    def __init__(self):
+        self.failures = 0
+        self.open_until = 0.0
+
+    def allow(self, now):
+        return now >= self.open_until
+
+    def record_success(self):
+        self.failures = 0
+        self.open_until = 0.0
+
+    def record_failure(self, now):
+        self.failures += 1
+        if self.failures >= SOURCE_FAILURE_THRESHOLD:
+            cooldown = SOURCE_BASE_COOLDOWN * 2 ** (self.failures - SOURCE_FAILURE_THRESHOLD)
+            self.open_until = now + min(cooldown, SOURCE_MAX_COOLDOWN)
+
+source_breakers = {}
+missing_sources = {}
+stale_streams = set()
+
+def download_ics(url):
+    """Скачивает ICS с таймаутом, повторами и предохранителем на источник"""
+    now = clock.time()
+    if missing_sources.get(url, 0) > now:
+        raise SourceUnavailable(f"Файл не найден (закэшировано): {url}")
+
+    breaker = source_breakers.setdefault(url, CircuitBreaker())
+    if not breaker.allow(now):
+        raise SourceUnavailable(f"Источник временно отключен до {datetime.datetime.fromtimestamp(breaker.open_until):%H:%M:%S}: {url}")
+
+    if url.startswith("file://"):
+        # Локальный файл — удобно для тестовых конфигураций
+        with open(url[len("file://"):], "r", encoding="utf-8") as f:
+            return f.read()
+
+    last_error = None
+    for attempt in range(SOURCE_RETRIES + 1):
+        try:
+            response = requests.get(url, timeout=SOURCE_TIMEOUT)
+            if response.status_code == 404:
+                breaker.record_success()
+                missing_sources[url] = clock.time() + SOURCE_NOT_FOUND_TTL
+                raise SourceUnavailable(f"Файл не найден: {url}")
+            response.raise_for_status()
+            breaker.record_success()
+            missing_sources.pop(url, None)
+            return response.text
+        except requests.HTTPError as e:
+            last_error = e
+            if e.response is not None and e.response.status_code < 500:
+                break
+        except requests.RequestException as e:
+            last_error = e
+
+        if attempt < SOURCE_RETRIES:
+            time.sleep(SOURCE_RETRY_DELAY * 2 ** attempt)
+
+    breaker.record_failure(clock.time())
+    raise SourceUnavailable(f"Не удалось скачать {url}: {last_error}") from last_error
+
+def schedule_status(course, stream, text):
+    """Добавляет к расписанию пометку, если оно устарело или не загрузилось"""
+    cache_key = f"{course}_{stream}"
+    if cache_key not in events_cache:
+        return "⚠️ Не удалось загрузить расписание. Попробуй позже."
+    if cache_key in stale_streams:
+        return f"⚠️ Источник расписания недоступен, показана последняя сохраненная версия.\n\n{text}"
+    return text
+
+def parse_calendar(course, stream, data):
+    """Разбирает ICS; если содержимое совпадает со снимком, берет готовый результат из него"""
+    content_hash = ics_content_hash(data)
+    snapshot = load_snapshot(course, stream, expected_hash=content_hash)
+    if snapshot is not None:
+        logging.info("Расписание курса %s, потока %s не изменилось, взято из снимка", course, stream,
+                     extra={"event": "snapshot_reused", "stream": f"{course}_{stream}"})
+        # Снимок сверен с источником — продлеваем его свежесть
+        os.utime(get_snapshot_path(course, stream))
+        return snapshot
+
+    events = parse_ics(data)
+    try:
+        save_snapshot(course, stream, content_hash, events)
+    except OSError as e:
+        logging.warning("Не удалось сохранить снимок %s_%s: %s", course, stream, e)
+    return events, None
+
+# === ПАРАЛЛЕЛЬНЫЙ РАЗБОР ПОТОКОВ ===
+# При старте и плановом обновлении ICS всех потоков скачиваются параллельно в пуле потоков,
+# а разбираются в пуле процессов. Процесс возвращает события в компактном виде (pack_events),
+# основной процесс распаковывает их и подменяет все потоки подряд, без await между ними.
+# Процессы запускаются через spawn: fork унаследовал бы очередь логов без слушателя и блокировки
+# работающих потоков. Записи логов из процессов идут через свою очередь в обработчики основного.
+parse_pool = None
+parse_log_listener = None
+
+def parse_worker_count():
+    return PARSE_WORKERS or os.cpu_count() or 1
+
+def init_parse_worker(log_queue):
+    """Запускается в каждом процессе пула: логи — в очередь основного процесса"""
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(logging.INFO)
+
+def get_parse_pool():
+    global parse_pool, parse_log_listener
+    if parse_pool is None:
+        context = multiprocessing.get_context("spawn")
+        log_queue = context.Queue()
+        parse_log_listener = logging.handlers.QueueListener(
+            log_queue, *logging.getLogger().handlers, respect_handler_level=True
+        )
+        parse_log_listener.start()
+        parse_pool = ProcessPoolExecutor(
+            max_workers=parse_worker_count(), mp_context=context,
+            initializer=init_parse_worker, initargs=(log_queue,)
+        )
+    return parse_pool
+
+def shutdown_parse_pool():
+    global parse_pool, parse_log_listener
+    if parse_pool is not None:
+        parse_pool.shutdown(cancel_futures=True)
+        parse_pool = None
+    if parse_log_listener is not None:
+        parse_log_listener.stop()
+        parse_log_listener = None
+
+def parse_worker(course, stream, data):
+    """Выполняется в процессе пула: разбирает ICS и сохраняет снимок.
+
+    Возвращает (хэш, упакованные события); вместо событий None, если снимок уже совпадает с ICS.
+    """
+    content_hash = ics_content_hash(data)
+    if read_snapshot_hash(course, stream) == content_hash:
+        return content_hash, None
+    packed = pack_events(parse_ics(data))
+    try:
+        save_snapshot(course, stream, content_hash, None, packed)
+    except OSError as e:
+        logging.warning("Не удалось сохранить снимок %s_%s: %s", course, stream, e)
+    return content_hash, packed
+
+def unpack_parse_result(course, stream, result):
+    """(события, индекс) из ответа процесса; None, если снимок успели заменить или удалить"""
+    content_hash, packed = result
+    if packed is not None:
+        return unpack_events(packed)
+    snapshot = load_snapshot(course, stream, expected_hash=content_hash)
+    if snapshot is not None:
+        os.utime(get_snapshot_path(course, stream))
+    return snapshot
+
+async def parse_calendars(items):
+    """Разбирает [(курс, поток, ICS)] в пуле процессов: {cache_key: (события, индекс)}.
+
+    Потоки, которые не удалось разобрать, в результат не попадают.
+    """
+    if not items:
+        return {}
+    loop = asyncio.get_running_loop()
+    pool = get_parse_pool()
+    results = await asyncio.gather(
+        *(loop.run_in_executor(pool, parse_worker, course, stream, data) for course, stream, data in items),
+        return_exceptions=True
+    )
+
+    if any(isinstance(result, BrokenProcessPool) for result in results):
+        # Процесс пула упал — следующий разбор начнется с нового пула
+        shutdown_parse_pool()
+
+    parsed = {}
+    for (course, stream, _), result in zip(items, results):
+        if not isinstance(result, BaseException):
+            result = unpack_parse_result(course, stream, result)
+        if result is None or isinstance(result, BaseException):
+            logging.error("❌ Ошибка разбора расписания %s_%s: %s", course, stream, result or "снимок не найден")
+            continue
+        parsed[f"{course}_{stream}"] = result
+    return parsed
+
+async def download_sources(cache_keys):
+    """Скачивает ICS потоков параллельно: {cache_key: текст или исключение}"""
+    loop = asyncio.get_running_loop()
+
+    def download(cache_key):
+        course, stream = cache_key.split('_', 1)
         url = STREAM_URLS.get(course, {}).get(stream)
         if not url:
-            logging.error(f"URL не найден для курса {course}, потока {stream}")
+            raise SourceUnavailable(f"URL не найден для курса {course}, потока {stream}")
+        return download_ics(url)
+
+    results = await asyncio.gather(
+        *(loop.run_in_executor(None, download, cache_key) for cache_key in cache_keys),
+        return_exceptions=True
+    )
+    return dict(zip(cache_keys, results))
+
+async def preload_calendars():
+    """При старте поднимает потоки, выбранные пользователями; популярные загружаются последними,
+    чтобы при нехватке бюджета памяти вытеснялись редкие"""
+    counts = {}
+    for settings in user_settings.values():
+        course, stream = settings.get('course'), settings.get('stream')
+        if course and stream and stream in STREAM_URLS.get(course, {}):
+            counts[f"{course}_{stream}"] = counts.get(f"{course}_{stream}", 0) + 1
+    cache_keys = sorted(counts, key=counts.get)
+
+    # Свежие снимки поднимаются без сети, остальное скачивается и разбирается параллельно
+    to_download = []
+    for cache_key in cache_keys:
+        course, stream = cache_key.split('_', 1)
+        if is_snapshot_fresh(course, stream):
+            load_events_from_github(course, stream)
+        else:
+            to_download.append(cache_key)
+
+    downloads = await download_sources(to_download)
+    items = [(*cache_key.split('_', 1), data) for cache_key, data in downloads.items()
+             if not isinstance(data, BaseException)]
+    parsed = await parse_calendars(items)
+    for cache_key in to_download:
+        if cache_key in parsed and cache_key not in events_cache:
+            course, stream = cache_key.split('_', 1)
+            store_parsed_events(course, stream, *parsed[cache_key], reloaded=True)
+    if parsed:
+        bump_schedule_version()
+    logging.info("📚 Загружено заранее: %s из %s потоков (%s разобрано в %s процессах)",
+                 sum(cache_key in events_cache for cache_key in cache_keys), len(cache_keys),
+                 len(parsed), parse_worker_count())
+
+def fetch_calendar(course, stream, use_network=True):
+    """Блокирующая часть загрузки потока: свежий снимок, источник или, если он недоступен,
+    устаревший снимок. Возвращает (откуда, события, индекс, хэш снимка) или None.
+
+    Кэши не трогает: результат кладет install_calendar в потоке цикла событий.
+    """
+    # Свежий снимок (в том числе выгруженного по LRU потока) поднимается без сети
+    if is_snapshot_fresh(course, stream):
+        snapshot_hash = read_snapshot_hash(course, stream)
+        snapshot = load_snapshot(course, stream)
+        if snapshot is not None:
+            return ("snapshot", *snapshot, snapshot_hash)
+
+    if use_network:
+        try:
+            logging.info("Загрузка расписания для курса %s, потока %s из GitHub...", course, stream,
+                         extra={"event": "calendar_loading", "stream": f"{course}_{stream}"})
+            url = STREAM_URLS.get(course, {}).get(stream)
+            if not url:
+                logging.error("URL не найден для курса %s, потока %s", course, stream)
+                return None
+
+            events, day_index = parse_calendar(course, stream, download_ics(url))
+            logging.info("Успешно загружено %s событий для курса %s, потока %s", len(events), course, stream,
+                         extra={"event": "calendar_loaded", "stream": f"{course}_{stream}", "events": len(events)})
+            return ("source", events, day_index, None)
+
+        except Exception as e:
+            logging.error("Ошибка при загрузке файла с GitHub: %s", e)
+
+    snapshot = load_snapshot(course, stream)
+    if snapshot is None:
+        return None
+    logging.warning("Курс %s, поток %s: источник недоступен, используется сохраненный снимок", course, stream)
+    return ("stale", *snapshot, None)
+
+def install_calendar(course, stream, loaded):
+    """Кладет результат fetch_calendar в кэши"""
+    if loaded is None:
+        return
+    cache_key = f"{course}_{stream}"
+    origin, events, day_index, snapshot_hash = loaded
+    if origin == "snapshot":
+        unchanged = evicted_streams.pop(cache_key, None) == snapshot_hash
+        store_parsed_events(course, stream, events, day_index, reloaded=unchanged)
+        return
+    store_parsed_events(course, stream, events, day_index)
+    if origin == "stale":
+        stale_streams.add(cache_key)
+    else:
+        stale_streams.discard(cache_key)
+
+def in_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+def load_events_from_github(course, stream):
+    """Загрузка событий с учетом курса и потока"""
+    cache_key = f"{course}_{stream}"
+    if cache_key not in events_cache:
+        # В цикле событий сеть не трогаем: ее уже попробовал ensure_calendar в пуле потоков,
+        # здесь поток поднимается только из снимка
+        install_calendar(course, stream, fetch_calendar(course, stream, use_network=not in_event_loop()))
+        if cache_key not in events_cache:
             return []
+    touch_stream(cache_key)
+    return apply_schedule_edits(course, stream, events_cache[cache_key])
 
-        response = requests.get(url)
-        response.raise_for_status()
-        data = response.text
+async def ensure_calendar(course, stream):
+    """Поднимает поток в память, не блокируя цикл событий: снимок, сеть и разбор — в пуле потоков.
 
-        event_blocks = data.split('BEGIN:VEVENT')
+    Одновременные запросы одного потока ждут одну загрузку. Устаревший поток (источник был
+    недоступен) перепроверяется в фоне, как только предохранитель источника это позволит.
+    """
+    cache_key = f"{course}_{stream}"
+    if cache_key in events_cache:
+        touch_stream(cache_key)
+        retry_stale_stream(course, stream)
+        return
+    if stream not in STREAM_URLS.get(course, {}):
+        return
 
-        for block in event_blocks:
-            if 'END:VEVENT' not in block:
-                continue
+    load = calendar_loads.get(cache_key)
+    if load is None:
+        async def load_calendar():
+            try:
+                loaded = await asyncio.get_running_loop().run_in_executor(None, fetch_calendar, course, stream)
+                if cache_key not in events_cache:
+                    install_calendar(course, stream, loaded)
+            finally:
+                calendar_loads.pop(cache_key, None)
+
+        load = calendar_loads[cache_key] = asyncio.create_task(load_calendar())
+    # Отмена одного ожидающего не прерывает загрузку для остальных
+    await asyncio.shield(load)
+
+async def ensure_all_calendars():
+    """Поднимает потоки из sources.json вне цикла событий для поиска по всем потокам.
+
+    Выгруженные по бюджету памяти потоки не возвращаются: иначе каждый запрос поиска
+    поднимал бы их снова, вытесняя другие. Поиск тогда идет по тем, что в памяти.
+    """
+    await asyncio.gather(*(
+        ensure_calendar(course, stream) for course, streams in STREAM_URLS.items() for stream in streams
+        if f"{course}_{stream}" not in evicted_streams
+    ))
+
+async def refresh_stream(course, stream):
+    """Перекачивает ICS потока вне цикла событий, разбирает в пуле процессов и применяет.
+
+    Возвращает изменения, как apply_calendar_update; SourceUnavailable, если источник недоступен.
+    """
+    cache_key = f"{course}_{stream}"
+    url = STREAM_URLS.get(course, {}).get(stream)
+    if not url:
+        raise SourceUnavailable(f"URL не найден для курса {course}, потока {stream}")
+
+    try:
+        data = await asyncio.get_running_loop().run_in_executor(None, download_ics, url)
+    except SourceUnavailable:
+        if cache_key in events_cache:
+            stale_streams.add(cache_key)
+        raise
+    parsed = None
+    if read_snapshot_hash(course, stream) != ics_content_hash(data):
+        parsed = (await parse_calendars([(course, stream, data)])).get(cache_key)
+        if parsed is None:
+            raise ValueError(f"не удалось разобрать расписание {cache_key}")
+    return apply_calendar_update(course, stream, data, parsed)
+
+def retry_stale_stream(course, stream):
+    """Фоновая перепроверка устаревшего потока не чаще раза в SOURCE_BASE_COOLDOWN"""
+    cache_key = f"{course}_{stream}"
+    url = STREAM_URLS.get(course, {}).get(stream)
+    now = clock.time()
+    if cache_key not in stale_streams or not url or stale_retry_at.get(cache_key, 0) > now:
+        return
+    breaker = source_breakers.get(url)
+    if breaker is not None and not breaker.allow(now):
+        return
+    stale_retry_at[cache_key] = now + SOURCE_BASE_COOLDOWN
 
+    async def retry():
+        try:
+            changes = await refresh_stream(course, stream)
+        except Exception as e:
+            logging.warning("Источник %s все еще недоступен: %s", cache_key, e)
+            return
+        logging.info("Расписание %s снова получено из источника", cache_key,
+                     extra={"event": "stale_stream_recovered", "stream": cache_key})
+        await notify_schedule_changes(course, stream, changes)
+
+    asyncio.create_task(retry())
+
+def build_edited_bucket(course, stream, date, base_bucket):
+    """События одного дня с учетом правок"""
+    date_str = date.isoformat()
+    date_edits = schedule_edits.get(f"{course}_{stream}", {}).get(date_str)
+    if not date_edits:
+        return base_bucket
+    return apply_day_edits(date_str, date_edits, base_bucket)
+
+def get_day_index(course, stream):
+    """Индекс событий с примененными правками по датам"""
+    cache_key = f"{course}_{stream}"
+    if cache_key in day_index_cache:
+        touch_stream(cache_key)
+        return day_index_cache[cache_key]
+
+    load_events_from_github(course, stream)
+    base_index = base_day_index_cache.get(cache_key)
+    if base_index is None:
+        return {}
+
+    index = base_index
+    stream_edits = schedule_edits.get(cache_key)
+    if stream_edits:
+        index = base_index.copy()
+        for date_str in stream_edits:
             try:
-                summary_match = re.search(r'SUMMARY:(.+?)(?:\n|$)', block)
-                dtstart_match = re.search(r'DTSTART(?:;VALUE=DATE-TIME)?(?:;TZID=Europe/Moscow)?:(\d{8}T\d{6})', block)
-                dtend_match = re.search(r'DTEND(?:;VALUE=DATE-TIME)?(?:;TZID=Europe/Moscow)?:(\d{8}T\d{6})', block)
-                description_match = re.search(r'DESCRIPTION:(.+?)(?:\n|$)', block, re.DOTALL)
+                date = datetime.date.fromisoformat(date_str)
+            except ValueError:
+                logging.error("Неверная дата в правках расписания %s: %s", cache_key, date_str)
+                continue
+            bucket = build_edited_bucket(course, stream, date, base_index.get(date, []))
+            if bucket:
+                index[date] = bucket
+            else:
+                index.pop(date, None)
+
+    day_index_cache[cache_key] = index
+    return index
+
+# === ОБНОВЛЕНИЕ РАСПИСАНИЯ И УВЕДОМЛЕНИЯ ОБ ИЗМЕНЕНИЯХ ===
+DIFF_FIELDS = ('original_summary', 'start_ts', 'end_ts', 'desc', 'teacher', 'room')
+
+def event_identity(event):
+    """Ключ для сопоставления событий: UID, а без него — название и время начала"""
+    if event.get('uid'):
+        return event['uid']
+    return f"{event['original_summary']}|{event['start_ts']}"
+
+def index_by_identity(events):
+    """Пары (ключ, событие); повторяющиеся ключи нумеруются по порядку"""
+    counts = {}
+    for event in events:
+        identity = event_identity(event)
+        occurrence = counts.get(identity, 0)
+        counts[identity] = occurrence + 1
+        yield (identity, occurrence) if occurrence else identity, event
+
+def diff_events(old_events, new_events):
+    """Сравнивает две версии расписания.
+
+    Возвращает (изменения, итоговый список); в итоговом списке неизменившиеся
+    события — это прежние объекты, поэтому их дни можно не пересобирать.
+    """
+    old_by_id = dict(index_by_identity(old_events))
+    added, changed, merged = [], [], []
+    seen = set()
+
+    for identity, event in index_by_identity(new_events):
+        seen.add(identity)
+        old_event = old_by_id.get(identity)
+        if old_event is None:
+            added.append(event)
+            merged.append(event)
+        elif any(old_event.get(field) != event.get(field) for field in DIFF_FIELDS):
+            changed.append((old_event, event))
+            merged.append(event)
+        else:
+            merged.append(old_event)
+
+    removed = [event for identity, event in old_by_id.items() if identity not in seen]
+    return {"added": added, "removed": removed, "changed": changed}, merged
+
+def changed_dates(changes):
+    dates = {ts_to_date(event['start_ts']) for event in changes["added"] + changes["removed"]}
+    for old_event, new_event in changes["changed"]:
+        dates.add(ts_to_date(old_event['start_ts']))
+        dates.add(ts_to_date(new_event['start_ts']))
+    return dates
+
+def apply_calendar_update(course, stream, data, parsed=None):
+    """Применяет скачанный ICS к потоку; parsed — уже разобранный результат (события, индекс)"""
+    cache_key = f"{course}_{stream}"
+    stale_streams.discard(cache_key)
+    old_events = events_cache.get(cache_key)
+    if old_events is None:
+        events, day_index = parsed or parse_calendar(course, stream, data)
+        store_parsed_events(course, stream, events, day_index)
+        return None
+
+    if parsed is None and read_snapshot_hash(course, stream) == ics_content_hash(data):
+        return {"added": [], "removed": [], "changed": []}
+
+    new_events, day_index = parsed or parse_calendar(course, stream, data)
+    if any(is_recurring(event) for event in old_events) or any(is_recurring(event) for event in new_events):
+        # С шаблонами один измененный VEVENT задевает много дат — сравниваем повторения
+        # и пересобираем поток целиком
+        apply_subject_renames(course, stream, new_events)
+        changes, _ = diff_events(expand_events(old_events), expand_events(new_events))
+        store_parsed_events(course, stream, new_events, day_index)
+        return changes
+
+    apply_subject_renames(course, stream, new_events)
+    changes, merged = diff_events(old_events, new_events)
+    dates = changed_dates(changes)
+
+    # Неизменившиеся события уже лежат в хранилище, новые записываются
+    merged = event_store.set_stream(cache_key, merged)
+    events_cache[cache_key] = merged
+
+    base_index = base_day_index_cache.get(cache_key)
+    if base_index is None:
+        base_day_index_cache[cache_key] = build_day_index(merged)
+        day_index_cache.pop(cache_key, None)
+        invalidate_rendered_views(cache_key)
+    elif dates:
+        buckets = {date: [] for date in dates}
+        for event in merged:
+            bucket = buckets.get(ts_to_date(event['start_ts']))
+            if bucket is not None:
+                bucket.append(event)
+
+        day_index = day_index_cache.get(cache_key)
+        for date, bucket in buckets.items():
+            if bucket:
+                base_index[date] = bucket
+            else:
+                base_index.pop(date, None)
+
+            if day_index is not None and day_index is not base_index:
+                edited_bucket = build_edited_bucket(course, stream, date, bucket)
+                if edited_bucket:
+                    day_index[date] = edited_bucket
+                else:
+                    day_index.pop(date, None)
+
+        invalidate_rendered_views(cache_key, dates)
+
+    if dates or base_index is None:
+        bump_schedule_version()
+
+    logging.info(
+        "Расписание курса %s, потока %s обновлено: +%s -%s ~%s", course, stream,
+        len(changes['added']), len(changes['removed']), len(changes['changed']),
+        extra={"event": "calendar_refreshed", "stream": f"{course}_{stream}"}
+    )
+    return changes
+
+def describe_event_short(event):
+    text = f"{event['start'].strftime('%d.%m %H:%M')}–{event['end'].strftime('%H:%M')} {event['summary']}"
+    if event.get('room'):
+        text += f", ауд. {event['room']}"
+    return text
+
+def format_schedule_changes(course, stream, changes, limit=15):
+    """Текст уведомления: только будущие изменения; пустая строка, если их нет"""
+    now_ts = int(clock.time())
+    lines = []
+    for event in changes["added"]:
+        if event['start_ts'] >= now_ts:
+            lines.append(f"➕ {describe_event_short(event)}")
+    for event in changes["removed"]:
+        if event['start_ts'] >= now_ts:
+            lines.append(f"➖ {describe_event_short(event)}")
+    for old_event, new_event in changes["changed"]:
+        if max(old_event['start_ts'], new_event['start_ts']) >= now_ts:
+            lines.append(f"✏️ {describe_event_short(old_event)}\n    → {describe_event_short(new_event)}")
+
+    if not lines:
+        return ""
+
+    text = f"📣 Изменения в расписании ({course_title(course, stream)}):\n\n"
+    text += "\n".join(lines[:limit])
+    if len(lines) > limit:
+        text += f"\n\n…и еще изменений: {len(lines) - limit}"
+    return text
+
+async def notify_schedule_changes(course, stream, changes):
+    """Рассылает изменения подписавшимся студентам потока"""
+    if not application or not changes:
+        return
+
+    text = format_schedule_changes(course, stream, changes)
+    if not text:
+        return
+
+    for user_id, settings in list(user_settings.items()):
+        if not settings.get('change_notifications', False):
+            continue
+        if settings.get('course') != course or settings.get('stream') != stream:
+            continue
+
+        try:
+            await application.bot.send_message(chat_id=user_id, text=text)
+            await asyncio.sleep(0.05)
+        except BadRequest as e:
+            logging.error("❌ Ошибка отправки уведомления об изменениях пользователю %s: %s", user_id, e,
+                          extra={"event": "change_notification_failed", "user_id": user_id})
+            if "chat not found" in str(e).lower() or "bot was blocked" in str(e).lower():
+                user_settings.pop(user_id, None)
+                update_user_stats(user_id)
+                save_user_settings(user_settings)
+        except Exception as e:
+            logging.error("❌ Ошибка отправки уведомления об изменениях пользователю %s: %s", user_id, e,
+                          extra={"event": "change_notification_failed", "user_id": user_id})
+
+async def refresh_all_calendars():
+    """Плановое обновление всех загруженных расписаний: скачивание и разбор параллельно,
+    затем все потоки подменяются разом и рассылаются изменения"""
+    logging.info("🔄 Плановое обновление расписаний...")
+    cache_keys = list(events_cache)
+    downloads = await download_sources(cache_keys)
+
+    # В пул процессов уходят только изменившиеся файлы
+    items = []
+    for cache_key, data in downloads.items():
+        course, stream = cache_key.split('_', 1)
+        if not isinstance(data, BaseException) and read_snapshot_hash(course, stream) != ics_content_hash(data):
+            items.append((course, stream, data))
+    parsed = await parse_calendars(items)
+    # Поток, который не удалось разобрать, остается со старым расписанием до следующего обновления
+    failed = {f"{course}_{stream}" for course, stream, _ in items} - set(parsed)
+
+    all_changes = {}
+    for cache_key, data in downloads.items():
+        course, stream = cache_key.split('_', 1)
+        if isinstance(data, BaseException):
+            if isinstance(data, SourceUnavailable) and cache_key in events_cache:
+                stale_streams.add(cache_key)
+            logging.error("❌ Ошибка обновления расписания %s: %s", cache_key, data)
+            continue
+        if cache_key not in events_cache or cache_key in failed:
+            continue
+        try:
+            all_changes[cache_key] = apply_calendar_update(course, stream, data, parsed.get(cache_key))
+        except Exception as e:
+            logging.error("❌ Ошибка обновления расписания %s: %s", cache_key, e)
+
+    for cache_key, changes in all_changes.items():
+        course, stream = cache_key.split('_', 1)
+        await notify_schedule_changes(course, stream, changes)
+
+# === КЭШ ОТРИСОВАННЫХ ДНЕЙ ===
+def render_day(course, stream, date, english_time=None, is_tomorrow=False):
+    """Текст дня из кэша; при промахе форматирует день по индексу"""
+    cache_key = f"{course}_{stream}"
+    view_key = (cache_key, date, english_time, is_tomorrow)
+    text = rendered_view_cache.get(view_key)
+    if text is None:
+        day_events = get_day_index(course, stream).get(date, [])
+        text = format_day(date, day_events, course, stream, english_time, is_tomorrow)
+        if cache_key in events_cache:
+            rendered_view_cache[view_key] = text
+    return text
+
+def invalidate_rendered_views(cache_key, dates=None):
+    """Сбрасывает отрисованные дни потока (все или только указанные даты), его ленту пар,
+    страницы периодов, список ДЗ и ICS-фиды"""
+    for timeline_key in [key for key in timeline_cache if key[0] == cache_key]:
+        del timeline_cache[timeline_key]
+    for variant in [key for key in feed_cache if key[0] == cache_key]:
+        del feed_cache[variant]
+    for variant in [key for key in feed_files if key[0] == cache_key]:
+        del feed_files[variant]
+    for view_key in [key for key in period_page_cache if key[0] == cache_key]:
+        del period_page_cache[view_key]
+    homework_index_cache.pop(cache_key, None)
+    for view_key in [key for key in homework_page_cache if key[0] == cache_key]:
+        del homework_page_cache[view_key]
+
+    stale = [
+        view_key for view_key in rendered_view_cache
+        if view_key[0] == cache_key and (dates is None or view_key[1] in dates)
+    ]
+    for view_key in stale:
+        del rendered_view_cache[view_key]
+
+# === ПОСТРАНИЧНЫЕ ПРОСМОТРЫ: НЕДЕЛЯ, МЕСЯЦ, СЕМЕСТР ===
+PERIOD_TITLES = {
+    "week": "📊 Эта неделя",
+    "nextweek": "📊 Следующая неделя",
+    "month": "🗓 Месяц",
+    "semester": "🎓 До конца семестра",
+}
+# Запас под заголовок страницы и пометку об устаревшем расписании
+PERIOD_PAGE_LIMIT = MAX_MESSAGE_LENGTH - 300
+
+def period_range(kind, today, day_index):
+    """Первый и последний день периода"""
+    if kind == "week":
+        return get_week_range(today)
+    if kind == "nextweek":
+        return get_week_range(today + datetime.timedelta(days=7 - today.weekday()))
+    if kind == "month":
+        start = today.replace(day=1)
+        end = (start + datetime.timedelta(days=32)).replace(day=1) - datetime.timedelta(days=1)
+        return start, end
+    return today, day_index_bounds(day_index)[1] if day_index else today
+
+def iter_period_days(course, stream, kind, start_date, end_date, english_time=None):
+    """Лениво отдает тексты дней периода; месяц и семестр пропускают дни без пар"""
+    if kind in ("week", "nextweek"):
+        date = start_date
+        while date <= end_date:
+            yield render_day(course, stream, date, english_time)
+            date += datetime.timedelta(days=1)
+        return
+
+    day_index = get_day_index(course, stream)
+    if isinstance(day_index, RecurringDayIndex):
+        # Разворачиваются только недели периода
+        day_index.expand_range(start_date, end_date)
+        dates = {date for date in day_index.buckets if start_date <= date <= end_date}
+    else:
+        dates = sorted(day_index)
+        dates = set(dates[bisect.bisect_left(dates, start_date):bisect.bisect_right(dates, end_date)])
+    # Английский по четвергам — как в get_timeline, только в пределах семестра
+    if english_time and day_index:
+        first_date, last_date = day_index_bounds(day_index)
+        first, last = max(start_date, first_date), min(end_date, last_date)
+        date = first + datetime.timedelta(days=(3 - first.weekday()) % 7)
+        while date <= last:
+            dates.add(date)
+            date += datetime.timedelta(days=7)
+
+    for date in sorted(dates):
+        text = render_day(course, stream, date, english_time)
+        if not text.endswith("занятий нет\n"):
+            yield text
+
+def split_lines(text, limit):
+    """Режет текст по строкам на куски не длиннее limit"""
+    chunk = ""
+    for line in text.splitlines(keepends=True):
+        while len(line) > limit:
+            if chunk:
+                yield chunk
+                chunk = ""
+            yield line[:limit]
+            line = line[limit:]
+        if len(chunk) + len(line) > limit:
+            yield chunk
+            chunk = ""
+        chunk += line
+    if chunk:
+        yield chunk
+
+def paginate_days(day_texts, limit=PERIOD_PAGE_LIMIT):
+    """Собирает дни в страницы, разрывая только по границам дней.
+
+    День длиннее страницы (редкость) режется по строкам.
+    """
+    page = ""
+    for text in day_texts:
+        for block in (split_lines(text, limit) if len(text) > limit else (text,)):
+            if page and len(page) + len(block) > limit:
+                yield page
+                page = ""
+            page += block
+    if page:
+        yield page
+
+def get_period_page(course, stream, kind, page, english_time=None, today=None):
+    """(текст страницы, есть ли следующая, границы периода).
+
+    Страницы генерируются по мере листания и остаются в кэше до сброса потока.
+    """
+    cache_key = f"{course}_{stream}"
+    today = today or clock.today()
+    start_date, end_date = period_range(kind, today, get_day_index(course, stream))
+    view_key = (cache_key, kind, english_time, start_date, end_date)
+
+    view = period_page_cache.get(view_key)
+    if view is None:
+        pages = paginate_days(iter_period_days(course, stream, kind, start_date, end_date, english_time))
+        view = {"pages": [], "generator": pages}
+        if cache_key in events_cache:
+            for old_key in [key for key in period_page_cache if key[:3] == view_key[:3]]:
+                del period_page_cache[old_key]
+            period_page_cache[view_key] = view
+
+    # Догенерируем на одну страницу вперед, чтобы знать, нужна ли кнопка ▶
+    while view["generator"] is not None and len(view["pages"]) <= page + 1:
+        next_page = next(view["generator"], None)
+        if next_page is None:
+            view["generator"] = None
+        else:
+            view["pages"].append(next_page)
+
+    pages = view["pages"]
+    page = max(0, min(page, len(pages) - 1))
+    text = pages[page] if pages else "В этот период занятий нет\n"
+    return text, page, page + 1 < len(pages), (start_date, end_date)
 
-                if not all([summary_match, dtstart_match, dtend_match]):
+def build_period_view(course, stream, kind, page, english_time=None):
+    """Текст и клавиатура страницы периода с навигацией ◀/▶"""
+    text, page, has_next, (start_date, end_date) = get_period_page(course, stream, kind, page, english_time)
+
+    header = f"{PERIOD_TITLES[kind]} ({start_date.strftime('%d.%m')}–{end_date.strftime('%d.%m')})"
+    if page or has_next:
+        header += f", стр. {page + 1}"
+    text = schedule_status(course, stream, f"{header}\n\n{text}")
+
+    navigation = []
+    if page:
+        navigation.append(InlineKeyboardButton("◀", callback_data=f"period_{kind}_{course}_{stream}_{page - 1}"))
+    if has_next:
+        navigation.append(InlineKeyboardButton("▶", callback_data=f"period_{kind}_{course}_{stream}_{page + 1}"))
+
+    keyboard = [navigation] if navigation else []
+    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data=f"back_to_menu_{course}_{stream}")])
+    return text, InlineKeyboardMarkup(keyboard)
+
+# === ТЕКУЩАЯ И СЛЕДУЮЩАЯ ПАРА ===
+WEEKDAYS_SHORT_RU = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+
+def get_timeline(course, stream, english_time=None):
+    """Пары потока, отсортированные по началу: (начала, концы, события).
+
+    Учитывает вставку английского по четвергам, как events_for_day.
+    """
+    cache_key = f"{course}_{stream}"
+    timeline_key = (cache_key, english_time)
+    timeline = timeline_cache.get(timeline_key)
+    if timeline is not None:
+        return timeline
+
+    day_index = get_day_index(course, stream)
+    events = []
+    for date, bucket in day_index.items():
+        events.extend(events_for_day(bucket, date, english_time))
+
+    # Английский ставится и в четверги без других пар — в пределах семестра
+    if english_time and day_index:
+        first, last = min(day_index), max(day_index)
+        date = first + datetime.timedelta(days=(3 - first.weekday()) % 7)
+        while date <= last:
+            if date not in day_index:
+                events.extend(events_for_day([], date, english_time))
+            date += datetime.timedelta(days=7)
+
+    events = [event for event in events if not is_lunch_break(event)]
+    events.sort(key=lambda event: event['start_ts'])
+    timeline = (
+        array('q', (event['start_ts'] for event in events)),
+        array('q', (event['end_ts'] for event in events)),
+        events
+    )
+    if cache_key in events_cache:
+        timeline_cache[timeline_key] = timeline
+    return timeline
+
+def find_current_and_next(course, stream, english_time, now_ts):
+    """Текущая (или None) и следующая (или None) пары за O(log n)"""
+    starts, ends, events = get_timeline(course, stream, english_time)
+    position = bisect.bisect_right(starts, now_ts)
+    current = events[position - 1] if position and ends[position - 1] > now_ts else None
+    upcoming = events[position] if position < len(events) else None
+    return current, upcoming
+
+def format_duration(seconds):
+    minutes = max(seconds // 60, 1)
+    days, minutes = divmod(minutes, 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+    parts = []
+    if days:
+        parts.append(f"{days} дн")
+    if hours:
+        parts.append(f"{hours} ч")
+    if minutes and not days:
+        parts.append(f"{minutes} мин")
+    return " ".join(parts)
+
+def format_lesson_brief(event, now_ts):
+    start_ts, end_ts = event['start_ts'], event['end_ts']
+    line = f"{ts_to_hhmm(start_ts)}–{ts_to_hhmm(end_ts)} {event['summary']}"
+    if local_day(start_ts) != local_day(now_ts):
+        date = ts_to_date(start_ts)
+        line = f"{WEEKDAYS_SHORT_RU[date.weekday()]}, {date.strftime('%d.%m')} {line}"
+
+    details = []
+    if event.get('teacher'):
+        details.append(f"👤 {event['teacher']}")
+    if event.get('room'):
+        details.append(f"🏫 {event['room']}")
+    if details:
+        line += "\n  " + " | ".join(details)
+    return line
+
+def format_next_lesson(course, stream, english_time=None, now_ts=None):
+    if now_ts is None:
+        now_ts = int(clock.time())
+    current, upcoming = find_current_and_next(course, stream, english_time, now_ts)
+
+    if current is None and upcoming is None:
+        text = "📭 Больше пар в расписании нет"
+    else:
+        sections = []
+        if current is not None:
+            sections.append(
+                f"🟢 Сейчас идет:\n{format_lesson_brief(current, now_ts)}\n"
+                f"  ⏳ До конца: {format_duration(current['end_ts'] - now_ts)}"
+            )
+        if upcoming is not None:
+            sections.append(
+                f"⏭ Следующая пара:\n{format_lesson_brief(upcoming, now_ts)}\n"
+                f"  ⏳ Начнется через {format_duration(upcoming['start_ts'] - now_ts)}"
+            )
+        text = "\n\n".join(sections)
+    return schedule_status(course, stream, text)
+
+# === ПОИСК ПО ПРЕПОДАВАТЕЛЯМ И АУДИТОРИЯМ ===
+DIRECTORY_PERIODS = {"сегодня": 1, "завтра": 1, "неделя": 7}
+DIRECTORY_MAX_MATCHES = 5
+DIRECTORY_ANSWER_CACHE_SIZE = 512
+ROOM_STOPWORDS = {"zoom", "онлайн", "online", "зачет", "экзамен"}
+
+def normalize_search_key(value):
+    return value.strip().lower().replace('ё', 'е')
+
+def stream_title(course, stream):
+    """Курс и поток для заголовков: «1 курс, СДИ»; у курса с одним потоком — только курс"""
+    info = COURSES.get(course)
+    if info is None:
+        return f"{course} курс"
+    if len(info["streams"]) > 1:
+        return f"{info['name']}, {info['streams'].get(stream, stream)}"
+    return info["name"]
+
+def stream_label(course, stream):
+    info = COURSES.get(course)
+    if info is None:
+        return f"{course} курс"
+    if len(info["streams"]) > 1:
+        return info["streams"].get(stream, stream)
+    return info["name"]
+
+class PrefixIndex:
+    """Инвертированный индекс с поиском по префиксу бисекцией по отсортированным ключам"""
+
+    def __init__(self, postings):
+        self.keys = sorted(postings)
+        self.postings = postings
+
+    def search(self, prefix):
+        """Ключи, начинающиеся с prefix, и их пары"""
+        prefix = normalize_search_key(prefix)
+        position = bisect.bisect_left(self.keys, prefix)
+        matches = []
+        for key in itertools.islice(self.keys, position, None):
+            if not key.startswith(prefix):
+                break
+            matches.append((key, self.postings[key]))
+        return matches
+
+def split_room(room):
+    """Аудитории из поля места: '215/220' -> ['215', '220']; онлайн и пометки отбрасываются"""
+    tokens = []
+    for token in re.split(r"\s*[/,;]\s*", room):
+        token = token.strip().rstrip('?').strip()
+        if token and normalize_search_key(token) not in ROOM_STOPWORDS:
+            tokens.append(token)
+    return tokens
+
+def add_posting(postings, key, name, lesson):
+    entry = postings.get(key)
+    if entry is None:
+        entry = postings[key] = (name, [])
+    entry[1].append(lesson)
+
+def build_directory_index():
+    """Индексы преподаватель -> пары и аудитория -> пары по потокам, которые сейчас в памяти.
+
+    Пара, общая для нескольких потоков, попадает в индекс один раз со списком потоков.
+    Сама сборка ничего не загружает: недостающие потоки заранее поднимает ensure_all_calendars.
+    """
+    lessons = {}
+    for cache_key in list(events_cache):
+        course, stream = cache_key.split('_', 1)
+        for bucket in get_day_index(course, stream).values():
+            for event in bucket:
+                if is_lunch_break(event):
                     continue
+                key = (event['start_ts'], event['end_ts'], event['summary'],
+                       event.get('teacher', ''), event.get('room', ''))
+                lessons.setdefault(key, []).append(stream_label(course, stream))
+
+    teachers, rooms = {}, {}
+    for lesson in sorted((key + (labels,) for key, labels in lessons.items()), key=lambda lesson: lesson[0]):
+        teacher, room = lesson[3], lesson[4]
+        if teacher:
+            add_posting(teachers, normalize_search_key(teacher), teacher, lesson)
+        for token in split_room(room):
+            add_posting(rooms, normalize_search_key(token), token, lesson)
+
+    return {"teacher": PrefixIndex(teachers), "room": PrefixIndex(rooms)}
+
+def get_directory_index():
+    global directory_index, directory_index_version
+    # Индекс зависит и от версии расписания, и от набора потоков в памяти
+    version = (schedule_version, frozenset(events_cache))
+    if directory_index is None or directory_index_version != version:
+        directory_index = build_directory_index()
+        directory_index_version = version
+        directory_answer_cache.clear()
+    return directory_index
+
+def bump_schedule_version():
+    """Отмечает, что расписание какого-то потока изменилось (для индексов поиска)"""
+    global schedule_version
+    schedule_version += 1
+
+def format_directory_lessons(lessons, start_ts, end_ts, show_teacher):
+    starts = [lesson[0] for lesson in lessons]
+    position = bisect.bisect_left(starts, start_ts)
+    text = ""
+    current_day = None
+    for lesson in itertools.islice(lessons, position, None):
+        lesson_start, lesson_end, summary, teacher, room, labels = lesson
+        if lesson_start >= end_ts:
+            break
+        day = local_day(lesson_start)
+        if day != current_day:
+            current_day = day
+            date = day_to_date(day)
+            text += f"\n📅 {WEEKDAYS_SHORT_RU[date.weekday()]}, {date.strftime('%d.%m')}\n"
+        line = f"  {ts_to_hhmm(lesson_start)}–{ts_to_hhmm(lesson_end)} {summary}"
+        extra = f"👤 {teacher}" if show_teacher else f"🏫 {room}"
+        if (teacher if show_teacher else room):
+            line += f" | {extra}"
+        text += f"{line} ({', '.join(labels)})\n"
+    return text
 
-                original_summary = summary_match.group(1).strip()
-                summary = get_display_subject_name(course, stream, original_summary)
+def directory_answer(kind, query, period):
+    """Ответ на /teacher и /room; кэшируется до изменения расписания"""
+    get_directory_index()
+    today = clock.today()
+    cache_key = (kind, normalize_search_key(query), period, today)
+    text = directory_answer_cache.get(cache_key)
+    if text is not None:
+        directory_answer_cache.move_to_end(cache_key)
+        return text
+
+    matches = directory_index[kind].search(query)
+    if kind == "room":
+        exact = [match for match in matches if match[0] == normalize_search_key(query)]
+        matches = exact or matches
+    title = "👤 Преподаватель" if kind == "teacher" else "🏫 Аудитория"
+
+    if not matches:
+        not_found = "не найден" if kind == "teacher" else "не найдена"
+        text = f"{title} «{query}» {not_found} в расписании"
+    elif len(matches) > DIRECTORY_MAX_MATCHES:
+        names = ", ".join(name for _, (name, _) in matches[:DIRECTORY_MAX_MATCHES])
+        text = f"Найдено совпадений: {len(matches)}. Уточни запрос, например: {names}"
+    else:
+        first_day = today + datetime.timedelta(days=1) if period == "завтра" else today
+        start_ts = date_to_ts(first_day)
+        end_ts = date_to_ts(first_day + datetime.timedelta(days=DIRECTORY_PERIODS[period]))
+        text = ""
+        for _, (name, lessons) in matches:
+            lessons_text = format_directory_lessons(lessons, start_ts, end_ts, show_teacher=kind == "room")
+            text += f"{title}: {name} — {period}\n"
+            text += lessons_text if lessons_text else "Пар нет\n"
+            text += "\n"
+        text = text.strip()
+
+    if len(text) > MAX_MESSAGE_LENGTH:
+        cut = text.rfind("\n", 0, MAX_MESSAGE_LENGTH - 2)
+        text = text[:cut if cut > 0 else MAX_MESSAGE_LENGTH - 2] + "\n…"
+
+    directory_answer_cache[cache_key] = text
+    if len(directory_answer_cache) > DIRECTORY_ANSWER_CACHE_SIZE:
+        directory_answer_cache.popitem(last=False)
+    return text
 
-                start_str = dtstart_match.group(1)
-                end_str = dtend_match.group(1)
-                description = description_match.group(1).strip() if description_match else ""
+# === СВОБОДНОЕ ВРЕМЯ И ПЕРЕСЕЧЕНИЯ ===
+FREE_DAY_START = (9, 0)
+FREE_DAY_END = (21, 0)
+FREE_MIN_SLOT = 30 * 60
+FREE_MAX_DAYS = 14
+
+class IntervalIndex:
+    """Занятые интервалы, слитые в непересекающиеся и отсортированные по началу"""
+
+    def __init__(self, intervals):
+        self.starts = array('q')
+        self.ends = array('q')
+        for start, end in sorted(intervals):
+            if self.ends and start <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def busy_between(self, start, end):
+        """Занятые интервалы, пересекающиеся с [start, end)"""
+        position = bisect.bisect_right(self.ends, start)
+        result = []
+        while position < len(self.starts) and self.starts[position] < end:
+            result.append((self.starts[position], self.ends[position]))
+            position += 1
+        return result
+
+    def is_free(self, start, end):
+        return not self.busy_between(start, end)
+
+def get_interval_index(kind, key):
+    """Индекс занятости потока ('stream', 'курс_поток') или аудитории ('room', номер)"""
+    global interval_index_version
+    if interval_index_version != schedule_version:
+        interval_index_cache.clear()
+        interval_index_version = schedule_version
+
+    index = interval_index_cache.get((kind, key))
+    if index is None:
+        if kind == "stream":
+            course, stream = key.split('_', 1)
+            intervals = [
+                (event['start_ts'], event['end_ts'])
+                for bucket in get_day_index(course, stream).values()
+                for event in bucket
+                if not is_lunch_break(event)
+            ]
+        else:
+            postings = get_directory_index()["room"].postings.get(key)
+            intervals = [(lesson[0], lesson[1]) for lesson in postings[1]] if postings else []
+        index = IntervalIndex(intervals)
+        interval_index_cache[(kind, key)] = index
+    return index
+
+def find_free_slots(indexes, date, min_slot=FREE_MIN_SLOT):
+    """Окна в рабочем дне, когда свободны все индексы сразу"""
+    day_start = local_to_ts(date.year, date.month, date.day, *FREE_DAY_START)
+    day_end = local_to_ts(date.year, date.month, date.day, *FREE_DAY_END)
+
+    busy = IntervalIndex(
+        interval for index in indexes for interval in index.busy_between(day_start, day_end)
+    )
+    slots = []
+    cursor = day_start
+    for start, end in zip(busy.starts, busy.ends):
+        if start - cursor >= min_slot:
+            slots.append((cursor, start))
+        cursor = max(cursor, end)
+    if day_end - cursor >= min_slot:
+        slots.append((cursor, day_end))
+    return slots
+
+def stream_aliases(course):
+    """Допустимые написания потоков курса в командах"""
+    aliases = {}
+    for stream, name in COURSES[course]["streams"].items():
+        for alias in (stream, name, name.replace(' ', ''), name.split()[0]):
+            aliases.setdefault(normalize_search_key(alias), stream)
+    return aliases
+
+def parse_day_token(token, today):
+    """'17.02', '17.02.2026', 'вт' или 'завтра' -> дата; None, если это не дата"""
+    token = normalize_search_key(token)
+    if token == "сегодня":
+        return today
+    if token == "завтра":
+        return today + datetime.timedelta(days=1)
+    weekdays = [normalize_search_key(day) for day in WEEKDAYS_SHORT_RU]
+    if token in weekdays:
+        return today + datetime.timedelta(days=(weekdays.index(token) - today.weekday()) % 7)
+    match = re.fullmatch(r"(\d{1,2})\.(\d{1,2})(?:\.(\d{4}))?", token)
+    if match:
+        return datetime.date(int(match.group(3) or today.year), int(match.group(2)), int(match.group(1)))
+    return None
+
+def free_time_answer(args, today, course):
+    """Разбирает аргументы /free и формирует ответ; потоки сравниваются внутри курса пользователя"""
+    rooms_mode = False
+    targets = []
+    first_day = last_day = None
+    at_time = None
+    course_streams = COURSES[course]["streams"]
+    aliases = stream_aliases(course)
+
+    for token in args:
+        normalized = normalize_search_key(token)
+        if normalized in ("ауд", "ауд.", "аудитории", "аудитория"):
+            rooms_mode = True
+        elif normalized == "все":
+            targets.extend(stream for stream in course_streams if stream not in targets)
+        elif re.fullmatch(r"\d{1,2}:\d{2}", normalized):
+            at_time = decode_hhmm(normalized)
+        elif '-' in normalized and all(parse_day_token(part, today) for part in normalized.split('-', 1)):
+            first_day, last_day = (parse_day_token(part, today) for part in normalized.split('-', 1))
+        elif parse_day_token(normalized, today):
+            first_day = last_day = parse_day_token(normalized, today)
+        elif rooms_mode:
+            targets.append(normalized)
+        elif normalized in aliases:
+            targets.append(aliases[normalized])
+        else:
+            return f"❌ Не понял «{token}». Потоки: {', '.join(course_streams)}; для аудиторий начни с «ауд»."
+
+    first_day = first_day or today
+    last_day = last_day or first_day
+    if last_day < first_day or (last_day - first_day).days >= FREE_MAX_DAYS:
+        return f"❌ Укажи период не длиннее {FREE_MAX_DAYS} дней"
+
+    if rooms_mode:
+        room_postings = get_directory_index()["room"].postings
+        if not targets:
+            targets = sorted(room_postings)
+        indexes = {room_postings[room][0] if room in room_postings else room: get_interval_index("room", room)
+                   for room in targets}
+    else:
+        if not targets:
+            targets = list(course_streams)
+        indexes = {stream_label(course, stream): get_interval_index("stream", f"{course}_{stream}") for stream in targets}
+
+    if at_time is not None:
+        start = local_to_ts(first_day.year, first_day.month, first_day.day, *at_time)
+        free = [name for name, index in indexes.items() if index.is_free(start, start + 60)]
+        busy = [name for name, index in indexes.items() if name not in free]
+        header = f"{WEEKDAYS_SHORT_RU[first_day.weekday()]}, {first_day.strftime('%d.%m')} в {at_time[0]:02d}:{at_time[1]:02d}"
+        text = f"🕊 Свободны {header}:\n{', '.join(free) if free else 'никто'}"
+        if busy:
+            text += f"\n\n🚫 Заняты: {', '.join(busy)}"
+        return text
+
+    text = f"🕊 Общее свободное время ({', '.join(indexes)}), {FREE_DAY_START[0]}:00–{FREE_DAY_END[0]}:00:\n"
+    date = first_day
+    while date <= last_day:
+        slots = find_free_slots(list(indexes.values()), date)
+        slots_text = ", ".join(f"{ts_to_hhmm(start)}–{ts_to_hhmm(end)}" for start, end in slots) or "нет"
+        text += f"\n📅 {WEEKDAYS_SHORT_RU[date.weekday()]}, {date.strftime('%d.%m')}: {slots_text}"
+        date += datetime.timedelta(days=1)
+    return text
 
-                start_dt = datetime.datetime.strptime(start_str, '%Y%m%dT%H%M%S')
-                end_dt = datetime.datetime.strptime(end_str, '%Y%m%dT%H%M%S')
+def find_edit_conflicts(course, stream, date_str, edit):
+    """Пары, с которыми пересекается новое событие из правок (в потоке и в его аудитории)"""
+    date = decode_iso_date(date_str)
+    start = local_to_ts(date.year, date.month, date.day, *decode_hhmm(edit['start_time']))
+    end = local_to_ts(date.year, date.month, date.day, *decode_hhmm(edit['end_time']))
+
+    conflicts = []
+    for event in get_day_index(course, stream).get(date, []):
+        is_itself = (not event.get('uid') and event['summary'] == edit['new_summary']
+                     and event['start_ts'] == start and event['end_ts'] == end)
+        if not is_itself and not is_lunch_break(event) and event['start_ts'] < end and start < event['end_ts']:
+            conflicts.append(f"{ts_to_hhmm(event['start_ts'])}–{ts_to_hhmm(event['end_ts'])} {event['summary']}")
+
+    # Индекс аудиторий собран из расписания с правками, то есть уже содержит само новое событие
+    _, room = extract_teacher_and_room(edit.get('new_desc', ''))
+    room_postings = get_directory_index()["room"].postings
+    label = stream_label(course, stream)
+    for token in split_room(room):
+        postings = room_postings.get(normalize_search_key(token))
+        for lesson_start, lesson_end, summary, _, _, labels in postings[1] if postings else []:
+            if lesson_start >= end:
+                break
+            is_itself = (lesson_start, lesson_end, summary) == (start, end, edit['new_summary']) and label in labels
+            if not is_itself and start < lesson_end:
+                conflicts.append(f"аудитория {token} занята")
+                break
+    return conflicts
+
+def check_schedule_edits_conflicts(edits):
+    """Предупреждения о пересечениях для всех новых событий в правках"""
+    warnings = []
+    for cache_key, stream_edits in edits.items():
+        course, stream = cache_key.split('_', 1)
+        for date_str, date_edits in stream_edits.items():
+            for edit in date_edits.values():
+                if not (edit.get("new", False) and "start_time" in edit):
+                    continue
+                try:
+                    conflicts = find_edit_conflicts(course, stream, date_str, edit)
+                except (ValueError, KeyError) as e:
+                    warnings.append(f"{cache_key} {date_str}: неверная правка ({e})")
+                    continue
+                if conflicts:
+                    warnings.append(
+                        f"{cache_key} {date_str} {edit['start_time']}–{edit['end_time']} {edit['new_summary']}: "
+                        + "; ".join(conflicts)
+                    )
+    return warnings
+
+# === ПАКЕТНЫЙ ИМПОРТ ПРАВОК И ДЗ ===
+# Строка документа: type (delete | rename | new | homework), course, stream (по умолчанию — поток
+# помощника), date (YYYY-MM-DD или ДД.ММ.ГГГГ), subject, time, end_time, new_subject, desc, text
+IMPORT_COLUMNS = ("type", "course", "stream", "date", "subject", "time", "end_time", "new_subject", "desc", "text")
+IMPORT_TYPES = ("delete", "rename", "new", "homework")
+IMPORT_MAX_SIZE = 1024 * 1024
+IMPORT_MAX_ERRORS = 20
+IMPORT_MODES = {"проверка": "check", "check": "check", "принять": "accept", "accept": "accept"}
+
+def parse_import_document(filename, raw):
+    """Строки CSV или JSON-документа как словари с номером строки; ValueError для битого файла"""
+    try:
+        text = raw.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise ValueError("файл должен быть в кодировке UTF-8")
 
-                start_dt = TIMEZONE.localize(start_dt)
-                end_dt = TIMEZONE.localize(end_dt)
+    if filename.lower().endswith(".json") or text.lstrip()[:1] in ("[", "{"):
+        try:
+            data = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"неверный JSON: {e}")
+        if isinstance(data, dict):
+            data = data.get("rows")
+        if not isinstance(data, list) or not all(isinstance(row, dict) for row in data):
+            raise ValueError("JSON должен быть списком объектов или {\"rows\": [...]}")
+        rows = [(number, row) for number, row in enumerate(data, 1)]
+    else:
+        try:
+            dialect = csv.Sniffer().sniff(text.split("\n", 1)[0], delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        reader = csv.DictReader(io.StringIO(text), dialect=dialect)
+        if not reader.fieldnames or "type" not in [name.strip().lower() for name in reader.fieldnames]:
+            raise ValueError("в первой строке CSV нужен заголовок с колонкой type")
+        # Номер строки — как в редакторе таблиц, с учетом заголовка
+        rows = [(reader.line_num, row) for row in reader]
+
+    normalized = []
+    for number, row in rows:
+        row = {str(column).strip().lower(): value for column, value in row.items() if column}
+        normalized.append((number, {column: str(row.get(column) or "").strip() for column in IMPORT_COLUMNS}))
+    return normalized
+
+def parse_import_date(value):
+    if "." in value:
+        return datetime.datetime.strptime(value, "%d.%m.%Y").date()
+    return decode_iso_date(value)
+
+def find_import_event(events, course, stream, subject, start_time):
+    """Пара дня по названию (исходному или переименованному) и времени начала"""
+    original = get_original_subject_name(course, stream, subject)
+    for event in events:
+        if (event['original_summary'] in (original, subject) or event['summary'] == subject) \
+                and (not start_time or ts_to_hhmm(event['start_ts']) == start_time):
+            return event
+    return None
+
+def stage_import_row(row, default_course, default_stream, staged_edits, staged_homeworks, added_edits):
+    """Проверяет строку по разобранному расписанию и вносит ее в черновые копии правок и ДЗ"""
+    kind = row["type"].lower()
+    if kind not in IMPORT_TYPES:
+        raise ValueError(f"неизвестный type '{row['type']}', ожидается {', '.join(IMPORT_TYPES)}")
+
+    course = row["course"] or default_course
+    stream = row["stream"] or default_stream
+    if stream not in STREAM_URLS.get(course, {}):
+        raise ValueError(f"нет потока {course}_{stream}")
+    cache_key = f"{course}_{stream}"
 
-                events.append({
-                    'summary': summary,
-                    'original_summary': original_summary,
-                    'start': start_dt,
-                    'end': end_dt,
-                    'desc': description
-                })
-            except Exception as e:
-                logging.warning(f"Ошибка парсинга события: {e}")
+    if not row["date"]:
+        raise ValueError("не указана дата")
+    date = parse_import_date(row["date"])
+    date_str = date.isoformat()
+    if row["time"]:
+        row["time"] = "%02d:%02d" % decode_hhmm(row["time"])
+
+    if cache_key not in staged_edits:
+        staged_edits[cache_key] = json.loads(json.dumps(schedule_edits.get(cache_key, {})))
+    date_edits = staged_edits[cache_key].setdefault(date_str, {})
+
+    if kind == "new":
+        if not (row["new_subject"] or row["subject"]) or not row["time"] or not row["end_time"]:
+            raise ValueError("для new нужны new_subject, time и end_time")
+        end_time = "%02d:%02d" % decode_hhmm(row["end_time"])
+        if end_time <= row["time"]:
+            raise ValueError("end_time раньше начала")
+        summary = row["new_subject"] or row["subject"]
+        edit = {"new": True, "new_summary": summary, "start_time": row["time"], "end_time": end_time}
+        if row["desc"]:
+            edit["new_desc"] = row["desc"]
+        event_key = f"{summary}[{row['time']}]"
+        date_edits[event_key] = edit
+        added_edits.setdefault(cache_key, {}).setdefault(date_str, {})[event_key] = edit
+        return kind
+
+    if kind == "homework":
+        if not row["subject"] or not row["text"]:
+            raise ValueError("для homework нужны subject и text")
+        # ДЗ можно задать и к паре, добавленной этим же документом
+        lessons = apply_day_edits(date_str, date_edits, base_day_index_cache.get(cache_key, {}).get(date, []))
+        event = find_import_event(lessons, course, stream, row["subject"], row["time"])
+        if event is None:
+            raise ValueError(f"{date.strftime('%d.%m.%Y')} нет пары «{row['subject']}»")
+        if cache_key not in staged_homeworks:
+            staged_homeworks[cache_key] = load_homeworks(course, stream)
+        staged_homeworks[cache_key][f"{event['original_summary']}|{date_str}"] = row["text"]
+        return kind
+
+    if not row["subject"] or not row["time"]:
+        raise ValueError(f"для {kind} нужны subject и time")
+    event = find_import_event(base_day_index_cache.get(cache_key, {}).get(date, []), course, stream, row["subject"], row["time"])
+    if event is None:
+        raise ValueError(f"в расписании {date.strftime('%d.%m.%Y')} {row['time']} нет пары «{row['subject']}»")
+    event_key = f"{event['original_summary']}[{row['time']}]"
+    if kind == "delete":
+        date_edits[event_key] = {"deleted": True}
+    else:
+        if not row["new_subject"]:
+            raise ValueError("для rename нужен new_subject")
+        edit = {"new_summary": row["new_subject"]}
+        if row["desc"]:
+            edit["new_desc"] = row["desc"]
+        date_edits[event_key] = edit
+    return kind
+
+def stage_import(rows, default_course, default_stream):
+    """Проверяет все строки; возвращает черновики правок и ДЗ, счетчики, ошибки и новые события"""
+    staged_edits, staged_homeworks, added_edits = {}, {}, {}
+    counts = dict.fromkeys(IMPORT_TYPES, 0)
+    errors = []
+    for number, row in rows:
+        course = row["course"] or default_course
+        stream = row["stream"] or default_stream
+        # Проверка идет по разобранному календарю; import_document уже поднял поток в память
+        if stream in STREAM_URLS.get(course, {}):
+            load_events_from_github(course, stream)
+        try:
+            counts[stage_import_row(row, default_course, default_stream, staged_edits, staged_homeworks, added_edits)] += 1
+        except (ValueError, KeyError) as e:
+            errors.append(f"строка {number}: {e}")
+
+    for stream_edits in staged_edits.values():
+        for date_str in [date_str for date_str, date_edits in stream_edits.items() if not date_edits]:
+            del stream_edits[date_str]
+    return staged_edits, staged_homeworks, counts, errors, added_edits
+
+def commit_import(staged_edits, staged_homeworks):
+    """Применяет черновики одной транзакцией: сначала все файлы пишутся во временные,
+    затем подменяются; кэши каждого потока сбрасываются один раз"""
+    global schedule_edits
+    new_edits = dict(schedule_edits)
+    new_edits.update({cache_key: stream_edits for cache_key, stream_edits in staged_edits.items() if stream_edits})
+    for cache_key in [cache_key for cache_key, stream_edits in staged_edits.items() if not stream_edits]:
+        new_edits.pop(cache_key, None)
+
+    files = {f"homeworks_{cache_key}.json": homeworks for cache_key, homeworks in staged_homeworks.items()}
+    if staged_edits:
+        files[SCHEDULE_EDITS_FILE] = new_edits
+    for path, data in files.items():
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+    for path in files:
+        os.replace(path + ".tmp", path)
+        remember_data_file(path)
+
+    schedule_edits = new_edits
+    for cache_key in set(staged_edits) | set(staged_homeworks):
+        if cache_key in staged_edits:
+            day_index_cache.pop(cache_key, None)
+        invalidate_rendered_views(cache_key)
+    if staged_edits:
+        bump_schedule_version()
+
+async def import_document(filename, raw, default_course, default_stream, dry_run=False, accept_conflicts=False):
+    """Разбирает, проверяет и (если ошибок нет) применяет документ; возвращает текст отчета.
+
+    Новые пары, пересекающиеся с расписанием, показываются до применения: такой документ
+    применяется, только если accept_conflicts.
+    """
+    try:
+        rows = parse_import_document(filename, raw)
+    except ValueError as e:
+        return f"❌ Не удалось прочитать файл: {e}"
+    if not rows:
+        return "❌ В файле нет строк"
+
+    # Календари упомянутых потоков загружаются вне цикла событий, проверка строк идет по кэшу
+    for course, stream in {(row["course"] or default_course, row["stream"] or default_stream) for _, row in rows}:
+        await ensure_calendar(course, stream)
+    staged_edits, staged_homeworks, counts, errors, added_edits = stage_import(rows, default_course, default_stream)
+    summary = (f"Удалений: {counts['delete']}, переименований: {counts['rename']}, "
+               f"новых пар: {counts['new']}, ДЗ: {counts['homework']}")
+    if errors:
+        text = f"❌ Импорт отклонен, ничего не изменено. Ошибок: {len(errors)}\n\n"
+        text += "\n".join(errors[:IMPORT_MAX_ERRORS])
+        if len(errors) > IMPORT_MAX_ERRORS:
+            text += f"\n…и еще {len(errors) - IMPORT_MAX_ERRORS}"
+        return text
+
+    # Сверка с текущим расписанием: после применения занятость аудитории включала бы саму новую пару
+    warnings = check_schedule_edits_conflicts(added_edits)
+    if dry_run:
+        text = f"🔎 Проверка пройдена, файл не применен.\n{summary}"
+    elif warnings and not accept_conflicts:
+        text = (f"⚠️ Импорт не применен: новые пары пересекаются с расписанием.\n{summary}\n\n"
+                "Чтобы применить файл все равно, пришли его с подписью /import принять")
+    else:
+        commit_import(staged_edits, staged_homeworks)
+        text = f"✅ Импорт применен.\n{summary}"
+    if warnings:
+        text += "\n\n⚠️ Пересечения:\n" + "\n".join(warnings[:IMPORT_MAX_ERRORS])
+    return text
+
+# === ИНЛАЙН-РЕЖИМ ===
+INLINE_CACHE_TIME = 300
+INLINE_MAX_RESULTS = 10
+INLINE_SUBJECT_LESSONS = 5
+INLINE_FUZZY_CUTOFF = 0.75
+
+WEEKDAYS_RU = ["понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье"]
+
+def build_inline_day_index():
+    """Слова запроса -> день: сегодня/завтра/неделя и дни недели (полные, краткие, в винительном)"""
+    postings = {"сегодня": "today", "завтра": "tomorrow", "неделя": "week", "неделю": "week"}
+    for weekday, name in enumerate(WEEKDAYS_RU):
+        postings[name] = weekday
+        postings[normalize_search_key(WEEKDAYS_SHORT_RU[weekday])] = weekday
+    postings["среду"] = 2
+    postings["пятницу"] = 4
+    postings["субботу"] = 5
+    return PrefixIndex(postings)
+
+inline_day_index = build_inline_day_index()
+
+def get_inline_subject_index(course, stream):
+    """Слово названия предмета -> названия; пересобирается при смене расписания"""
+    cache_key = f"{course}_{stream}"
+    cached = inline_subject_index_cache.get(cache_key)
+    if cached is not None and cached[0] == schedule_version:
+        return cached[1]
+
+    postings = {}
+    for bucket in get_day_index(course, stream).values():
+        for event in bucket:
+            if is_lunch_break(event):
                 continue
+            for word in re.findall(r"\w+", normalize_search_key(event['summary'])):
+                if len(word) > 2:
+                    postings.setdefault(word, set()).add(event['summary'])
+    index = PrefixIndex(postings)
+    if cache_key in events_cache:
+        inline_subject_index_cache[cache_key] = (schedule_version, index)
+    return index
+
+def fuzzy_lookup(index, word):
+    """Значения ключей по префиксу, а при опечатке — по ближайшим ключам"""
+    matches = [value for _, value in index.search(word)]
+    if not matches:
+        keys = difflib.get_close_matches(word, index.keys, n=3, cutoff=INLINE_FUZZY_CUTOFF)
+        matches = [index.postings[key] for key in keys]
+    return matches
+
+def match_inline_query(course, stream, query):
+    """(дни, предметы), подходящие под запрос; пустой запрос — сегодня, завтра, неделя"""
+    words = re.findall(r"\w+", normalize_search_key(query))
+    if not words:
+        return ["today", "tomorrow", "week"], []
+
+    days = []
+    subjects = None
+    for word in words:
+        for target in fuzzy_lookup(inline_day_index, word):
+            if target not in days:
+                days.append(target)
+        found = set()
+        for names in fuzzy_lookup(get_inline_subject_index(course, stream), word):
+            found |= names
+        if found:
+            subjects = found if subjects is None else subjects & found
+    return days, sorted(subjects or [])
+
+def inline_day_result(course, stream, target, today, english_time=None):
+    """Карточка дня или недели; текст берется из кэша отрисованных дней"""
+    if target == "week":
+        text, _, has_next, (start_date, end_date) = get_period_page(course, stream, "week", 0, english_time, today)
+        title = f"📊 Неделя {start_date.strftime('%d.%m')}–{end_date.strftime('%d.%m')}"
+        if has_next:
+            text += "…\n"
+        return f"week_{start_date.isoformat()}", title, text
+
+    if target == "today":
+        date, title = today, "📅 Сегодня"
+    elif target == "tomorrow":
+        date, title = today + datetime.timedelta(days=1), "📅 Завтра"
+    else:
+        date = today + datetime.timedelta(days=(target - today.weekday()) % 7)
+        title = f"📅 {WEEKDAYS_RU[target].capitalize()}"
+    text = render_day(course, stream, date, english_time, is_tomorrow=target == "tomorrow")
+    return f"day_{date.isoformat()}", f"{title}, {date.strftime('%d.%m')}", text
+
+def inline_subject_result(course, stream, subject, now_ts, english_time=None):
+    """Карточка ближайших пар предмета"""
+    starts, _, events = get_timeline(course, stream, english_time)
+    position = bisect.bisect_left(starts, now_ts)
+    lessons = [event for event in itertools.islice(events, position, None) if event['summary'] == subject]
+    lessons = lessons[:INLINE_SUBJECT_LESSONS]
+    if lessons:
+        text = f"📚 {subject}\n\n" + "\n".join(format_lesson_brief(event, now_ts) for event in lessons)
+    else:
+        text = f"📚 {subject}\n\nБольше пар в этом семестре нет"
+    subject_id = hashlib.sha1(subject.encode("utf-8")).hexdigest()[:16]
+    return f"subject_{subject_id}", f"📚 {subject}", text
+
+# === ЛИЧНЫЙ ICS-ФИД ===
+# Для каждого варианта (курс, поток, время английского) заранее собирается файл
+# feeds/<вариант>.<хэш>.ics; встроенный HTTP-сервер отдает его с ETag и 304.
+# feed_files помнит актуальный файл варианта: выгруженный поток отдается с диска без пересборки.
+def ics_escape(value):
+    return (value.replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\n', '\\n'))
+
+def ics_fold(line):
+    """Переносит строку ICS по 75 байт, не разрывая символы UTF-8"""
+    if len(line.encode("utf-8")) <= 75:
+        return line
+    parts = []
+    current, current_size = "", 0
+    limit = 75
+    for char in line:
+        size = len(char.encode("utf-8"))
+        if current_size + size > limit:
+            parts.append(current)
+            current, current_size = "", 0
+            limit = 74
+        current += char
+        current_size += size
+    parts.append(current)
+    return "\r\n ".join(parts)
+
+def ts_to_ics_utc(ts):
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+def build_ics_feed(course, stream, english_time=None):
+    """ICS с учетом правок, переименований, английского и ДЗ в описании"""
+    _, _, events = get_timeline(course, stream, english_time)
+    homeworks = load_homeworks(course, stream)
+    stamp = ts_to_ics_utc(int(clock.time()))
+
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//GAUGN schedule bot//RU",
+        "CALSCALE:GREGORIAN",
+        "METHOD:PUBLISH",
+        f"X-WR-CALNAME:{ics_escape(f'Расписание: {stream_title(course, stream)}')}",
+        "X-WR-TIMEZONE:Europe/Moscow",
+    ]
+    for event in events:
+        start_ts, end_ts = event['start_ts'], event['end_ts']
+        description = event.get('desc', '')
+        homework = homeworks.get(f"{event.get('original_summary', event['summary'])}|{ts_to_date(start_ts).isoformat()}")
+        if homework:
+            description = f"{description}\n\nДЗ: {homework}".strip()
+        uid = event.get('uid') or f"{start_ts}-{hashlib.sha1(event['summary'].encode('utf-8')).hexdigest()[:12]}@gaugn-bot"
+
+        lines += [
+            "BEGIN:VEVENT",
+            f"UID:{ics_escape(uid)}",
+            f"DTSTAMP:{stamp}",
+            f"DTSTART:{ts_to_ics_utc(start_ts)}",
+            f"DTEND:{ts_to_ics_utc(end_ts)}",
+            f"SUMMARY:{ics_escape(event['summary'])}",
+        ]
+        if event.get('room'):
+            lines.append(f"LOCATION:{ics_escape(event['room'])}")
+        if description:
+            lines.append(f"DESCRIPTION:{ics_escape(description)}")
+        lines.append("END:VEVENT")
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(ics_fold(line) for line in lines) + "\r\n"
+
+def get_feed(course, stream, english_time=None):
+    """(содержимое, ETag) варианта фида; пересобирается только после сброса"""
+    variant = (f"{course}_{stream}", english_time)
+    feed = feed_cache.get(variant)
+    if feed is not None:
+        return feed
+
+    # Хэш считается без DTSTAMP, чтобы ETag менялся только вместе с расписанием
+    body = build_ics_feed(course, stream, english_time).encode("utf-8")
+    digest = hashlib.sha256(re.sub(rb"DTSTAMP:\S+", b"", body)).hexdigest()[:16]
+    feed = (body, f'"{digest}"')
+    if f"{course}_{stream}" not in events_cache:
+        # Поток не загрузился — такой фид не сохраняется, иначе пустой календарь отдавался бы и дальше
+        return feed
+
+    name = f"{course}_{stream}_{english_time or 'none'}"
+    path = os.path.join(FEED_DIR, f"{name}.{digest}.ics")
+    try:
+        os.makedirs(FEED_DIR, exist_ok=True)
+        if not os.path.exists(path):
+            for old_path in glob.glob(os.path.join(FEED_DIR, f"{name}.*.ics")):
+                os.remove(old_path)
+            with open(path, "wb") as f:
+                f.write(body)
+    except OSError as e:
+        logging.warning("Не удалось сохранить фид %s: %s", name, e)
+    else:
+        feed_files[variant] = (path, feed[1])
 
-        events_cache[cache_key] = events
-        logging.info(f"Успешно загружено {len(events)} событий для курса {course}, потока {stream}")
-        return apply_schedule_edits(course, stream, events)
+    feed_cache[variant] = feed
+    return feed
+
+def read_feed_file(path, etag):
+    try:
+        with open(path, "rb") as f:
+            return f.read(), etag
+    except OSError:
+        return None
 
+async def serve_feed(course, stream, english_time=None):
+    """Фид для HTTP-ответа, не блокируя цикл событий: из памяти, с диска или собранный
+    после загрузки потока в пуле потоков; None, если поток загрузить не удалось"""
+    variant = (f"{course}_{stream}", english_time)
+    feed = feed_cache.get(variant)
+    if feed is not None:
+        return feed
+    feed_file = feed_files.get(variant)
+    if feed_file is not None:
+        feed = await asyncio.get_running_loop().run_in_executor(None, read_feed_file, *feed_file)
+        if feed is not None:
+            return feed
+    await ensure_calendar(course, stream)
+    if f"{course}_{stream}" not in events_cache:
+        return None
+    return get_feed(course, stream, english_time)
+
+def pregenerate_feeds():
+    """Собирает фиды всех вариантов для загруженных потоков"""
+    for cache_key in list(events_cache):
+        course, stream = cache_key.split('_', 1)
+        for english_time in (None, "morning", "afternoon"):
+            get_feed(course, stream, english_time)
+
+def feed_token(user_id):
+    return hmac.new((BOT_TOKEN or "").encode("utf-8"), str(user_id).encode("utf-8"), hashlib.sha256).hexdigest()[:20]
+
+def feed_url(user_id):
+    return f"{FEED_BASE_URL}/feed/{user_id}/{feed_token(user_id)}.ics"
+
+def resolve_feed_path(path):
+    """/feed/<user_id>/<token>.ics или /feed/<курс>_<поток>_<morning|afternoon|none>.ics"""
+    match = re.fullmatch(r"/feed/(\d+)/([0-9a-f]+)\.ics", path)
+    if match:
+        user_id, token = match.groups()
+        settings = user_settings.get(user_id)
+        if not settings or not hmac.compare_digest(token, feed_token(user_id)):
+            return None
+        if not settings.get('course') or not settings.get('stream'):
+            return None
+        return settings['course'], settings['stream'], settings.get('english_time')
+
+    match = re.fullmatch(r"/feed/([^_/]+)_([^_/]+)_(morning|afternoon|none)\.ics", path)
+    if match:
+        course, stream, english_time = match.groups()
+        if stream in STREAM_URLS.get(course, {}):
+            return course, stream, None if english_time == "none" else english_time
+    return None
+
+async def handle_feed_request(reader, writer):
+    """Минимальный HTTP/1.1: GET/HEAD, ETag, If-None-Match -> 304"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=10)
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout=10)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        parts = request_line.decode("latin-1").split()
+        method, path = (parts[0], parts[1].split('?', 1)[0]) if len(parts) >= 2 else ("", "")
+        variant = resolve_feed_path(path) if method in ("GET", "HEAD") else None
+        feed = await serve_feed(*variant) if variant is not None else None
+
+        if method not in ("GET", "HEAD"):
+            status, body, extra = "405 Method Not Allowed", b"", {"Allow": "GET, HEAD"}
+        elif variant is None:
+            status, body, extra = "404 Not Found", b"", {}
+        elif feed is None:
+            status, body, extra = "503 Service Unavailable", b"", {"Retry-After": str(FEED_RETRY_AFTER)}
+        else:
+            body, etag = feed
+            extra = {
+                "ETag": etag,
+                "Cache-Control": f"max-age={FEED_MAX_AGE}",
+                "Content-Type": "text/calendar; charset=utf-8",
+            }
+            if etag in (tag.strip() for tag in headers.get("if-none-match", "").split(",")):
+                status, body = "304 Not Modified", b""
+            else:
+                status = "200 OK"
+
+        head = [f"HTTP/1.1 {status}", f"Content-Length: {len(body)}", "Connection: close"]
+        head += [f"{name}: {value}" for name, value in extra.items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+        if method != "HEAD":
+            writer.write(body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
     except Exception as e:
-        logging.error(f"Ошибка при загрузке файла с GitHub: {e}")
-        return []
+        logging.error("❌ Ошибка при отдаче фида: %s", e)
+    finally:
+        writer.close()
+
+async def start_feed_server():
+    global feed_server
+    pregenerate_feeds()
+    feed_server = await asyncio.start_server(handle_feed_request, FEED_HOST, FEED_PORT)
+    logging.info("📡 ICS-фиды доступны на %s:%s", FEED_HOST, FEED_PORT)
 
 def get_unique_subjects(course, stream):
     events = load_events_from_github(course, stream)
@@ -369,7 +3517,7 @@ def get_subject_dates(course, stream, subject):
     dates = []
     for event in events:
         if event["summary"] == subject:
-            dates.append(event["start"].date())
+            dates.append(ts_to_date(event["start_ts"]))
     return sorted(dates)
 
 # === ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===
@@ -396,16 +3544,20 @@ def is_online_class(ev):
 
 def has_only_lunch_break(events, date):
     """Проверяет, есть ли в этот день только обеденный перерыв"""
-    day_events = [e for e in events if e["start"].date() == date]
+    day_events = [e for e in events if ts_to_date(e["start_ts"]) == date]
 
     if len(day_events) == 0:
         return False
 
-    lunch_breaks = [e for e in day_events if "обед" in e["summary"].lower() or "перерыв" in e["summary"].lower()]
+    lunch_breaks = [e for e in day_events if is_lunch_break(e)]
     return len(lunch_breaks) == len(day_events)
 
-def format_event(ev, course, stream):
-    desc = ev["desc"]
+def is_lunch_break(ev):
+    summary = ev["summary"].lower()
+    return "обед" in summary or "перерыв" in summary
+
+def extract_teacher_and_room(desc):
+    """Извлекает преподавателя и аудиторию из описания события"""
     teacher, room = "", ""
 
     # Улучшенный парсинг преподавателя
@@ -465,6 +3617,14 @@ def format_event(ev, course, stream):
         if name_match:
             teacher = name_match.group(1).strip()
 
+    return teacher, room
+
+def format_event(ev, course, stream):
+    if "teacher" in ev:
+        teacher, room = ev["teacher"], ev["room"]
+    else:
+        teacher, room = extract_teacher_and_room(ev["desc"])
+
     # ИКОНКА НОУТБУКА ТОЛЬКО ЕСЛИ ЯВНО УКАЗАНО, ЧТО ОНЛАЙН
     online_marker = " 💻" if is_online_class(ev) else ""
 
@@ -481,7 +3641,7 @@ def format_event(ev, course, stream):
             line += f"  🏫 {room}"
 
     # Добавляем домашнее задание если есть
-    date_str = ev['start'].date().isoformat()
+    date_str = ts_to_date(ev['start_ts']).isoformat()
     hw_key = f"{ev['original_summary']}|{date_str}"
     homeworks = load_homeworks(course, stream)
 
@@ -490,25 +3650,25 @@ def format_event(ev, course, stream):
     return line
 
 def events_for_day(events, date, english_time=None):
-    day_events = [e for e in events if e["start"].date() == date]
+    day_events = [e for e in events if ts_to_date(e["start_ts"]) == date]
 
     if date.weekday() == 3 and english_time:
         if english_time == "morning":
-            start_time = TIMEZONE.localize(datetime.datetime.combine(date, datetime.time(9, 0)))
-            end_time = TIMEZONE.localize(datetime.datetime.combine(date, datetime.time(12, 10)))
+            start_ts = local_to_ts(date.year, date.month, date.day, 9, 0)
+            end_ts = local_to_ts(date.year, date.month, date.day, 12, 10)
         else:
-            start_time = TIMEZONE.localize(datetime.datetime.combine(date, datetime.time(14, 0)))
-            end_time = TIMEZONE.localize(datetime.datetime.combine(date, datetime.time(17, 10)))
+            start_ts = local_to_ts(date.year, date.month, date.day, 14, 0)
+            end_ts = local_to_ts(date.year, date.month, date.day, 17, 10)
 
         has_english = any("английский" in e["summary"].lower() for e in day_events)
         if not has_english:
-            english_event = {
-                "summary": "Английский язык",
-                "original_summary": "Английский язык",
-                "start": start_time,
-                "end": end_time,
-                "desc": "Онлайн занятие"
-            }
+            english_event = Event(
+                summary="Английский язык",
+                original_summary="Английский язык",
+                start_ts=start_ts,
+                end_ts=end_ts,
+                desc="Онлайн занятие"
+            )
             day_events.append(english_event)
 
     return day_events
@@ -552,7 +3712,7 @@ def format_day(date, events, course, stream, english_time=None, is_tomorrow=Fals
         return f"{prefix} {date_str} — занятий нет\n"
 
     text = f"{prefix} {date_str}:\n"
-    for ev in sorted(evs, key=lambda x: x["start"]):
+    for ev in sorted(evs, key=lambda x: x["start_ts"]):
         text += f"{format_event(ev, course, stream)}\n\n"
 
     return text
@@ -568,45 +3728,394 @@ def can_manage_homework(update: Update):
     """Проверяет, может ли пользователь управлять ДЗ"""
     return is_assistant(update)
 
-def get_user_stats():
-    """Получает статистику пользователей"""
-    total_users = len(user_settings)
-
-    course_stats = {}
-    reminders_stats = {"enabled": 0, "disabled": 0}
-    english_time_stats = {"morning": 0, "afternoon": 0, "none": 0}
+# === СТАТИСТИКА ===
+# Счетчики обновляются при каждом изменении настроек пользователя (update_user_stats),
+# поэтому /stats не перебирает user_settings.
+def user_stat_key(settings):
+    english_time = settings.get('english_time')
+    if english_time not in ("morning", "afternoon"):
+        english_time = "none"
+    return (settings.get('course'), settings.get('stream', '1'), bool(settings.get('reminders', False)), english_time)
+
+def apply_user_stat_key(key, delta):
+    course, stream, reminders, english_time = key
+    user_counters["total_users"] += delta
+    if course:
+        streams = user_counters["course_stats"].setdefault(course, {})
+        streams[stream] = streams.get(stream, 0) + delta
+        if not streams[stream]:
+            del streams[stream]
+            if not streams:
+                del user_counters["course_stats"][course]
+    user_counters["reminders_stats"]["enabled" if reminders else "disabled"] += delta
+    user_counters["english_time_stats"][english_time] += delta
+
+def update_user_stats(user_id):
+    """Пересчитывает вклад одного пользователя в счетчики"""
+    old_key = user_stat_keys.pop(user_id, None)
+    if old_key is not None:
+        apply_user_stat_key(old_key, -1)
+    settings = user_settings.get(user_id)
+    if settings is not None:
+        key = user_stat_keys[user_id] = user_stat_key(settings)
+        apply_user_stat_key(key, 1)
+
+def rebuild_user_stats():
+    """Полный пересчет — только при загрузке настроек"""
+    user_counters.update({
+        "total_users": 0,
+        "course_stats": {},
+        "reminders_stats": {"enabled": 0, "disabled": 0},
+        "english_time_stats": {"morning": 0, "afternoon": 0, "none": 0}
+    })
+    user_stat_keys.clear()
+    for user_id in user_settings:
+        update_user_stats(user_id)
 
-    for user_id, settings in user_settings.items():
-        course = settings.get('course')
-        stream = settings.get('stream', '1')
+def get_user_stats():
+    """Получает статистику пользователей из счетчиков"""
+    return {
+        "total_users": user_counters["total_users"],
+        "course_stats": {course: dict(streams) for course, streams in user_counters["course_stats"].items()},
+        "reminders_stats": dict(user_counters["reminders_stats"]),
+        "english_time_stats": dict(user_counters["english_time_stats"])
+    }
 
-        if course:
-            if course not in course_stats:
-                course_stats[course] = {}
+# === АКТИВНОСТЬ ПО ДНЯМ ===
+# Каждому пользователю присваивается порядковый номер; за день хранится битовая карта
+# номеров активных пользователей. 1000 пользователей — 125 байт в день.
+def load_activity():
+    try:
+        with open(ACTIVITY_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        logging.error("❌ Не удалось прочитать %s: %s", ACTIVITY_FILE, e)
+        return
 
-            if stream not in course_stats[course]:
-                course_stats[course][stream] = 0
-            course_stats[course][stream] += 1
+    activity["users"] = data.get("users", [])
+    activity["new_users"] = data.get("new_users", {})
+    activity["days"] = {day: bytearray(base64.b64decode(bitmap)) for day, bitmap in data.get("days", {}).items()}
+    activity_user_index.clear()
+    activity_user_index.update((user_id, index) for index, user_id in enumerate(activity["users"]))
 
-        if settings.get('reminders', False):
-            reminders_stats["enabled"] += 1
-        else:
-            reminders_stats["disabled"] += 1
+def save_activity():
+    global activity_dirty
+    if not activity_dirty:
+        return
+    cutoff = (clock.today() - datetime.timedelta(days=ACTIVITY_KEEP_DAYS)).isoformat()
+    for day in [day for day in activity["days"] if day < cutoff]:
+        del activity["days"][day]
+        activity["new_users"].pop(day, None)
+
+    data = {
+        "users": activity["users"],
+        "new_users": activity["new_users"],
+        "days": {day: base64.b64encode(bytes(bitmap)).decode("ascii") for day, bitmap in activity["days"].items()}
+    }
+    with open(ACTIVITY_FILE, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    activity_dirty = False
+
+def record_activity(user_id, today=None):
+    """Отмечает пользователя активным сегодня: O(1)"""
+    global activity_dirty
+    day = (today or clock.today()).isoformat()
+    index = activity_user_index.get(user_id)
+    if index is None:
+        index = activity_user_index[user_id] = len(activity["users"])
+        activity["users"].append(user_id)
+        activity["new_users"][day] = activity["new_users"].get(day, 0) + 1
+        activity_dirty = True
+
+    bitmap = activity["days"].get(day)
+    if bitmap is None:
+        bitmap = activity["days"][day] = bytearray()
+    byte, bit = divmod(index, 8)
+    if byte >= len(bitmap):
+        bitmap.extend(bytes(byte + 1 - len(bitmap)))
+    if not bitmap[byte] & (1 << bit):
+        bitmap[byte] |= 1 << bit
+        activity_dirty = True
+
+def count_bits(bitmap):
+    return bin(int.from_bytes(bitmap, "little")).count("1")
+
+def activity_trend(days, today=None):
+    """Активность за последние days дней: (по дням, уникальных, новых)"""
+    today = today or clock.today()
+    daily = []
+    combined = 0
+    new_users = 0
+    for offset in range(days - 1, -1, -1):
+        day = (today - datetime.timedelta(days=offset)).isoformat()
+        bitmap = activity["days"].get(day, b"")
+        daily.append(count_bits(bitmap))
+        combined |= int.from_bytes(bitmap, "little")
+        new_users += activity["new_users"].get(day, 0)
+    return daily, bin(combined).count("1"), new_users
+
+def sparkline(values):
+    bars = "▁▂▃▄▅▆▇█"
+    top = max(values, default=0)
+    if not top:
+        return bars[0] * len(values)
+    return "".join(bars[value * (len(bars) - 1) // top] for value in values)
+
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user:
+        user_id = str(update.effective_user.id)
+        record_activity(user_id)
+        record_update_usage(update, user_id)
 
-        english_time = settings.get('english_time')
-        if english_time == "morning":
-            english_time_stats["morning"] += 1
-        elif english_time == "afternoon":
-            english_time_stats["afternoon"] += 1
-        else:
-            english_time_stats["none"] += 1
+async def flush_activity_periodically():
+    while True:
+        await asyncio.sleep(ACTIVITY_FLUSH_INTERVAL)
+        try:
+            save_activity()
+        except OSError as e:
+            logging.error("❌ Не удалось сохранить %s: %s", ACTIVITY_FILE, e)
+
+# === ЖУРНАЛ ИСПОЛЬЗОВАНИЯ ===
+# Каждое нажатие кнопки, команда и инлайн-запрос — запись фиксированного размера:
+# время, номер действия, номер потока пользователя, вид. Записи копятся в памяти и
+# дописываются в сегменты usage/usage-<номер>-<время>.bin из пула потоков; имена действий и
+# потоков — в usage/names.json. Свертка читает сегменты кусками с сохраненного смещения
+# и копит почасовые и дневные итоги в usage/rollups.json.
+USAGE_RECORD = struct.Struct("<IHHB")
+USAGE_KINDS = ("callback", "command", "inline")
+USAGE_NO_STREAM = 0xFFFF
+USAGE_MAX_NAMES = 4096
+
+usage_buffer = bytearray()
+usage_names = {"actions": [], "streams": []}
+usage_name_ids = {"actions": {}, "streams": {}}
+usage_names_saved = {"actions": 0, "streams": 0}
+usage_lock = threading.Lock()
+
+def load_usage_names():
+    """Поднимает таблицы имен из usage/names.json: номера в еще не свернутых записях
+    должны значить то же, что и до перезапуска"""
+    try:
+        with open(os.path.join(USAGE_DIR, "names.json"), "r", encoding="utf-8") as f:
+            names = json.load(f)
+    except FileNotFoundError:
+        return
+    except ValueError as e:
+        logging.error("❌ Не удалось прочитать таблицу имен журнала использования: %s", e)
+        return
+    for kind in usage_names:
+        usage_names[kind] = list(names.get(kind, []))
+        usage_name_ids[kind] = {name: name_id for name_id, name in enumerate(usage_names[kind])}
+        usage_names_saved[kind] = len(usage_names[kind])
+
+def usage_name_id(kind, name):
+    name_id = usage_name_ids[kind].get(name)
+    if name_id is None:
+        names = usage_names[kind]
+        if len(names) >= USAGE_MAX_NAMES:
+            # Таблица имен переполнена: дальше все новое считается как "other"
+            name = "other"
+            if name in usage_name_ids[kind]:
+                return usage_name_ids[kind][name]
+        name_id = usage_name_ids[kind][name] = len(names)
+        names.append(name)
+    return name_id
+
+def usage_action(data):
+    """Имя действия без параметров: today_1_sdi -> today, hw_page_list_1_sdi_... -> hw_page_list"""
+    parts = data.split('_')
+    for position in range(1, len(parts)):
+        part = parts[position]
+        if part in COURSES or part in FACULTIES or part.isdigit():
+            return '_'.join(parts[:position])
+    return '_'.join(parts[:3])
+
+def record_usage(kind, action, user_id):
+    """Кладет запись в буфер: O(1), без ввода-вывода"""
+    settings = user_settings.get(user_id, {})
+    if settings.get('course') and settings.get('stream'):
+        stream_id = usage_name_id("streams", f"{settings['course']}_{settings['stream']}")
+    else:
+        stream_id = USAGE_NO_STREAM
+    usage_buffer.extend(USAGE_RECORD.pack(
+        int(clock.time()), usage_name_id("actions", action), stream_id, USAGE_KINDS.index(kind)
+    ))
+
+def record_update_usage(update, user_id):
+    if update.callback_query and update.callback_query.data:
+        record_usage("callback", usage_action(update.callback_query.data), user_id)
+    elif update.message and update.message.text and update.message.text.startswith('/'):
+        command = update.message.text.split()[0][1:].split('@')[0].lower()
+        record_usage("command", command[:32], user_id)
+    elif update.inline_query:
+        record_usage("inline", "inline", user_id)
+
+def take_usage_batch():
+    """Забирает накопленные записи и новые имена (вызывается в потоке цикла событий)"""
+    global usage_buffer
+    data, usage_buffer = usage_buffer, bytearray()
+    names = None
+    if any(len(usage_names[kind]) != usage_names_saved[kind] for kind in usage_names):
+        names = {kind: list(values) for kind, values in usage_names.items()}
+        usage_names_saved.update({kind: len(values) for kind, values in names.items()})
+    return bytes(data), names
+
+def usage_segments():
+    return sorted(glob.glob(os.path.join(USAGE_DIR, "usage-*.bin")))
+
+def write_json_atomically(path, data):
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+def write_usage_batch(data, names):
+    """Дописывает записи в текущий сегмент; сегмент больше USAGE_LOG_MAX_BYTES закрывается"""
+    if not data and names is None:
+        return
+    with usage_lock:
+        os.makedirs(USAGE_DIR, exist_ok=True)
+        # Имена пишутся раньше записей, которые на них ссылаются
+        if names is not None:
+            write_json_atomically(os.path.join(USAGE_DIR, "names.json"), names)
+        if not data:
+            return
+        segments = usage_segments()
+        if not segments or os.path.getsize(segments[-1]) + len(data) > USAGE_LOG_MAX_BYTES:
+            # Номер сегмента растет монотонно и задает порядок; время первой записи — для людей
+            number = int(os.path.basename(segments[-1]).split('-')[1]) + 1 if segments else 0
+            first_ts = USAGE_RECORD.unpack_from(data)[0]
+            segments.append(os.path.join(USAGE_DIR, f"usage-{number:06d}-{first_ts}.bin"))
+        with open(segments[-1], "ab") as f:
+            f.write(data)
+
+def flush_usage_log():
+    write_usage_batch(*take_usage_batch())
+
+def load_usage_rollups():
+    try:
+        with open(os.path.join(USAGE_DIR, "rollups.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"offsets": {}, "hourly": {}, "daily": {}}
+
+def add_usage(bucket, action, stream):
+    bucket["total"] = bucket.get("total", 0) + 1
+    actions = bucket.setdefault("actions", {})
+    actions[action] = actions.get(action, 0) + 1
+    if stream is not None:
+        streams = bucket.setdefault("streams", {})
+        streams[stream] = streams.get(stream, 0) + 1
+
+def rollup_usage():
+    """Досчитывает итоги по новым записям; журнал читается кусками по USAGE_READ_CHUNK записей"""
+    with usage_lock:
+        try:
+            with open(os.path.join(USAGE_DIR, "names.json"), "r", encoding="utf-8") as f:
+                names = json.load(f)
+        except FileNotFoundError:
+            return load_usage_rollups()
+        rollups = load_usage_rollups()
+        offsets, hourly, daily = rollups["offsets"], rollups["hourly"], rollups["daily"]
+        actions, streams = names["actions"], names["streams"]
+        segments = usage_segments()
+        current_day, date_str = None, None
+
+        for path in segments:
+            name = os.path.basename(path)
+            offset = offsets.get(name, 0)
+            with open(path, "rb") as f:
+                f.seek(offset)
+                while True:
+                    chunk = f.read(USAGE_READ_CHUNK * USAGE_RECORD.size)
+                    chunk = chunk[:len(chunk) - len(chunk) % USAGE_RECORD.size]
+                    if not chunk:
+                        break
+                    for ts, action_id, stream_id, _ in USAGE_RECORD.iter_unpack(chunk):
+                        # Запись с номером, которого нет в таблице имен, не к чему отнести
+                        if action_id >= len(actions) or (stream_id != USAGE_NO_STREAM and stream_id >= len(streams)):
+                            continue
+                        day = local_day(ts)
+                        if day != current_day:
+                            current_day, date_str = day, day_to_date(day).isoformat()
+                        hour = (ts + utc_offset_for_day(ts // 86400)) % 86400 // 3600
+                        action = actions[action_id]
+                        stream = streams[stream_id] if stream_id != USAGE_NO_STREAM else None
+                        add_usage(hourly.setdefault(f"{date_str}T{hour:02d}", {}), action, stream)
+                        day_bucket = daily.setdefault(date_str, {})
+                        add_usage(day_bucket, action, stream)
+                        day_bucket.setdefault("hours", [0] * 24)[hour] += 1
+                    offset += len(chunk)
+                    f.seek(offset)
+            offsets[name] = offset
+
+        # Полностью свернутые старые сегменты сверх USAGE_LOG_KEEP удаляются
+        for path in segments[:-1][:-USAGE_LOG_KEEP or None]:
+            name = os.path.basename(path)
+            if offsets.get(name) == os.path.getsize(path):
+                os.remove(path)
+        present = {os.path.basename(path) for path in usage_segments()}
+        rollups["offsets"] = {name: offset for name, offset in offsets.items() if name in present}
+
+        today = clock.today()
+        hourly_cutoff = (today - datetime.timedelta(days=USAGE_HOURLY_KEEP_DAYS)).isoformat()
+        daily_cutoff = (today - datetime.timedelta(days=USAGE_DAILY_KEEP_DAYS)).isoformat()
+        rollups["hourly"] = {key: value for key, value in hourly.items() if key >= hourly_cutoff}
+        rollups["daily"] = {key: value for key, value in daily.items() if key >= daily_cutoff}
+        write_json_atomically(os.path.join(USAGE_DIR, "rollups.json"), rollups)
+        return rollups
+
+def format_usage_report(rollups, days, now=None):
+    now = now or clock.now()
+    today = now.date()
+    dates = [(today - datetime.timedelta(days=offset)).isoformat() for offset in range(days - 1, -1, -1)]
+    buckets = [rollups["daily"].get(date_str, {}) for date_str in dates]
+    total = sum(bucket.get("total", 0) for bucket in buckets)
+
+    actions, streams, hours = {}, {}, [0] * 24
+    for bucket in buckets:
+        for action, count in bucket.get("actions", {}).items():
+            actions[action] = actions.get(action, 0) + count
+        for stream, count in bucket.get("streams", {}).items():
+            streams[stream] = streams.get(stream, 0) + count
+        for hour, count in enumerate(bucket.get("hours", [])):
+            hours[hour] += count
+
+    last_hours = []
+    for offset in range(23, -1, -1):
+        moment = now - datetime.timedelta(hours=offset)
+        last_hours.append(rollups["hourly"].get(moment.strftime("%Y-%m-%dT%H"), {}).get("total", 0))
+
+    text = f"📈 Использование за {days} дн: {total} действий\n"
+    text += f"По дням: {sparkline([bucket.get('total', 0) for bucket in buckets])}\n"
+    text += f"Последние 24 ч: {sparkline(last_hours)}\n"
+    text += f"По часам (0–23): {sparkline(hours)}\n"
+    if total:
+        peaks = sorted(range(24), key=lambda hour: -hours[hour])[:3]
+        text += "Пик: " + ", ".join(f"{hour:02d}:00 ({hours[hour]})" for hour in peaks) + "\n"
+    text += "\n🔘 Действия:\n"
+    for action, count in sorted(actions.items(), key=lambda item: -item[1])[:10]:
+        text += f"  • {action}: {count}\n"
+    text += "\n🎓 Потоки:\n"
+    for stream_key, count in sorted(streams.items(), key=lambda item: -item[1])[:10]:
+        course, stream = stream_key.split('_', 1)
+        text += f"  • {course_title(course, stream)}: {count}\n"
+    return text
 
-    return {
-        "total_users": total_users,
-        "course_stats": course_stats,
-        "reminders_stats": reminders_stats,
-        "english_time_stats": english_time_stats
-    }
+async def usage_log_worker():
+    """Раз в USAGE_FLUSH_INTERVAL дописывает журнал, раз в USAGE_ROLLUP_INTERVAL сворачивает его"""
+    loop = asyncio.get_running_loop()
+    last_rollup = clock.time()
+    while True:
+        await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+        try:
+            await loop.run_in_executor(None, write_usage_batch, *take_usage_batch())
+            if clock.time() - last_rollup >= USAGE_ROLLUP_INTERVAL:
+                await loop.run_in_executor(None, rollup_usage)
+                last_rollup = clock.time()
+        except Exception as e:
+            logging.error("❌ Ошибка журнала использования: %s", e)
 
 async def send_homework_reminders():
     """Отправляет напоминания о домашних заданиях"""
@@ -629,61 +4138,116 @@ async def send_homework_reminders():
 
                     try:
                         await application.bot.send_message(chat_id=user_id, text=message)
-                        logging.info(f"📤 Отправлено напоминание пользователю {user_id}")
+                        logging.info("📤 Отправлено напоминание пользователю %s", user_id,
+                                     extra={"event": "reminder_sent", "user_id": user_id})
                     except BadRequest as e:
-                        logging.error(f"❌ Ошибка отправки напоминания пользователю {user_id}: {e}")
+                        logging.error("❌ Ошибка отправки напоминания пользователю %s: %s", user_id, e,
+                                      extra={"event": "reminder_failed", "user_id": user_id})
                         if "chat not found" in str(e).lower() or "bot was blocked" in str(e).lower():
                             user_settings.pop(user_id, None)
+                            update_user_stats(user_id)
                             save_user_settings(user_settings)
 
         except Exception as e:
-            logging.error(f"❌ Ошибка отправки напоминания пользователю {user_id}: {e}")
+            logging.error("❌ Ошибка отправки напоминания пользователю %s: %s", user_id, e,
+                          extra={"event": "reminder_failed", "user_id": user_id})
 
 async def check_for_updates():
     """Проверяет обновления на GitHub"""
     try:
         logging.info("🔍 Проверка обновлений на GitHub...")
-        response = requests.get(GITHUB_RAW_URL)
+        response = requests.get(GITHUB_RAW_URL, timeout=SOURCE_TIMEOUT)
         if response.status_code == 200:
             new_content = response.text
             with open(__file__, "r", encoding="utf-8") as f:
                 current_content = f.read()
 
             if new_content != current_content:
-                with open(__file__, "w", encoding="utf-8") as f:
+                # Не подменяем код, который не компилируется
+                compile(new_content, __file__, "exec")
+
+                tmp_path = __file__ + ".new"
+                with open(tmp_path, "w", encoding="utf-8") as f:
                     f.write(new_content)
+                os.replace(tmp_path, __file__)
 
                 save_last_update()
-                logging.info("✅ Бот обновлен до последней версии!")
+                logging.info("✅ Бот обновлен до последней версии, перезапуск...")
 
                 if application:
                     await application.bot.send_message(
                         chat_id=ADMIN_USERNAME,
                         text="✅ Бот автоматически обновлен до последней версии из GitHub!"
                     )
+                request_restart()
             else:
                 logging.info("📭 Обновлений нет")
 
     except Exception as e:
-        logging.error(f"❌ Ошибка при проверке обновлений: {e}")
+        logging.error("❌ Ошибка при проверке обновлений: %s", e)
+
+# Задачи по расписанию: (час, минута по TIMEZONE, корутина)
+SCHEDULED_JOBS = [
+    (20, 0, send_homework_reminders),
+    (9, 0, check_for_updates),
+    (7, 0, refresh_all_calendars),
+]
+# Запуск, опоздавший больше чем на это время (бот спал или был остановлен), пропускается
+SCHEDULER_GRACE = 5 * 60
+# Часы перепроверяются хотя бы раз в минуту: перевод системного времени не сбивает расписание
+SCHEDULER_MAX_SLEEP = 60
+
+def next_run_ts(hour, minute, after_ts):
+    """Ближайший момент hour:minute местного времени не раньше after_ts"""
+    date = ts_to_date(int(after_ts))
+    run_ts = local_to_ts(date.year, date.month, date.day, hour, minute)
+    if run_ts < after_ts:
+        date += datetime.timedelta(days=1)
+        run_ts = local_to_ts(date.year, date.month, date.day, hour, minute)
+    return run_ts
 
 async def scheduler():
-    """Асинхронный планировщик для напоминаний и обновлений"""
-    while True:
-        now = datetime.datetime.now(TIMEZONE)
+    """Асинхронный планировщик для напоминаний и обновлений.
 
-        if now.hour == 20 and now.minute == 0:
-            await send_homework_reminders()
-            await asyncio.sleep(60)
+    Спит до ближайшего срока и запускает каждую задачу ровно один раз в сутки.
+    """
+    next_runs = [next_run_ts(hour, minute, clock.time()) for hour, minute, _ in SCHEDULED_JOBS]
+    while True:
+        for position, (hour, minute, job) in enumerate(SCHEDULED_JOBS):
+            due_ts = next_runs[position]
+            if clock.time() < due_ts:
+                continue
+            if clock.time() - due_ts <= SCHEDULER_GRACE:
+                try:
+                    await job()
+                except Exception as e:
+                    logging.error("❌ Ошибка задачи %s: %s", job.__name__, e)
+            else:
+                logging.warning("Пропущен запуск %s: опоздание %d с", job.__name__, clock.time() - due_ts)
+            next_runs[position] = next_run_ts(hour, minute, max(clock.time(), due_ts + 1))
 
-        elif now.hour == 9 and now.minute == 0:
-            await check_for_updates()
-            await asyncio.sleep(60)
+        delay = min(next_runs) - clock.time()
+        await asyncio.sleep(min(max(delay, 0), SCHEDULER_MAX_SLEEP))
 
-        await asyncio.sleep(30)
+def message_digest(text, reply_markup=None):
+    """Отпечаток текста и клавиатуры сообщения"""
+    digest = hashlib.sha1(text.encode("utf-8"))
+    if reply_markup is not None:
+        digest.update(json.dumps(reply_markup.to_dict(), ensure_ascii=False, sort_keys=True).encode("utf-8"))
+    return digest.digest()
 
 async def safe_edit_message(update: Update, text: str, reply_markup=None):
-    """Безопасное редактирование сообщения с обработкой ошибок"""
+    """Безопасное редактирование сообщения с обработкой ошибок.
+
+    Если сообщение уже показывает тот же текст и клавиатуру, запрос к Telegram не отправляется.
+    """
+    message = update.callback_query.message
+    message_key = (message.chat_id, message.message_id) if message else None
+    digest = message_digest(text, reply_markup)
+    if message_key is not None and sent_message_digests.get(message_key) == digest:
+        sent_message_digests.move_to_end(message_key)
+        return
+
     try:
         await update.callback_query.edit_message_text(
             text=text,
@@ -691,35 +4255,80 @@ async def safe_edit_message(update: Update, text: str, reply_markup=None):
         )
     except BadRequest as e:
         if "Message is not modified" in str(e):
-            logging.info("Message not modified - ignoring")
+            logging.info("Message not modified - ignoring", extra={"event": "message_not_modified"})
         else:
+            if message_key is not None:
+                sent_message_digests.pop(message_key, None)
             raise
 
-# === ОСНОВНЫЕ ОБРАБОТЧИКИ КОМАНД ===
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if message_key is not None:
+        sent_message_digests[message_key] = digest
+        sent_message_digests.move_to_end(message_key)
+        if len(sent_message_digests) > SENT_MESSAGE_CACHE_SIZE:
+            sent_message_digests.popitem(last=False)
+
+def build_reminders_settings(user_id, course, stream):
+    """Текст и клавиатура экрана настройки напоминаний"""
+    settings = user_settings.get(user_id, {})
+    reminders_enabled = settings.get('reminders', False)
+    changes_enabled = settings.get('change_notifications', False)
+
+    status_text = "включены ✅" if reminders_enabled else "выключены ❌"
+    changes_text = "включены ✅" if changes_enabled else "выключены ❌"
+
     keyboard = [
-        [InlineKeyboardButton("1 курс", callback_data="select_course_1")],
-        [InlineKeyboardButton("2 курс", callback_data="select_course_2")],
-        [InlineKeyboardButton("3 курс", callback_data="select_course_3")],
-        [InlineKeyboardButton("4 курс", callback_data="select_course_4")],
+        [InlineKeyboardButton(
+            "🔔 Включить" if not reminders_enabled else "🔕 Выключить",
+            callback_data=f"toggle_reminders_{course}_{stream}"
+        )],
+        [InlineKeyboardButton(
+            "📣 Уведомлять об изменениях" if not changes_enabled else "🔇 Не уведомлять об изменениях",
+            callback_data=f"toggle_changes_{course}_{stream}"
+        )],
+        [InlineKeyboardButton("⬅️ Назад", callback_data=f"back_to_menu_{course}_{stream}")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
+
+    text = f"⚙️ Настройка напоминаний\n\nНапоминания о домашних заданиях {status_text}\n"
+    text += f"Уведомления об изменениях в расписании {changes_text}\n\n"
+    text += "Напоминания приходят каждый день в 20:00 с информацией о ДЗ на завтра."
+    return text, reply_markup
+
+# === ОСНОВНЫЕ ОБРАБОТЧИКИ КОМАНД ===
+def build_course_keyboard(course_ids):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(COURSES[course]["name"], callback_data=f"select_course_{course}")]
+        for course in course_ids
+    ])
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if len(FACULTIES) > 1:
+        keyboard = [
+            [InlineKeyboardButton(faculty["name"], callback_data=f"select_faculty_{faculty_id}")]
+            for faculty_id, faculty in FACULTIES.items()
+        ]
+        await update.message.reply_text(
+            "Привет! 🎓\nВыбери свой факультет:",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return
+
+    faculty = next(iter(FACULTIES.values()))
     await update.message.reply_text(
         "Привет! 🎓\nВыбери свой курс:",
-        reply_markup=reply_markup
+        reply_markup=build_course_keyboard(faculty["courses"])
     )
 
 async def select_stream(update: Update, context: ContextTypes.DEFAULT_TYPE, course):
-    """Выбор потока (только для 1 курса)"""
-    if course != "1":
-        await select_english_time(update, context, course, "1")
+    """Выбор потока (если у курса их несколько)"""
+    streams = COURSES.get(course, {}).get("streams", {})
+    if len(streams) <= 1:
+        await select_english_time(update, context, course, next(iter(streams), "1"))
         return
 
     keyboard = [
-        [InlineKeyboardButton("📖 СДИ", callback_data=f"select_stream_sdi_{course}")],
-        [InlineKeyboardButton("📖 Теория и практика", callback_data=f"select_stream_theory_{course}")],
-        [InlineKeyboardButton("📖 Регионы 1", callback_data=f"select_stream_region1_{course}")],
-        [InlineKeyboardButton("📖 Регионы 2", callback_data=f"select_stream_region2_{course}")],
+        [InlineKeyboardButton(f"📖 {name}", callback_data=f"select_stream_{stream}_{course}")]
+        for stream, name in streams.items()
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -735,7 +4344,22 @@ async def select_stream(update: Update, context: ContextTypes.DEFAULT_TYPE, cour
             reply_markup=reply_markup
         )
 
+async def prefetch_calendar(course, stream):
+    """Фоновая загрузка расписания, пока пользователь выбирает время английского"""
+    cache_key = f"{course}_{stream}"
+    if cache_key in events_cache or cache_key in calendar_loads:
+        return
+    await ensure_calendar(course, stream)
+    if cache_key in events_cache:
+        logging.info("Расписание курса %s, потока %s загружено заранее", course, stream,
+                     extra={"event": "calendar_prefetched", "stream": cache_key})
+    else:
+        logging.warning("Не удалось заранее загрузить расписание %s", cache_key)
+
 async def select_english_time(update: Update, context: ContextTypes.DEFAULT_TYPE, course, stream):
+    if PREFETCH_ON_SELECT:
+        asyncio.create_task(prefetch_calendar(course, stream))
+
     keyboard = [
         [InlineKeyboardButton("🕘 9:00-12:10", callback_data=f"english_morning_{course}_{stream}")],
         [InlineKeyboardButton("🕑 14:00-17:10", callback_data=f"english_afternoon_{course}_{stream}")],
@@ -755,38 +4379,50 @@ async def select_english_time(update: Update, context: ContextTypes.DEFAULT_TYPE
             reply_markup=reply_markup
         )
 
+def get_main_menu_markup(course, stream, role):
+    """Клавиатура главного меню; разметка неизменяема, поэтому собирается один раз"""
+    markup_key = (course, stream, role)
+    reply_markup = main_menu_markups.get(markup_key)
+    if reply_markup is not None:
+        return reply_markup
+
+    keyboard = [
+        [InlineKeyboardButton("📅 Сегодня", callback_data=f"today_{course}_{stream}"),
+         InlineKeyboardButton("📅 Завтра", callback_data=f"tomorrow_{course}_{stream}")],
+        [InlineKeyboardButton("📊 Эта неделя", callback_data=f"this_week_{course}_{stream}"),
+         InlineKeyboardButton("📊 След. неделя", callback_data=f"next_week_{course}_{stream}")],
+        [InlineKeyboardButton("🗓 Месяц", callback_data=f"period_month_{course}_{stream}_0"),
+         InlineKeyboardButton("🎓 Семестр", callback_data=f"period_semester_{course}_{stream}_0")],
+        [InlineKeyboardButton("⏭ Следующая пара", callback_data=f"next_lesson_{course}_{stream}")],
+        [InlineKeyboardButton("🔔 Настройка напоминаний", callback_data=f"reminders_settings_{course}_{stream}")],
+        [InlineKeyboardButton("🔄 Обновить расписание", callback_data=f"refresh_{course}_{stream}")],
+    ]
+
+    if role == "assistant":
+        keyboard.append([InlineKeyboardButton("📝 Управление ДЗ", callback_data=f"manage_hw_{course}_{stream}")])
+
+    reply_markup = main_menu_markups[markup_key] = InlineKeyboardMarkup(keyboard)
+    return reply_markup
+
 async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, course, stream, english_time=None):
     try:
-        events = load_events_from_github(course, stream)
-
+        # Меню не трогает расписание: его загружают только экраны, которым оно нужно
         user_id = str(update.effective_user.id)
         if user_id not in user_settings:
             user_settings[user_id] = {}
 
-        user_settings[user_id]['course'] = course
-        user_settings[user_id]['stream'] = stream
+        selection = {'course': course, 'stream': stream}
         if english_time:
-            user_settings[user_id]['english_time'] = english_time
-        save_user_settings(user_settings)
-
-        keyboard = [
-            [InlineKeyboardButton("📅 Сегодня", callback_data=f"today_{course}_{stream}"),
-             InlineKeyboardButton("📅 Завтра", callback_data=f"tomorrow_{course}_{stream}")],
-            [InlineKeyboardButton("📊 Эта неделя", callback_data=f"this_week_{course}_{stream}"),
-             InlineKeyboardButton("📊 След. неделя", callback_data=f"next_week_{course}_{stream}")],
-            [InlineKeyboardButton("🔔 Настройка напоминаний", callback_data=f"reminders_settings_{course}_{stream}")],
-            [InlineKeyboardButton("🔄 Обновить расписание", callback_data=f"refresh_{course}_{stream}")],
-        ]
-
-        if can_manage_homework(update):
-            keyboard.append([InlineKeyboardButton("📝 Управление ДЗ", callback_data=f"manage_hw_{course}_{stream}")])
+            selection['english_time'] = english_time
+        if any(user_settings[user_id].get(key) != value for key, value in selection.items()):
+            user_settings[user_id].update(selection)
+            update_user_stats(user_id)
+            save_user_settings(user_settings)
 
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        role = "assistant" if can_manage_homework(update) else "student"
+        reply_markup = get_main_menu_markup(course, stream, role)
 
-        stream_display = STREAM_NAMES.get(stream, stream) if course == "1" else ""
-        course_text = f"{course} курс"
-        if course == "1":
-            course_text += f", {stream_display}"
+        course_text = course_title(course, stream)
 
         english_text = ""
         if english_time == "morning":
@@ -819,7 +4455,15 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, cou
             )
 
     except Exception as e:
-        logging.error(f"Ошибка в show_main_menu: {e}")
+        logging.error("Ошибка в show_main_menu: %s", e)
+
+SCHEDULE_CALLBACKS = ("today_", "tomorrow_", "next_lesson_", "this_week_", "next_week_", "period_",
+                      "add_hw_", "hw_select_subject_")
+
+def callback_streams(data):
+    """Пары (курс, поток), упомянутые в данных кнопки"""
+    parts = data.split('_')
+    return {(course, stream) for course, stream in zip(parts, parts[1:]) if stream in STREAM_URLS.get(course, {})}
 
 async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -828,8 +4472,22 @@ async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     data = query.data
     user_id = str(update.effective_user.id)
 
+    # Пары читают только экраны расписания и выбор предмета ДЗ; меню и настройки
+    # обходятся без них, поэтому загрузка потока (вне цикла событий) идет только здесь
+    if data.startswith(SCHEDULE_CALLBACKS):
+        for course, stream in callback_streams(data):
+            await ensure_calendar(course, stream)
+
+    # === ОБРАБОТКА ВЫБОРА ФАКУЛЬТЕТА ===
+    if data.startswith('select_faculty_'):
+        faculty = FACULTIES.get(data[len('select_faculty_'):])
+        if faculty is None:
+            await query.answer("Ошибка: факультет не найден")
+            return
+        await safe_edit_message(update, text="Выбери свой курс:", reply_markup=build_course_keyboard(faculty["courses"]))
+
     # === ОБРАБОТКА ВЫБОРА КУРСА ===
-    if data.startswith('select_course_'):
+    elif data.startswith('select_course_'):
         course = data.split('_')[-1]
         context.user_data['course'] = course
         await select_stream(update, context, course)
@@ -872,65 +4530,56 @@ async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
         settings = user_settings.get(user_id, {})
         english_time = settings.get('english_time')
 
-        events = load_events_from_github(course, stream)
-        today = datetime.datetime.now(TIMEZONE).date()
+        today = clock.today()
 
         if action == "today":
-            text = format_day(today, events, course, stream, english_time)
+            text = render_day(course, stream, today, english_time)
         else:  # tomorrow
             tomorrow = today + datetime.timedelta(days=1)
-            text = format_day(tomorrow, events, course, stream, english_time, is_tomorrow=True)
+            text = render_day(course, stream, tomorrow, english_time, is_tomorrow=True)
+        text = schedule_status(course, stream, text)
 
         keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data=f"back_to_menu_{course}_{stream}")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
 
         await safe_edit_message(update, text=text, reply_markup=reply_markup)
 
-    # === ОБРАБОТКА ПРОСМОТРА НЕДЕЛИ ===
-    elif data.startswith('this_week_') or data.startswith('next_week_'):
+    # === ТЕКУЩАЯ И СЛЕДУЮЩАЯ ПАРА ===
+    elif data.startswith('next_lesson_'):
+        parts = data.split('_')
+        course = parts[2]
+        stream = parts[3]
+
+        settings = user_settings.get(user_id, {})
+        text = format_next_lesson(course, stream, settings.get('english_time'))
+
+        keyboard = [
+            [InlineKeyboardButton("🔄 Обновить", callback_data=f"next_lesson_{course}_{stream}")],
+            [InlineKeyboardButton("⬅️ Назад", callback_data=f"back_to_menu_{course}_{stream}")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+
+        await safe_edit_message(update, text=text, reply_markup=reply_markup)
+
+    # === ОБРАБОТКА ПРОСМОТРА НЕДЕЛИ, МЕСЯЦА И СЕМЕСТРА ===
+    elif data.startswith('this_week_') or data.startswith('next_week_') or data.startswith('period_'):
         parts = data.split('_')
-        if parts[0] == "this":
-            action = "this_week"
+        if parts[0] == "period":
+            kind = parts[1]
             course = parts[2]
             stream = parts[3]
+            page = int(parts[4])
         else:
-            action = "next_week"
+            kind = "week" if parts[0] == "this" else "nextweek"
             course = parts[2]
             stream = parts[3]
+            page = 0
 
         settings = user_settings.get(user_id, {})
         english_time = settings.get('english_time')
 
-        events = load_events_from_github(course, stream)
-        today = datetime.datetime.now(TIMEZONE).date()
-
-        if action == "this_week":
-            start_date, end_date = get_week_range(today)
-        else:
-            next_monday = today + datetime.timedelta(days=(7 - today.weekday()))
-            start_date, end_date = get_week_range(next_monday)
-
-        text = ""
-        current_date = start_date
-        while current_date <= end_date:
-            text += format_day(current_date, events, course, stream, english_time)
-            current_date += datetime.timedelta(days=1)
-
-        keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data=f"back_to_menu_{course}_{stream}")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        try:
-            await safe_edit_message(update, text=text, reply_markup=reply_markup)
-        except BadRequest as e:
-            if "message is too long" in str(e).lower():
-                parts_list = [text[i:i+4000] for i in range(0, len(text), 4000)]
-                for i, part in enumerate(parts_list):
-                    if i == len(parts_list) - 1:
-                        await query.message.reply_text(part, reply_markup=reply_markup)
-                    else:
-                        await query.message.reply_text(part)
-            else:
-                raise
+        text, reply_markup = build_period_view(course, stream, kind, page, english_time)
+        await safe_edit_message(update, text=text, reply_markup=reply_markup)
 
     # === ОБНОВЛЕНИЕ РАСПИСАНИЯ ===
     elif data.startswith('refresh_'):
@@ -938,14 +4587,18 @@ async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
         course = parts[1]
         stream = parts[2]
 
-        cache_key = f"{course}_{stream}"
-        if cache_key in events_cache:
-            del events_cache[cache_key]
+        try:
+            changes = await refresh_stream(course, stream)
+            await query.answer("✅ Расписание обновлено!")
+        except Exception as e:
+            logging.error("Ошибка при обновлении расписания %s_%s: %s", course, stream, e)
+            changes = None
+            await query.answer("⚠️ Источник недоступен, показана сохраненная версия")
 
-        events = load_events_from_github(course, stream)
+        # Рассылка подписчикам идет в фоне: нажавший сразу получает обновленное меню
+        if changes:
+            asyncio.create_task(notify_schedule_changes(course, stream, changes))
 
-        await query.answer("✅ Расписание обновлено!")
-        
         settings = user_settings.get(user_id, {})
         english_time = settings.get('english_time')
         await show_main_menu(update, context, course, stream, english_time)
@@ -966,23 +4619,7 @@ async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
         course = parts[2]
         stream = parts[3]
 
-        settings = user_settings.get(user_id, {})
-        reminders_enabled = settings.get('reminders', False)
-
-        status_text = "включены ✅" if reminders_enabled else "выключены ❌"
-
-        keyboard = [
-            [InlineKeyboardButton(
-                "🔔 Включить" if not reminders_enabled else "🔕 Выключить",
-                callback_data=f"toggle_reminders_{course}_{stream}"
-            )],
-            [InlineKeyboardButton("⬅️ Назад", callback_data=f"back_to_menu_{course}_{stream}")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        text = f"⚙️ Настройка напоминаний\n\nНапоминания о домашних заданиях {status_text}\n\n"
-        text += "Напоминания приходят каждый день в 20:00 с информацией о ДЗ на завтра."
-
+        text, reply_markup = build_reminders_settings(user_id, course, stream)
         await safe_edit_message(update, text=text, reply_markup=reply_markup)
 
     # === ПЕРЕКЛЮЧЕНИЕ НАПОМИНАНИЙ ===
@@ -996,25 +4633,34 @@ async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         current_status = user_settings[user_id].get('reminders', False)
         user_settings[user_id]['reminders'] = not current_status
+        update_user_stats(user_id)
         save_user_settings(user_settings)
 
         new_status = user_settings[user_id]['reminders']
-        status_text = "включены ✅" if new_status else "выключены ❌"
+        text, reply_markup = build_reminders_settings(user_id, course, stream)
 
-        keyboard = [
-            [InlineKeyboardButton(
-                "🔔 Включить" if not new_status else "🔕 Выключить",
-                callback_data=f"toggle_reminders_{course}_{stream}"
-            )],
-            [InlineKeyboardButton("⬅️ Назад", callback_data=f"back_to_menu_{course}_{stream}")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        await safe_edit_message(update, text=text, reply_markup=reply_markup)
+        await query.answer(f"Напоминания {'включены' if new_status else 'выключены'}!")
+
+    # === ПЕРЕКЛЮЧЕНИЕ УВЕДОМЛЕНИЙ ОБ ИЗМЕНЕНИЯХ ===
+    elif data.startswith('toggle_changes_'):
+        parts = data.split('_')
+        course = parts[2]
+        stream = parts[3]
+
+        if user_id not in user_settings:
+            user_settings[user_id] = {}
+
+        current_status = user_settings[user_id].get('change_notifications', False)
+        user_settings[user_id]['change_notifications'] = not current_status
+        update_user_stats(user_id)
+        save_user_settings(user_settings)
 
-        text = f"⚙️ Настройка напоминаний\n\nНапоминания о домашних заданиях {status_text}\n\n"
-        text += "Напоминания приходят каждый день в 20:00 с информацией о ДЗ на завтра."
+        new_status = user_settings[user_id]['change_notifications']
+        text, reply_markup = build_reminders_settings(user_id, course, stream)
 
         await safe_edit_message(update, text=text, reply_markup=reply_markup)
-        await query.answer(f"Напоминания {'включены' if new_status else 'выключены'}!")
+        await query.answer(f"Уведомления об изменениях {'включены' if new_status else 'выключены'}!")
 
     # === УПРАВЛЕНИЕ ДОМАШНИМИ ЗАДАНИЯМИ ===
     elif data.startswith('manage_hw_'):
@@ -1079,7 +4725,7 @@ async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data['hw_stream'] = stream
 
         dates = get_subject_dates(course, stream, subject)
-        future_dates = [d for d in dates if d >= datetime.datetime.now(TIMEZONE).date()]
+        future_dates = [d for d in dates if d >= clock.today()]
 
         keyboard = []
         for date in future_dates[:10]:
@@ -1122,30 +4768,8 @@ async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
         course = parts[2]
         stream = parts[3]
 
-        future_hws = get_future_homeworks(course, stream)
-
-        if not future_hws:
-            text = "📋 Список домашних заданий пуст"
-        else:
-            text = "📋 Список домашних заданий:\n\n"
-            for hw_key, hw_text in sorted(future_hws.items()):
-                parts = hw_key.split('|')
-                subject = parts[0]
-                date_str = parts[1]
-                date_obj = datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
-                date_formatted = date_obj.strftime("%d.%m.%Y")
-                text += f"📖 {subject} ({date_formatted}):\n{hw_text}\n\n"
-
-        keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data=f"manage_hw_{course}_{stream}")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        try:
-            await safe_edit_message(update, text=text, reply_markup=reply_markup)
-        except BadRequest as e:
-            if "message is too long" in str(e).lower():
-                await query.message.reply_text(text, reply_markup=reply_markup)
-            else:
-                raise
+        text, reply_markup = build_homework_page(course, stream, "list")
+        await safe_edit_message(update, text=text, reply_markup=reply_markup)
 
     # === УДАЛЕНИЕ ДЗ ===
     elif data.startswith('delete_hw_'):
@@ -1157,51 +4781,45 @@ async def handle_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
         course = parts[2]
         stream = parts[3]
 
-        future_hws = get_future_homeworks(course, stream)
+        text, reply_markup = build_homework_page(course, stream, "delete")
+        await safe_edit_message(update, text=text, reply_markup=reply_markup)
 
-        if not future_hws:
-            text = "📋 Нет домашних заданий для удаления"
-            keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data=f"manage_hw_{course}_{stream}")]]
-        else:
-            text = "Выбери ДЗ для удаления:"
-            keyboard = []
-            for hw_key in sorted(future_hws.keys()):
-                parts = hw_key.split('|')
-                subject = parts[0]
-                date_str = parts[1]
-                date_obj = datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
-                date_formatted = date_obj.strftime("%d.%m.%Y")
-                
-                button_text = f"{subject} ({date_formatted})"
-                callback_data = f"confirm_delete_hw_{course}_{stream}_{hw_key}"
-                
-                keyboard.append([InlineKeyboardButton(button_text, callback_data=callback_data)])
-            
-            keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data=f"manage_hw_{course}_{stream}")])
+    # === СТРАНИЦЫ СПИСКА И УДАЛЕНИЯ ДЗ ===
+    elif data.startswith('hw_page_'):
+        parts = data.split('_')
+        mode = parts[2]
+        course = parts[3]
+        stream = parts[4]
+        cursor = parts[5]
 
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        if mode == "delete" and not can_manage_homework(update):
+            await query.answer("❌ У вас нет прав для управления ДЗ")
+            return
+
+        text, reply_markup = build_homework_page(course, stream, mode, cursor)
         await safe_edit_message(update, text=text, reply_markup=reply_markup)
 
     # === ПОДТВЕРЖДЕНИЕ УДАЛЕНИЯ ДЗ ===
-    elif data.startswith('confirm_delete_hw_'):
+    elif data.startswith('hw_del_'):
         if not can_manage_homework(update):
             await query.answer("❌ У вас нет прав для управления ДЗ")
             return
 
         parts = data.split('_')
-        course = parts[3]
-        stream = parts[4]
-        hw_key = '_'.join(parts[5:])
+        course = parts[2]
+        stream = parts[3]
+        cursor = parts[4]
+        page_cursor = parts[5]
 
-        homeworks = load_homeworks(course, stream)
-        if hw_key in homeworks:
-            del homeworks[hw_key]
-            save_homeworks(course, stream, homeworks)
+        if page_cursor == cursor:
+            page_cursor = homework_successor_cursor(course, stream, cursor)
+        if delete_homework_by_cursor(course, stream, cursor):
             await query.answer("✅ Домашнее задание удалено!")
         else:
             await query.answer("❌ Домашнее задание не найдено")
 
-        await handle_query(update, context)
+        text, reply_markup = build_homework_page(course, stream, "delete", page_cursor)
+        await safe_edit_message(update, text=text, reply_markup=reply_markup)
 
 # === ОБРАБОТКА ТЕКСТОВЫХ СООБЩЕНИЙ ===
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1226,9 +4844,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         homeworks[hw_key] = hw_text
         save_homeworks(course, stream, homeworks)
 
-        context.user_data['awaiting_hw_text'] = False
+        for key in HW_FLOW_KEYS:
+            context.user_data.pop(key, None)
 
-        date_obj = datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
+        date_obj = decode_iso_date(date_str)
         date_formatted = date_obj.strftime("%d.%m.%Y")
 
         await update.message.reply_text(
@@ -1242,6 +4861,166 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         english_time = settings.get('english_time')
         await show_main_menu(update, context, course, stream, english_time)
 
+async def next_lesson(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    settings = user_settings.get(user_id, {})
+    course = settings.get('course')
+    stream = settings.get('stream')
+
+    if not course or not stream:
+        await update.message.reply_text("Сначала выбери курс и поток: /start")
+        return
+
+    await ensure_calendar(course, stream)
+    await update.message.reply_text(format_next_lesson(course, stream, settings.get('english_time')))
+
+async def directory_command(update: Update, context: ContextTypes.DEFAULT_TYPE, kind):
+    command = "teacher" if kind == "teacher" else "room"
+    if not context.args:
+        example = "Залунин" if kind == "teacher" else "220"
+        await update.message.reply_text(
+            f"Использование: /{command} <{'фамилия или ее начало' if kind == 'teacher' else 'номер'}> [сегодня|завтра|неделя]\n"
+            f"Пример: /{command} {example} неделя"
+        )
+        return
+
+    args = list(context.args)
+    period = "неделя"
+    if len(args) > 1 and args[-1].lower() in DIRECTORY_PERIODS:
+        period = args.pop().lower()
+
+    await ensure_all_calendars()
+    await update.message.reply_text(directory_answer(kind, " ".join(args), period))
+
+async def free_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    course = user_settings.get(str(update.effective_user.id), {}).get('course')
+    if course not in COURSES:
+        await update.message.reply_text("Сначала выбери курс и поток: /start")
+        return
+    if not context.args:
+        await update.message.reply_text(
+            "Использование: /free [потоки | ауд [номера]] [дата | дата-дата] [время]\n"
+            "Примеры:\n"
+            "/free все 17.02-20.02 — общее свободное время потоков твоего курса\n"
+            "/free sdi theory вт\n"
+            "/free ауд вт 12:00 — какие аудитории свободны во вторник в 12:00\n"
+            "/free ауд 218 220 17.02"
+        )
+        return
+
+    today = clock.today()
+    await ensure_all_calendars()
+    try:
+        text = free_time_answer(context.args, today, course)
+    except ValueError as e:
+        text = f"❌ Неверная дата или время: {e}"
+    await update.message.reply_text(text)
+
+async def ics_feed(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    settings = user_settings.get(user_id, {})
+    if not settings.get('course') or not settings.get('stream'):
+        await update.message.reply_text("Сначала выбери курс и поток: /start")
+        return
+
+    await update.message.reply_text(
+        "📲 Ссылка на твое расписание для календаря телефона:\n"
+        f"{feed_url(user_id)}\n\n"
+        "Добавь ее как подписку на календарь (iOS: Настройки → Календарь → Учетные записи → "
+        "Подписной календарь; Google Календарь: Добавить по URL). "
+        "Учитываются время английского, правки, переименования и ДЗ."
+    )
+
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_assistant(update):
+        await update.message.reply_text("❌ У вас нет прав для использования этой команды")
+        return
+
+    context.user_data['awaiting_import'] = True
+    context.user_data['import_mode'] = IMPORT_MODES.get(context.args[0].lower()) if context.args else None
+    await update.message.reply_text(
+        "📥 Пришли CSV или JSON файл с правками и ДЗ — он применится целиком или не применится вовсе.\n\n"
+        "Колонки: type, course, stream, date, subject, time, end_time, new_subject, desc, text\n"
+        "type: delete — удалить пару, rename — переименовать, new — добавить пару, homework — ДЗ.\n"
+        "course и stream можно не указывать — возьмется твой поток.\n\n"
+        "Пример CSV:\n"
+        "type,date,subject,time,end_time,new_subject,desc,text\n"
+        "delete,17.02.2026,Философия: лекции,10:30,,,,\n"
+        "new,18.02.2026,,14:00,15:30,Консультация,Преподаватель: Котов. Аудитория 220,\n"
+        "homework,19.02.2026,Политология,,,,,Прочитать главу 3\n\n"
+        "/import проверка — только проверить файл, ничего не меняя\n"
+        "/import принять — применить, даже если новые пары пересекаются с расписанием"
+    )
+
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Файл импорта: после /import или с подписью /import"""
+    caption = (update.message.caption or "").strip()
+    if caption.startswith("/import"):
+        mode = IMPORT_MODES.get(caption.split()[1].lower()) if len(caption.split()) > 1 else None
+    elif context.user_data.get('awaiting_import'):
+        mode = context.user_data.get('import_mode')
+    else:
+        return
+    # Ожидание файла заканчивается на любом исходе, иначе флаги остались бы в сохраненном состоянии
+    context.user_data.pop('awaiting_import', None)
+    context.user_data.pop('import_mode', None)
+    if not is_assistant(update):
+        await update.message.reply_text("❌ У вас нет прав для использования этой команды")
+        return
+
+    document = update.message.document
+    if document.file_size and document.file_size > IMPORT_MAX_SIZE:
+        await update.message.reply_text("❌ Файл слишком большой (максимум 1 МБ)")
+        return
+
+    settings = user_settings.get(str(update.effective_user.id), {})
+    telegram_file = await document.get_file()
+    raw = bytes(await telegram_file.download_as_bytearray())
+    text = await import_document(
+        document.file_name or "", raw, settings.get('course'), settings.get('stream'),
+        dry_run=mode == "check", accept_conflicts=mode == "accept"
+    )
+    await update.message.reply_text(text[:MAX_MESSAGE_LENGTH])
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """@бот <запрос>: сегодня, завтра, неделя, день недели или предмет своего потока"""
+    user_id = str(update.effective_user.id)
+    settings = user_settings.get(user_id, {})
+    course, stream = settings.get('course'), settings.get('stream')
+    if not course or not stream:
+        await update.inline_query.answer(
+            [], cache_time=0, is_personal=True,
+            button=InlineQueryResultsButton(text="Выбрать курс и поток", start_parameter="inline")
+        )
+        return
+
+    await ensure_calendar(course, stream)
+    english_time = settings.get('english_time')
+    now = clock.now()
+    days, subjects = match_inline_query(course, stream, update.inline_query.query)
+
+    cards = [inline_day_result(course, stream, target, now.date(), english_time) for target in days]
+    cards += [inline_subject_result(course, stream, subject, int(now.timestamp()), english_time) for subject in subjects]
+
+    results = []
+    for result_id, title, text in cards[:INLINE_MAX_RESULTS]:
+        text = schedule_status(course, stream, text)[:MAX_MESSAGE_LENGTH]
+        description = text.split("\n", 2)[1] if text.count("\n") > 1 else text
+        results.append(InlineQueryResultArticle(
+            id=result_id,
+            title=title,
+            description=description[:100],
+            input_message_content=InputTextMessageContent(text)
+        ))
+
+    await update.inline_query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True)
+
+async def teacher_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await directory_command(update, context, "teacher")
+
+async def room_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await directory_command(update, context, "room")
+
 # === АДМИНСКИЕ КОМАНДЫ ===
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update):
@@ -1256,11 +5035,7 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text += "📚 По курсам и потокам:\n"
     for course, streams in sorted(stats_data['course_stats'].items()):
         for stream, count in sorted(streams.items()):
-            stream_name = STREAM_NAMES.get(stream, stream)
-            if course == "1":
-                text += f"  • {course} курс, {stream_name}: {count}\n"
-            else:
-                text += f"  • {course} курс: {count}\n"
+            text += f"  • {course_title(course, stream)}: {count}\n"
 
     text += f"\n🔔 Напоминания:\n"
     text += f"  • Включены: {stats_data['reminders_stats']['enabled']}\n"
@@ -1271,8 +5046,33 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text += f"  • День: {stats_data['english_time_stats']['afternoon']}\n"
     text += f"  • Не выбрано: {stats_data['english_time_stats']['none']}\n"
 
+    text += f"\n📈 Активность:\n"
+    for days in (7, 30):
+        daily, unique, new_users = activity_trend(days)
+        text += (f"  • {days} дн: {unique} уникальных, {sum(daily) / days:.1f} в день, "
+                 f"новых {new_users}\n    {sparkline(daily)}\n")
+    text += f"  • Сегодня: {activity_trend(1)[1]}\n"
+
     await update.message.reply_text(text)
 
+async def usage(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        await update.message.reply_text("❌ У вас нет прав для использования этой команды")
+        return
+
+    days = 7
+    if context.args:
+        try:
+            days = max(1, min(int(context.args[0]), USAGE_DAILY_KEEP_DAYS))
+        except ValueError:
+            await update.message.reply_text("Использование: /usage [дней]\nПример: /usage 30")
+            return
+
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, write_usage_batch, *take_usage_batch())
+    rollups = await loop.run_in_executor(None, rollup_usage)
+    await update.message.reply_text(format_usage_report(rollups, days))
+
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update):
         await update.message.reply_text("❌ У вас нет прав для использования этой команды")
@@ -1296,7 +5096,7 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
             success_count += 1
             await asyncio.sleep(0.05)
         except Exception as e:
-            logging.error(f"Ошибка отправки сообщения пользователю {user_id}: {e}")
+            logging.error("Ошибка отправки сообщения пользователю %s: %s", user_id, e)
             fail_count += 1
 
     await update.message.reply_text(
@@ -1366,19 +5166,210 @@ async def list_assistants(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text(text)
 
+# === СОСТОЯНИЕ ДИАЛОГОВ ===
+# Шаг многошагового сценария (добавление ДЗ, импорт) хранится в context.user_data. Ключи сценариев
+# каждого пользователя лежат в отдельном файле conversation_state/<id>.json: раз в STATE_FLUSH_INTERVAL
+# переписываются только изменившиеся. Сценарий, не продвинувшийся за STATE_TTL, сбрасывается —
+# иначе случайное сообщение через неделю сохранится как ДЗ. В памяти держится не больше
+# STATE_MAX_IDLE_USERS пользователей без начатого сценария, давно не заходившие выгружаются.
+STATE_FLOW_KEYS = (
+    'hw_subject', 'hw_date', 'hw_course', 'hw_stream', 'awaiting_hw_text',
+    'awaiting_import', 'import_mode'
+)
+HW_FLOW_KEYS = ('hw_subject', 'hw_date', 'hw_course', 'hw_stream', 'awaiting_hw_text')
+
+def flow_state(user_data):
+    return {key: user_data[key] for key in STATE_FLOW_KEYS if key in user_data}
+
+class ConversationStatePersistence(BasePersistence):
+    """Персистентность PTB только для user_data, и только для ключей сценариев"""
+
+    def __init__(self, directory=STATE_DIR):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=STATE_FLUSH_INTERVAL
+        )
+        self.directory = directory
+        # Что лежит на диске и когда это состояние изменилось
+        self.saved = {}
+        self.updated = {}
+        # Последнее обращение пользователя: порядок выгрузки при превышении лимита
+        self.seen = OrderedDict()
+
+    def path(self, user_id):
+        return os.path.join(self.directory, f"{user_id}.json")
+
+    def remove(self, user_id):
+        self.saved.pop(user_id, None)
+        self.updated.pop(user_id, None)
+        try:
+            os.remove(self.path(user_id))
+        except FileNotFoundError:
+            pass
+
+    def is_expired(self, user_id, user_data):
+        """Сценарий не менялся с последней записи дольше STATE_TTL"""
+        updated = self.updated.get(user_id)
+        return (
+            updated is not None and clock.time() - updated > STATE_TTL
+            and flow_state(user_data) == self.saved.get(user_id)
+        )
+
+    async def get_user_data(self):
+        user_data = {}
+        if not os.path.isdir(self.directory):
+            return user_data
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json") or not name[:-len(".json")].isdigit():
+                continue
+            user_id = int(name[:-len(".json")])
+            try:
+                with open(self.path(user_id), "r", encoding="utf-8") as f:
+                    record = json.load(f)
+                state, updated = record["data"], record["updated"]
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logging.warning("Не удалось прочитать состояние диалога %s: %s", name, e)
+                continue
+            self.saved[user_id], self.updated[user_id] = state, updated
+            if self.is_expired(user_id, state):
+                self.remove(user_id)
+                continue
+            user_data[user_id] = dict(state)
+        logging.info("💬 Восстановлено незавершенных сценариев: %s", len(user_data))
+        return user_data
+
+    async def update_user_data(self, user_id, data):
+        state = flow_state(data)
+        if state == self.saved.get(user_id, {}):
+            return
+        if not state:
+            self.remove(user_id)
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        updated = clock.time()
+        write_json_atomically(self.path(user_id), {"updated": updated, "data": state})
+        self.saved[user_id], self.updated[user_id] = state, updated
+
+    async def drop_user_data(self, user_id):
+        self.seen.pop(user_id, None)
+        self.remove(user_id)
+
+    async def refresh_user_data(self, user_id, user_data):
+        """Перед обработкой каждого обновления: брошенный сценарий начинается заново"""
+        self.seen[user_id] = clock.time()
+        self.seen.move_to_end(user_id)
+        if self.is_expired(user_id, user_data):
+            for key in STATE_FLOW_KEYS:
+                user_data.pop(key, None)
+
+    async def flush(self):
+        # Изменения пишутся сразу в update_user_data, PTB вызывает его и при остановке
+        pass
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+def sweep_conversation_states(application):
+    """Сбрасывает брошенные сценарии и выгружает лишних пользователей без сценария; число выгруженных"""
+    persistence = application.persistence
+    dropped = [
+        user_id for user_id, user_data in application.user_data.items()
+        if persistence.is_expired(user_id, user_data)
+    ]
+    idle = [
+        user_id for user_id, user_data in application.user_data.items()
+        if not flow_state(user_data) and user_id not in dropped
+    ]
+    if len(idle) > STATE_MAX_IDLE_USERS:
+        idle.sort(key=lambda user_id: persistence.seen.get(user_id, 0))
+        dropped += idle[:len(idle) - STATE_MAX_IDLE_USERS]
+    for user_id in dropped:
+        application.drop_user_data(user_id)
+    return len(dropped)
+
+async def sweep_conversation_states_periodically(application):
+    while True:
+        await asyncio.sleep(STATE_SWEEP_INTERVAL)
+        try:
+            dropped = sweep_conversation_states(application)
+        except Exception as e:
+            logging.error("❌ Ошибка при очистке состояния диалогов: %s", e)
+            continue
+        if dropped:
+            logging.info("💬 Выгружено состояний диалогов: %s, в памяти: %s", dropped, len(application.user_data))
+
 # === ГЛАВНАЯ ФУНКЦИЯ ===
 
 async def post_init(application):
     asyncio.create_task(scheduler())
+    asyncio.create_task(watch_data_files())
+    asyncio.create_task(flush_activity_periodically())
+    asyncio.create_task(usage_log_worker())
+    asyncio.create_task(sweep_conversation_states_periodically(application))
+    if PRELOAD_ON_STARTUP:
+        asyncio.create_task(preload_calendars())
+    try:
+        await start_feed_server()
+    except OSError as e:
+        logging.error("❌ Не удалось запустить сервер ICS-фидов: %s", e)
     logging.info("✅ Планировщик запущен!")
 
 def main():
-    global user_settings, application, assistants, subject_renames, schedule_edits
+    global BOT_TOKEN, user_settings, application, assistants, subject_renames, schedule_edits
+
+    setup_logging()
+    atexit.register(stop_logging)
+
+    BOT_TOKEN = load_bot_token()
+    if not BOT_TOKEN:
+        exit(1)
 
     user_settings = load_user_settings()
+    rebuild_user_stats()
+    load_activity()
+    load_usage_names()
     assistants = load_assistants()
     subject_renames = load_subject_renames()
     schedule_edits = load_schedule_edits()
+    remember_data_files()
+    pending_write_flushers.append(lambda: save_user_settings(user_settings))
+    pending_write_flushers.append(save_activity)
+    pending_write_flushers.append(flush_usage_log)
+
+    # Расписания выбранных пользователями потоков поднимаются в фоне после запуска (preload_calendars),
+    # остальные — при первом обращении
+    logging.info("📚 Источников: %s, бюджет памяти на расписания: %s МБ",
+                 sum(len(streams) for streams in STREAM_URLS.values()), CALENDAR_MEMORY_BUDGET // (1024 * 1024))
 
     logging.info("🤖 Запуск бота...")
 
@@ -1387,21 +5378,39 @@ def main():
         .token(BOT_TOKEN)
         .proxy(PROXY_URL)
         .get_updates_proxy(PROXY_URL)
+        .persistence(ConversationStatePersistence())
         .post_init(post_init)
         .build()
     )
 
+    application.add_handler(TypeHandler(Update, track_activity), group=-1)
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("next", next_lesson))
+    application.add_handler(CommandHandler("teacher", teacher_search))
+    application.add_handler(CommandHandler("room", room_search))
+    application.add_handler(CommandHandler("free", free_time))
+    application.add_handler(CommandHandler("ics", ics_feed))
     application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("usage", usage))
     application.add_handler(CommandHandler("broadcast", broadcast))
     application.add_handler(CommandHandler("add_assistant", add_assistant))
     application.add_handler(CommandHandler("remove_assistant", remove_assistant))
     application.add_handler(CommandHandler("list_assistants", list_assistants))
+    application.add_handler(CommandHandler("import", import_command))
     application.add_handler(CallbackQueryHandler(handle_query))
+    application.add_handler(InlineQueryHandler(inline_query))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
 
     logging.info("✅ Бот успешно запущен!")
     application.run_polling()
 
+    flush_pending_writes()
+    shutdown_parse_pool()
+    if restart_requested:
+        logging.info("♻️ Перезапуск процесса с обновленным кодом...")
+        stop_logging()
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,289 @@
+"""Ускоренная симуляция семестра: планировщик бота в виртуальном времени против фейкового Telegram.
+
+Проверяет, что напоминания о ДЗ и уведомления об изменениях приходят ровно один раз
+и вовремя, плановое обновление идет раз в сутки, а «сегодня» и «завтра» сменяются в полночь.
+
+Запуск: python simulate.py --streams 3 --users 300 --weeks 18
+"""
+import argparse
+import asyncio
+import collections
+import datetime
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+import main as bot
+import gen_scale_data
+
+# Допустимое опоздание доставки относительно срока задачи, секунды виртуального времени
+TIMING_TOLERANCE = 60
+SEMESTER_START = datetime.date(2026, 2, 9)
+
+# === ВИРТУАЛЬНОЕ ВРЕМЯ ===
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """Цикл событий, в котором ожидание таймера не спит, а сдвигает часы цикла.
+
+    Готовый ввод-вывод проверяется без ожидания; если его нет и есть таймеры, время
+    мгновенно переносится к ближайшему. Пока работают задачи в пулах (run_in_executor —
+    скачивание и разбор ICS), цикл ждет их по-настоящему, а виртуальное время стоит.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.virtual_time = 0.0
+        self.executor_calls = 0
+        real_select = self._selector.select
+
+        def virtual_select(timeout=None):
+            ready = real_select(0)
+            if ready or timeout == 0:
+                return ready
+            if timeout is None or self.executor_calls:
+                return real_select(None)
+            self.virtual_time += timeout
+            return []
+
+        self._selector.select = virtual_select
+
+    def run_in_executor(self, executor, func, *args):
+        future = super().run_in_executor(executor, func, *args)
+        self.executor_calls += 1
+
+        def done(_):
+            self.executor_calls -= 1
+
+        future.add_done_callback(done)
+        return future
+
+    def time(self):
+        return self.virtual_time
+
+class VirtualClock(bot.SystemClock):
+    """Часы бота, идущие вместе с временем цикла"""
+
+    def __init__(self, loop, start_ts):
+        self.loop = loop
+        self.start_ts = start_ts
+
+    def time(self):
+        return self.start_ts + self.loop.time()
+
+# === ФЕЙКОВЫЙ TELEGRAM ===
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((str(chat_id), text, bot.clock.time()))
+
+class FakeApplication:
+    def __init__(self):
+        self.bot = FakeBot()
+
+    def stop_running(self):
+        pass
+
+# === СЦЕНАРИЙ ===
+def local_ts(date, hour, minute=0, second=0):
+    return bot.local_to_ts(date.year, date.month, date.day, hour, minute, second)
+
+async def sleep_until(ts):
+    await asyncio.sleep(max(ts - bot.clock.time(), 0))
+
+def expected_reminders(first_day, last_day):
+    """(пользователь, день) для каждого вечера, когда на завтра есть ДЗ его потока"""
+    expected = collections.Counter()
+    homework_dates = {}
+    for user_id, settings in bot.user_settings.items():
+        if not (settings.get('reminders') and settings.get('course') and settings.get('stream')):
+            continue
+        cache_key = f"{settings['course']}_{settings['stream']}"
+        if cache_key not in homework_dates:
+            homeworks = bot.load_homeworks(settings['course'], settings['stream'])
+            homework_dates[cache_key] = {bot.decode_iso_date(key.split('|')[1]) for key in homeworks}
+        for date in homework_dates[cache_key]:
+            day = date - datetime.timedelta(days=1)
+            if first_day <= day <= last_day:
+                expected[(user_id, day)] += 1
+    return collections.Counter({key: 1 for key in expected})
+
+def shift_lesson(path, date, label):
+    """Меняет аудиторию первой пары даты прямо в ICS-файле; False, если пар нет"""
+    with open(path, "r", encoding="utf-8") as f:
+        data = f.read()
+    match = re.search(rf"DTSTART;TZID=Europe/Moscow:{date.strftime('%Y%m%d')}T\d{{6}}\n[^\n]*\nLOCATION:[^\n]*", data)
+    if match is None:
+        return False
+    block = re.sub(r"LOCATION:[^\n]*$", f"LOCATION:{label}", match.group(0))
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(data[:match.start()] + block + data[match.end():])
+    return True
+
+async def editor(paths, first_day, last_day, edits):
+    """Раз в неделю, по средам в 12:00, переносит пару потока на пятницу"""
+    day = first_day
+    number = 0
+    while day <= last_day:
+        if day.weekday() == 2:
+            cache_key, path = paths[number % len(paths)]
+            await sleep_until(local_ts(day, 12))
+            if shift_lesson(path, day + datetime.timedelta(days=2), f"Перенос {number}"):
+                edits.append((cache_key, day + datetime.timedelta(days=1)))
+            number += 1
+        day += datetime.timedelta(days=1)
+
+async def rollover_probe(first_day, last_day, failures):
+    """За секунду до и ровно в полночь «сегодня» и «завтра» должны указывать на нужные даты"""
+    day = first_day
+    while day < last_day:
+        midnight = local_ts(day + datetime.timedelta(days=1), 0)
+        await sleep_until(midnight - 1)
+        if bot.clock.today() != day:
+            failures.append(f"23:59:59 {day}: сегодня {bot.clock.today()}")
+        await sleep_until(midnight)
+        if bot.clock.today() != day + datetime.timedelta(days=1):
+            failures.append(f"00:00:00 {day + datetime.timedelta(days=1)}: сегодня {bot.clock.today()}")
+        day += datetime.timedelta(days=1)
+
+def run_simulation(args, workdir):
+    start_date = SEMESTER_START
+    config = gen_scale_data.write_dataset(workdir, 1, args.streams, args.users, args.weeks, args.seed, start_date)
+    bot.apply_sources(config)
+    bot.user_settings = bot.load_user_settings()
+    bot.rebuild_user_stats()
+    for settings in bot.user_settings.values():
+        settings['change_notifications'] = settings['change_notifications'] or settings['reminders']
+
+    first_day = start_date
+    last_day = start_date + datetime.timedelta(days=args.weeks * 7 - 1)
+    paths = [
+        (f"{course['id']}_{stream['id']}", stream['url'][len("file://"):])
+        for faculty in config['faculties'] for course in faculty['courses'] for stream in course['streams']
+    ]
+
+    loop = VirtualTimeLoop()
+    asyncio.set_event_loop(loop)
+    bot.clock = VirtualClock(loop, local_ts(first_day, 0))
+    bot.application = FakeApplication()
+
+    job_runs = collections.defaultdict(list)
+    edits, failures = [], []
+
+    def recorded(job):
+        async def run():
+            job_runs[job.__name__].append(bot.clock.time())
+            if job is not bot.check_for_updates:
+                await job()
+        run.__name__ = job.__name__
+        return run
+
+    bot.SCHEDULED_JOBS = [(hour, minute, recorded(job)) for hour, minute, job in bot.SCHEDULED_JOBS]
+    for cache_key, _ in paths:
+        bot.load_events_from_github(*cache_key.split('_', 1))
+
+    async def scenario():
+        scheduler = asyncio.ensure_future(bot.scheduler())
+        await asyncio.gather(
+            editor(paths, first_day, last_day - datetime.timedelta(days=3), edits),
+            rollover_probe(first_day, last_day, failures),
+        )
+        await sleep_until(local_ts(last_day + datetime.timedelta(days=1), 0))
+        scheduler.cancel()
+
+    started = time.perf_counter()
+    try:
+        loop.run_until_complete(scenario())
+    finally:
+        bot.shutdown_parse_pool()
+        asyncio.set_event_loop(None)
+        loop.close()
+    elapsed = time.perf_counter() - started
+    return first_day, last_day, job_runs, edits, failures, elapsed
+
+def check_results(first_day, last_day, job_runs, edits, failures):
+    """Сверяет доставку с ожидаемой: ровно один раз и не позже TIMING_TOLERANCE"""
+    sent = bot.application.bot.sent
+    days = (last_day - first_day).days + 1
+    max_lag = 0
+
+    for name, (hour, minute) in {"send_homework_reminders": (20, 0), "check_for_updates": (9, 0),
+                                 "refresh_all_calendars": (7, 0)}.items():
+        runs = collections.Counter(bot.ts_to_date(int(ts)) for ts in job_runs[name])
+        if len(runs) != days or max(runs.values()) != 1:
+            failures.append(f"{name}: {len(job_runs[name])} запусков за {days} дней")
+        for ts in job_runs[name]:
+            lag = ts - local_ts(bot.ts_to_date(int(ts)), hour, minute)
+            max_lag = max(max_lag, lag)
+            if not 0 <= lag <= TIMING_TOLERANCE:
+                failures.append(f"{name}: запуск {bot.ts_to_datetime(int(ts))}, опоздание {lag:.0f} с")
+
+    reminders = collections.Counter()
+    changes = collections.Counter()
+    for user_id, text, ts in sent:
+        day = bot.ts_to_date(int(ts))
+        if text.startswith("🔔"):
+            reminders[(user_id, day)] += 1
+            lag = ts - local_ts(day, 20)
+        else:
+            changes[(user_id, day)] += 1
+            lag = ts - local_ts(day, 7)
+        max_lag = max(max_lag, lag)
+        if not 0 <= lag <= TIMING_TOLERANCE:
+            failures.append(f"сообщение {user_id} в {bot.ts_to_datetime(int(ts))}: опоздание {lag:.0f} с")
+
+    expected = expected_reminders(first_day, last_day)
+    for key in expected.keys() | reminders.keys():
+        if reminders[key] != expected[key]:
+            failures.append(f"напоминание {key[0]} {key[1]}: {reminders[key]} вместо {expected[key]}")
+
+    expected_changes = collections.Counter()
+    for cache_key, day in edits:
+        course, stream = cache_key.split('_', 1)
+        for user_id, settings in bot.user_settings.items():
+            if settings.get('change_notifications') and (settings.get('course'), settings.get('stream')) == (course, stream):
+                expected_changes[(user_id, day)] += 1
+    for key in expected_changes.keys() | changes.keys():
+        if changes[key] != expected_changes[key]:
+            failures.append(f"уведомление об изменениях {key[0]} {key[1]}: {changes[key]} вместо {expected_changes[key]}")
+
+    return len(reminders), len(changes), max_lag
+
+def main():
+    parser = argparse.ArgumentParser(description="Симуляция семестра в виртуальном времени")
+    parser.add_argument("--streams", type=int, default=3)
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--weeks", type=int, default=18)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix="simulate_")
+    previous_dir = os.getcwd()
+    os.chdir(workdir)
+    try:
+        first_day, last_day, job_runs, edits, failures, elapsed = run_simulation(args, workdir)
+        reminders, changes, max_lag = check_results(first_day, last_day, job_runs, edits, failures)
+    finally:
+        os.chdir(previous_dir)
+        shutil.rmtree(workdir, ignore_errors=True)
+        bot.clock = bot.SystemClock()
+        logging.disable(logging.NOTSET)
+
+    print(f"Семестр {first_day} — {last_day}: {(last_day - first_day).days + 1} дней за {elapsed:.2f} с")
+    print(f"Напоминаний: {reminders}, уведомлений об изменениях: {changes} ({len(edits)} переносов)")
+    print(f"Запусков задач: " + ", ".join(f"{name} {len(runs)}" for name, runs in sorted(job_runs.items())))
+    print(f"Наибольшее опоздание: {max_lag:.2f} с")
+    if failures:
+        print(f"ОШИБКИ ({len(failures)}):")
+        for failure in failures[:20]:
+            print(f"  {failure}")
+        sys.exit(1)
+    print("✅ Все доставки ровно один раз и вовремя")
+
+if __name__ == '__main__':
+    main()